@@ -0,0 +1,355 @@
+"""
+A read-only JSON API of the catalog, for kiosks and the mobile app.
+
+    /library/api/books                             books
+    /library/api/bookcopies?book=&library_branch=  book copies and their status
+    /library/api/books/<id>/availability           copies available at each branch,
+                                                   see library.availability
+
+Lists are returned a page at a time: 'limit' rows (API_LIMIT unless given)
+after the 'cursor' given, with the cursor of the next page in 'next', or
+null on the last page.  'fields' selects the fields of the rows, e.g.
+?fields=id,title, and only the columns of those fields are read.
+
+Every response has an ETag made from the versions of the data it shows
+(see library.versions): the catalog
+versions, the checkout version of each book copy and, where the status of
+copies is shown, the last 6PM, when reservations expire.  The ids of a
+page are cached under the catalog versions, so a client polling with
+If-None-Match gets 304 Not Modified without a single database query.
+Checkouts bump the versions again once they commit (see library.checkout),
+so a response built while a checkout was in progress is never answered
+304 under the versions of its outcome.
+There is no Last-Modified header: it only has a resolution of a second, so
+a change made in the same second as a response would be answered 304 to
+If-Modified-Since.
+Readers are never shown: a status is 'available', 'reserved' or 'borrowed'.
+"""
+
+from collections import OrderedDict
+from datetime import datetime
+from functools import wraps
+import json
+import pytz
+
+from django.core.cache import cache
+from django.http import Http404, HttpResponse, HttpResponseBadRequest
+from django.views.decorators.http import condition, require_safe
+
+from .models import (Book, BookAvailability, BookCopy, BookCopyCheckout,
+                     reserve_cutoff_date)
+from . import versions
+from .exports import plain_value
+from .listing import decode_cursor, encode_cursor
+
+# The number of rows of a page, unless the request asks for another number.
+API_LIMIT = 50
+
+# The most rows a request may ask for.
+MAX_API_LIMIT = 500
+
+# The versions of which books and copies exist, and where.
+CATALOG_VERSIONS = ['book', 'librarybranch', 'bookcopy']
+
+# The fields of the rows, and the lookups they are read from.
+BOOK_FIELDS = OrderedDict([
+        ('id', 'id'),
+        ('isbn', 'isbn'),
+        ('title', 'title'),
+        ('publisher', 'publisher__name'),
+        ('publication_date', 'publication_date'),
+        ('authors', None),
+        ])
+BOOKCOPY_FIELDS = OrderedDict([
+        ('id', 'id'),
+        ('book', 'book'),
+        ('isbn', 'book__isbn'),
+        ('title', 'book__title'),
+        ('library_branch', 'library_branch'),
+        ('library_branch_name', 'library_branch__name'),
+        ('copy_number', 'copy_number'),
+        ('position', 'position'),
+        ('status', None),
+        ])
+
+# The columns of the current checkout a status is found from.
+STATUS_LOOKUPS = ('current_checkout', 'current_checkout__reserve_date',
+                  'current_checkout__borrow_date', 'current_checkout__return_date')
+
+
+class ApiError(ValueError):
+    """
+    A request with bad parameters, answered with 400 Bad Request.
+    """
+    pass
+
+
+class ApiResponse(object):
+    """
+    The ETag of a response, and how to build its content when the
+    client does not have it already.
+    """
+    def __init__(self, parts, version_list, build, cutoff_date=None):
+        """
+        @param parts:everything besides the versions the content depends on
+        @param version_list:Array<int>, the versions of the data shown
+        @param build:function returning the content, made into JSON
+        @param cutoff_date:datetime | None, the last time the statuses shown
+               changed by themselves
+        """
+        self.etag = versions.fragment_key(parts, version_list, cutoff_date)
+        self.build = build
+
+
+def api_view(prepare):
+    """
+    Make a view of a function that prepares an ApiResponse.  A conditional
+    GET is answered from the ETag alone, without building the content.
+    """
+    def prepared(request, *args, **kwargs):
+        # The ETag and the view share one ApiResponse.
+        if not hasattr(request, '_api_response'):
+            request._api_response = prepare(request, *args, **kwargs)
+        return request._api_response
+
+    @condition(etag_func=lambda request, *args, **kwargs:
+                   prepared(request, *args, **kwargs).etag)
+    def view(request, *args, **kwargs):
+        content = prepared(request, *args, **kwargs).build()
+        return HttpResponse(json.dumps(content), content_type='application/json')
+
+    @wraps(prepare)
+    @require_safe
+    def view_or_error(request, *args, **kwargs):
+        try:
+            return view(request, *args, **kwargs)
+        except ApiError as e:
+            return HttpResponseBadRequest(json.dumps({'error' : unicode(e)}),
+                                          content_type='application/json')
+    return view_or_error
+
+
+def get_id(request, name):
+    """
+    @return int | None, an id given in the query string
+    """
+    value = request.GET.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise ApiError('"%s" must be an id.' % name)
+    return int(value)
+
+
+def get_limit(request):
+    """
+    @return int, the number of rows asked for
+    """
+    value = request.GET.get('limit', str(API_LIMIT))
+    if not value.isdigit() or not 1 <= int(value) <= MAX_API_LIMIT:
+        raise ApiError('"limit" must be a number from 1 to %d.' % MAX_API_LIMIT)
+    return int(value)
+
+
+def get_after(request):
+    """
+    @return int, the id the page starts after
+    """
+    token = request.GET.get('cursor')
+    if not token:
+        return 0
+    cursor = decode_cursor(token)
+    if cursor is None or cursor[0] != 'after' or cursor[1] is None:
+        raise ApiError('"cursor" is not valid.')
+    return cursor[1]
+
+
+def get_fields(request, fields):
+    """
+    @param fields:OrderedDict, the fields a row may have
+    @return Array<string>, the fields asked for, all of them by default
+    """
+    value = request.GET.get('fields')
+    if not value:
+        return list(fields)
+    names = value.split(',')
+    for name in names:
+        if name not in fields:
+            raise ApiError('Unknown field "%s", use some of: %s.' % (name, ','.join(fields)))
+    return names
+
+
+def cached_ids(name, parts, version_names, find):
+    """
+    Read the ids a response shows from the cache, or find and store them.
+    @param parts:everything besides the versions the ids depend on
+    @param find:function returning the ids
+    @return (ids, Array<int>), the ids and the versions they depend on
+    """
+    version_list = versions.get_versions(version_names)
+    key = 'library.api.%s.%s' % (name, versions.fragment_key(parts, version_list))
+    ids = cache.get(key)
+    if ids is None:
+        ids = find()
+        cache.set(key, ids, versions.FRAGMENT_TIMEOUT)
+    return ids, version_list
+
+
+def page_ids(queryset, after, limit):
+    """
+    @return (Array<int>, int | None), the ids of a page and the id the next
+            page starts after, None on the last page
+    """
+    ids = list(queryset.filter(id__gt=after).order_by('id')
+               .values_list('id', flat=True)[:limit + 1])
+    if len(ids) > limit:
+        return ids[:limit], ids[limit - 1]
+    return ids, None
+
+
+def next_cursor(next_id):
+    if next_id is None:
+        return None
+    return encode_cursor('after', next_id, None)
+
+
+def select_rows(queryset, ids, lookups):
+    """
+    @return dict<int, tuple>, the values of the lookups by id
+    """
+    return dict((values[0], values[1:]) for values in
+                queryset.filter(id__in=ids).values_list('id', *lookups))
+
+
+def checkout_status(values, now):
+    """
+    @param values:tuple, the values of STATUS_LOOKUPS
+    @return string, 'available', 'reserved' or 'borrowed'
+    """
+    checkout_id, reserve_date, borrow_date, return_date = values
+    if checkout_id is None:
+        return 'available'
+    # As BookCopyCheckout.status(), without telling whose the checkout is.
+    checkout = BookCopyCheckout(id=checkout_id, reserve_date=reserve_date,
+                                borrow_date=borrow_date, return_date=return_date)
+    if not checkout.is_current(now):
+        return 'available'
+    if checkout.borrow_date:
+        return 'borrowed'
+    return 'reserved'
+
+
+def book_rows(ids, fields):
+    """
+    @return Array<OrderedDict>, the fields of the books, in the order of the ids
+    """
+    lookups = [BOOK_FIELDS[name] for name in fields if name != 'authors']
+    rows = select_rows(Book.objects.all(), ids, lookups)
+    authors = dict((book_id, []) for book_id in ids)
+    if 'authors' in fields:
+        for book_id, name in Book.authors.through.objects.filter(book__in=ids) \
+                .order_by('id').values_list('book', 'author__name'):
+            authors[book_id].append(name)
+    result = []
+    for book_id in ids:
+        if book_id not in rows:
+            continue
+        values = iter(rows[book_id])
+        result.append(OrderedDict(
+                (name, authors[book_id] if name == 'authors' else plain_value(next(values)))
+                for name in fields))
+    return result
+
+
+def bookcopy_rows(ids, fields, now):
+    """
+    @return Array<OrderedDict>, the fields of the book copies, in the order of the ids
+    """
+    lookups = [BOOKCOPY_FIELDS[name] for name in fields if name != 'status']
+    if 'status' in fields:
+        lookups.extend(STATUS_LOOKUPS)
+    rows = select_rows(BookCopy.objects.all(), ids, lookups)
+    result = []
+    for bookcopy_id in ids:
+        if bookcopy_id not in rows:
+            continue
+        values = rows[bookcopy_id]
+        if 'status' in fields:
+            status_values = values[-len(STATUS_LOOKUPS):]
+        values = iter(values)
+        result.append(OrderedDict(
+                (name, checkout_status(status_values, now) if name == 'status'
+                 else plain_value(next(values)))
+                for name in fields))
+    return result
+
+
+@api_view
+def books(request):
+    fields = get_fields(request, BOOK_FIELDS)
+    after = get_after(request)
+    limit = get_limit(request)
+    (ids, next_id), version_list = cached_ids(
+        'books', (after, limit), ['book'],
+        lambda: page_ids(Book.objects.all(), after, limit))
+    return ApiResponse(('books', after, limit, fields), version_list, lambda: {
+            'results' : book_rows(ids, fields),
+            'next' : next_cursor(next_id),
+            })
+
+
+@api_view
+def bookcopies(request):
+    fields = get_fields(request, BOOKCOPY_FIELDS)
+    after = get_after(request)
+    limit = get_limit(request)
+    book_id = get_id(request, 'book')
+    library_branch_id = get_id(request, 'library_branch')
+    now = datetime.now(pytz.utc)
+
+    def find():
+        bookcopy_set = BookCopy.objects.all()
+        if book_id is not None:
+            bookcopy_set = bookcopy_set.filter(book=book_id)
+        if library_branch_id is not None:
+            bookcopy_set = bookcopy_set.filter(library_branch=library_branch_id)
+        return page_ids(bookcopy_set, after, limit)
+    (ids, next_id), version_list = cached_ids(
+        'bookcopies', (book_id, library_branch_id, after, limit), CATALOG_VERSIONS, find)
+    cutoff_date = None
+    if 'status' in fields:
+        version_list = version_list + versions.bookcopy_versions(ids)
+        cutoff_date = reserve_cutoff_date(now)
+    return ApiResponse(('bookcopies', book_id, library_branch_id, after, limit, fields),
+                       version_list, lambda: {
+            'results' : bookcopy_rows(ids, fields, now),
+            'next' : next_cursor(next_id),
+            }, cutoff_date)
+
+
+@api_view
+def book_availability(request, book_id):
+    book_id = int(book_id)
+
+    def find():
+        if not Book.objects.filter(id=book_id).exists():
+            return False, []
+        return True, list(BookCopy.objects.filter(book=book_id).order_by('id')
+                          .values_list('id', flat=True))
+    (exists, ids), version_list = cached_ids('availability', (book_id,), CATALOG_VERSIONS, find)
+    if not exists:
+        raise Http404
+
+    # The counts change with the checkouts of the copies, see library.availability.
+    return ApiResponse(('availability', book_id),
+                       version_list + versions.bookcopy_versions(ids), lambda: {
+            'book' : book_id,
+            'library_branches' : [
+                OrderedDict([('id', library_branch_id), ('name', name),
+                             ('available', available_count), ('copies', copy_count)])
+                for library_branch_id, name, available_count, copy_count
+                in BookAvailability.objects.filter(book=book_id)
+                .order_by('library_branch__name', 'library_branch')
+                .values_list('library_branch', 'library_branch__name',
+                             'available_count', 'copy_count')],
+            })
@@ -0,0 +1,155 @@
+"""
+How many copies of each book each branch has, and how many are available.
+
+A copy is available when it has no current checkout.  The counts of a
+book at a branch are changed in the transaction that changes a copy:
+do_borrow and do_reserve take a copy, do_return and the reservation
+sweeper give it back, unless a reader waiting for the book gets it
+reserved instead (see library.holds).  Copies saved or deleted one at a time are counted
+again through signals, and the bulk imports call add_copies().  A
+reservation that expired at 6PM is counted as taken until the
+'expire_reservations' command clears it.  rebuild_availability() recounts
+everything, e.g. with the 'rebuild_availability' command.  Every change
+bumps the version of the counts of the book, see library.finder.
+"""
+
+from django.db.models import Count, F
+from django.db.models.signals import post_delete, post_save, pre_save
+
+from .models import BookAvailability, BookCopy
+from . import versions
+
+
+def count_keys(keys):
+    """
+    @param keys:Array<(int, int)>, a book and library branch id per copy
+    @return dict<(int, int), int>, the number of copies of each
+    """
+    counts = {}
+    for key in keys:
+        counts[key] = counts.get(key, 0) + 1
+    return counts
+
+
+def change_available(book_id, library_branch_id, delta):
+    BookAvailability.objects.filter(book=book_id, library_branch=library_branch_id) \
+        .update(available_count=F('available_count') + delta)
+    versions.bump_availability([book_id])
+
+
+def copy_taken(bookcopy):
+    """
+    Count a copy that was available as checked out.
+    """
+    change_available(bookcopy.book_id, bookcopy.library_branch_id, -1)
+
+
+def copy_returned(bookcopy):
+    """
+    Count a copy that was checked out as available.
+    """
+    change_available(bookcopy.book_id, bookcopy.library_branch_id, 1)
+
+
+def copies_returned(keys):
+    """
+    Count many copies as available again, e.g. after reservations expired.
+    @param keys:Array<(int, int)>, a book and library branch id per copy
+    """
+    for (book_id, library_branch_id), count in count_keys(keys).items():
+        BookAvailability.objects.filter(book=book_id, library_branch=library_branch_id) \
+            .update(available_count=F('available_count') + count)
+    versions.bump_availability([book_id for book_id, library_branch_id in keys])
+
+
+def add_copies(bookcopies):
+    """
+    Count new copies that have no checkout yet, e.g. after a bulk_create,
+    which sends no signals.
+    @param bookcopies:Array<BookCopy>
+    """
+    counts = count_keys([(bookcopy.book_id, bookcopy.library_branch_id)
+                         for bookcopy in bookcopies])
+    if not counts:
+        return
+    existing = set(BookAvailability.objects
+                   .filter(book__in=set(book_id for book_id, library_branch_id in counts),
+                           library_branch__in=set(library_branch_id for book_id,
+                                                  library_branch_id in counts))
+                   .values_list('book', 'library_branch'))
+    created = []
+    for (book_id, library_branch_id), count in counts.items():
+        if (book_id, library_branch_id) in existing:
+            BookAvailability.objects.filter(book=book_id, library_branch=library_branch_id) \
+                .update(copy_count=F('copy_count') + count,
+                        available_count=F('available_count') + count)
+        else:
+            created.append(BookAvailability(book_id=book_id, library_branch_id=library_branch_id,
+                                            copy_count=count, available_count=count))
+    BookAvailability.objects.bulk_create(created)
+    versions.bump_availability([book_id for book_id, library_branch_id in counts])
+
+
+def recount(book_id, library_branch_id):
+    """
+    Count the copies of a book at a branch again.
+    """
+    bookcopy_set = BookCopy.objects.filter(book=book_id, library_branch=library_branch_id)
+    copy_count = bookcopy_set.count()
+    available_count = bookcopy_set.filter(current_checkout__isnull=True).count()
+    availability_set = BookAvailability.objects.filter(book=book_id,
+                                                       library_branch=library_branch_id)
+    if copy_count == 0:
+        availability_set.delete()
+    elif not availability_set.update(copy_count=copy_count, available_count=available_count):
+        BookAvailability.objects.get_or_create(
+            book_id=book_id, library_branch_id=library_branch_id,
+            defaults={'copy_count' : copy_count, 'available_count' : available_count})
+    versions.bump_availability([book_id])
+
+
+def rebuild_availability():
+    """
+    Recount the copies of every book at every branch.
+    """
+    BookAvailability.objects.all().delete()
+    available = dict(((book_id, library_branch_id), count)
+                     for book_id, library_branch_id, count in BookCopy.objects
+                     .filter(current_checkout__isnull=True)
+                     .values_list('book', 'library_branch')
+                     .annotate(count=Count('id')).order_by())
+    BookAvailability.objects.bulk_create([
+            BookAvailability(book_id=book_id, library_branch_id=library_branch_id,
+                             copy_count=count,
+                             available_count=available.get((book_id, library_branch_id), 0))
+            for book_id, library_branch_id, count in BookCopy.objects
+            .values_list('book', 'library_branch')
+            .annotate(count=Count('id')).order_by()])
+    versions.bump('availability')
+
+
+def bookcopy_saving(sender, instance, update_fields=None, **kwargs):
+    # Remember where a saved copy was, in case it is moved.
+    instance._availability_key = None
+    if instance.pk and update_fields is None:
+        keys = list(BookCopy.objects.filter(pk=instance.pk)
+                    .values_list('book', 'library_branch'))
+        if keys:
+            instance._availability_key = keys[0]
+
+def bookcopy_saved(sender, instance, update_fields=None, **kwargs):
+    # Checkouts only save current_checkout, and change the counts themselves.
+    if update_fields is not None and set(update_fields) == set(['current_checkout']):
+        return
+    key = (instance.book_id, instance.library_branch_id)
+    recount(*key)
+    old_key = getattr(instance, '_availability_key', None)
+    if old_key and old_key != key:
+        recount(*old_key)
+
+def bookcopy_deleted(sender, instance, **kwargs):
+    recount(instance.book_id, instance.library_branch_id)
+
+pre_save.connect(bookcopy_saving, sender=BookCopy)
+post_save.connect(bookcopy_saved, sender=BookCopy)
+post_delete.connect(bookcopy_deleted, sender=BookCopy)
@@ -0,0 +1,113 @@
+"""
+Borrowing, reserving and returning book copies, and holding books.
+
+Each action runs in its own transaction with the book copy row locked, so
+the checks made before an action still hold when its records are written.
+The cache versions of the copy are bumped again once the transaction has
+committed, see library.versions.
+"""
+
+import random
+import time
+
+from django.contrib.auth.models import User
+from django.db import DatabaseError, transaction
+
+from .models import BookCopy, BookCopyCheckout, MAX_ACTIVE_CHECKOUTS
+from . import holds, versions
+
+# MySQL error codes for a lock wait timeout and a deadlock.
+RETRY_ERROR_CODES = (1205, 1213)
+
+# How many times a failed transaction is run again, and the base delay
+# in seconds, which doubles on every attempt.
+CHECKOUT_RETRIES = 3
+RETRY_DELAY = 0.01
+
+
+def is_retryable(error):
+    """
+    Determine if a database error means the transaction lost a race for a
+    lock, in which case it may simply be run again.
+    @param error:DatabaseError
+    @return bool
+    """
+    if error.args and error.args[0] in RETRY_ERROR_CODES:
+        return True
+    return 'database is locked' in str(error)
+
+
+def checkout_bookcopy(user, bookcopy_id, action, now, retries=CHECKOUT_RETRIES):
+    """
+    Borrow, reserve or return a book copy, or hold its book, on behalf of
+    a user.
+    A ValueError with a message for the reader is raised if the action is
+    not allowed.  A transaction that deadlocks or times out waiting for a
+    lock is retried after a short random delay.
+    @param action:string, one of 'borrow', 'reserve', 'return' or 'hold'
+    @return BookCopy
+    """
+    attempt = 0
+    while True:
+        try:
+            bookcopy = _checkout_bookcopy(user, bookcopy_id, action, now)
+            break
+        except DatabaseError as e:
+            if attempt >= retries or not is_retryable(e):
+                raise
+        attempt += 1
+        time.sleep(random.uniform(0, RETRY_DELAY * 2 ** attempt))
+    if action != 'hold':
+        # The actions bump the versions of the copy before the transaction
+        # commits, so a page read in between may have been cached under them
+        # with the old status.  New versions now drop such pages.
+        versions.bump_bookcopies([bookcopy.id])
+        versions.bump_availability([bookcopy.book_id])
+    return bookcopy
+
+
+def _checkout_bookcopy(user, bookcopy_id, action, now):
+    """
+    Perform a checkout action in a single transaction.
+    """
+    with transaction.commit_on_success():
+        # End the transaction the request's earlier reads (its session, its
+        # user) began.  Under REPEATABLE READ its plain reads would otherwise
+        # still see the rows as they were at the first of them.
+        transaction.commit()
+        # Lock the copy, so only one reader at a time may change it.  Locks
+        # are always taken copy first, then user, to avoid deadlocks.
+        bookcopy = BookCopy.objects.select_for_update().get(id=bookcopy_id)
+        if bookcopy.current_checkout_id is not None:
+            # Read the current checkout with a lock too, so it is read as
+            # last committed, like the copy.
+            bookcopy.current_checkout = BookCopyCheckout.objects.select_for_update() \
+                .get(id=bookcopy.current_checkout_id)
+        if action == 'borrow' or action == 'reserve':
+            checkout = bookcopy.live_checkout(now)
+            if not (checkout and checkout.user_id == user.id):
+                # A new checkout is needed, so make sure the user does not
+                # check out more than 10 books at a time.  The user row is
+                # locked first, so concurrent requests are counted in turn,
+                # and the checkouts are counted with locking reads, so the
+                # ones committed by the request before are seen.
+                User.objects.select_for_update().get(pk=user.pk)
+                if BookCopyCheckout.objects.active_count(user, now, lock=True) \
+                        >= MAX_ACTIVE_CHECKOUTS:
+                    raise ValueError("User may not borrow or reserve more than %d books!"
+                                     % MAX_ACTIVE_CHECKOUTS)
+            if action == 'borrow':
+                bookcopy.do_borrow(user, now)
+            else:
+                bookcopy.do_reserve(user, now)
+        elif action == 'return':
+            # The book does not need to be 'available' to return it.
+            bookcopy.do_return(user, now)
+        elif action == 'hold':
+            # Wait for any copy of the book.  The user row is locked, so
+            # concurrent holds of a user are checked in turn.
+            User.objects.select_for_update().get(pk=user.pk)
+            holds.place_hold(user, bookcopy.book_id, now)
+        else:
+            raise ValueError("Unknown action '%s'!" % action)
+    return bookcopy
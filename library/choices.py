@@ -0,0 +1,65 @@
+"""
+Choices for the admin forms, cached until the models they list change.
+
+Every cached value is stored under a key holding the version of its model,
+see library.versions.  Books are too many to list, so forms look them up
+through book_typeahead() instead.
+"""
+
+import hashlib
+
+from django.core.cache import cache
+
+from .models import Book, LibraryBranch
+from . import versions
+from .search import search_books
+
+# Seconds a cached choice list is kept.
+CHOICES_TIMEOUT = 24 * 60 * 60
+
+# The most books suggested for a typeahead query.
+TYPEAHEAD_LIMIT = 10
+
+
+def cached(version_name, name, build):
+    """
+    Read a value from the cache, or build and store it.
+    @param version_name:string, the version whose changes invalidate the value
+    @param name:string, unique to the value
+    @param build:function returning the value
+    """
+    key = 'library.choices.%s.%s.%d' % (version_name, name,
+                                        versions.get_version(version_name))
+    value = cache.get(key)
+    if value is None:
+        value = build()
+        cache.set(key, value, CHOICES_TIMEOUT)
+    return value
+
+
+def librarybranch_choices():
+    """
+    @return Array<(int, string)>, the id and name of every library branch
+    """
+    return cached('librarybranch', 'all', lambda:
+                  list(LibraryBranch.objects.order_by('id').values_list('id', 'name')))
+
+
+def book_typeahead(query):
+    """
+    Suggest books for a partly typed title, ISBN, author or publisher.
+    @return Array<dict>, with the id, title and isbn of each book
+    """
+    query = query.strip()
+    if not query:
+        return []
+
+    def build():
+        book_ids = search_books(query, limit=TYPEAHEAD_LIMIT)
+        books = dict((book['id'], book) for book in Book.objects
+                     .filter(id__in=book_ids).values('id', 'title', 'isbn'))
+        return [books[book_id] for book_id in book_ids if book_id in books]
+    # Queries may hold any characters, so they are hashed into the key.
+    return cached('book', 'typeahead.' + hashlib.md5(query.lower().encode('utf-8')).hexdigest(),
+                  build)
+
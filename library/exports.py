@@ -0,0 +1,166 @@
+"""
+Exporting the catalog and the checkout history as CSV or JSON lines.
+
+Tables are read in chunks of rows walking the primary key, each chunk with
+a query like
+
+    SELECT ... WHERE id > <last id of the previous chunk> ORDER BY id LIMIT 5000
+
+so only one chunk is in memory at a time however large the table is, and
+the lines of each chunk are handed on as soon as they are written, e.g. to
+a StreamingHttpResponse.  The output may be compressed with gzip as it is
+made.
+
+The book copy export has the columns of the book copy import, so a file
+exported from one library can be imported into another.
+"""
+
+from collections import OrderedDict
+import csv
+import json
+import zlib
+from datetime import date, datetime
+from StringIO import StringIO
+
+from .models import Book, BookCopy, BookCopyCheckout
+
+# The number of rows read by each query.
+EXPORT_CHUNK_SIZE = 5000
+
+# The columns of each export, and the lookups they are read from.  The
+# first column is the primary key the chunks are walked by.
+EXPORTS = {
+    'books' : (Book, (
+            ('id', 'id'),
+            ('isbn', 'isbn'),
+            ('title', 'title'),
+            ('publisher', 'publisher__name'),
+            ('publication_date', 'publication_date'))),
+    'bookcopies' : (BookCopy, (
+            ('id', 'id'),
+            ('isbn', 'book__isbn'),
+            ('library_branch', 'library_branch__name'),
+            ('copy_number', 'copy_number'),
+            ('position', 'position'))),
+    'checkouts' : (BookCopyCheckout, (
+            ('id', 'id'),
+            ('bookcopy', 'bookcopy'),
+            ('username', 'user__username'),
+            ('library_branch', 'library_branch__name'),
+            ('reserve_date', 'reserve_date'),
+            ('borrow_date', 'borrow_date'),
+            ('return_date', 'return_date'))),
+    }
+
+FORMATS = ('csv', 'jsonl')
+
+CONTENT_TYPES = {
+    'csv' : 'text/csv',
+    'jsonl' : 'application/x-ndjson',
+    'gzip' : 'application/gzip',
+    }
+
+
+def export_rows(name, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Read the rows of an export one chunk at a time.
+    @param name:string, a key of EXPORTS
+    @return generator of Array<tuple>, the values of the rows of each chunk
+    """
+    model, columns = EXPORTS[name]
+    lookups = [lookup for column, lookup in columns]
+    last_id = 0
+    while True:
+        rows = list(model.objects.filter(id__gt=last_id).order_by('id')
+                    .values_list(*lookups)[:chunk_size])
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        yield rows
+
+
+def plain_value(value):
+    """
+    @return a value as JSON can write it, dates in ISO 8601
+    """
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    return value
+
+
+def csv_lines(rows):
+    """
+    @param rows:Array<Array>, values made plain by plain_value()
+    @return str, the rows as UTF-8 encoded CSV lines
+    """
+    buffer = StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([value.encode('utf-8') if isinstance(value, unicode) else value
+                         for value in row])
+    return buffer.getvalue()
+
+
+def export_lines(name, format, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Write the rows of an export.
+    @param format:string, 'csv' or 'jsonl'
+    @return generator of str, the header of a CSV file, then the lines of
+            each chunk of rows
+    """
+    columns = [column for column, lookup in EXPORTS[name][1]]
+    if format == 'csv':
+        yield csv_lines([columns])
+    for rows in export_rows(name, chunk_size):
+        rows = [[plain_value(value) for value in row] for row in rows]
+        if format == 'csv':
+            yield csv_lines(rows)
+        else:
+            yield ''.join(json.dumps(OrderedDict(zip(columns, row))) + '\n'
+                          for row in rows)
+
+
+def gzip_chunks(chunks):
+    """
+    Compress a stream of strings into the stream of a gzip file.
+    @return generator of str
+    """
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def export(name, format='csv', compress=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    @param name:string, a key of EXPORTS
+    @param format:string, 'csv' or 'jsonl'
+    @param compress:bool, whether to gzip the output
+    @return generator of str, the content of the export file
+    """
+    if name not in EXPORTS:
+        raise ValueError('Unknown export "%s".' % name)
+    if format not in FORMATS:
+        raise ValueError('Unknown format "%s".' % format)
+    chunks = export_lines(name, format, chunk_size)
+    if compress:
+        chunks = gzip_chunks(chunks)
+    return chunks
+
+
+def export_filename(name, format, compress=False):
+    """
+    @return string, e.g. 'checkouts.csv.gz'
+    """
+    filename = '%s.%s' % (name, format)
+    if compress:
+        filename += '.gz'
+    return filename
+
+
+def export_content_type(format, compress=False):
+    if compress:
+        return CONTENT_TYPES['gzip']
+    return CONTENT_TYPES[format]
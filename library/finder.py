@@ -0,0 +1,125 @@
+"""
+Finding the branches that have a copy of a book available right now.
+
+Each process keeps an index of which branches have an available copy of
+each book: a bitset per book, with one bit per library branch in the order
+of their names.  A book is read from BookAvailability (see
+library.availability) the first time it is looked up, with one query on
+the (book, library_branch) index, and read again after its counts change:
+the counts bump the version 'availability.<book id>', and a lookup compares
+the versions of its book with the ones the index holds in a single cache
+lookup.  Adding, renaming or removing branches ('librarybranch') or
+recounting everything ('availability') empties the index, and it holds
+at most INDEX_SIZE books, so its memory does not grow with the catalog.
+
+Versions are bumped before the transaction changing the counts commits,
+and checkouts and the reservation sweeper bump them again after it, so a
+book read in between is read again.  Other writers bump only once, so
+books are also read again after INDEX_TIMEOUT seconds whatever their
+versions.  A suggestion that turns out to be wrong costs little: the
+borrow itself checks the copy again.
+"""
+
+from collections import OrderedDict
+from threading import Lock
+from time import time
+
+from .models import BookAvailability, LibraryBranch
+from . import versions
+
+# Seconds a book is held in the index before it is read again.
+INDEX_TIMEOUT = 60
+
+# The most books held in the index of a process.  The books looked up least
+# recently are dropped first.
+INDEX_SIZE = 10000
+
+
+class AvailabilityIndex(object):
+    """
+    Which branches have an available copy of each book.
+    """
+    def __init__(self):
+        self.lock = Lock()
+        self.branch_versions = None
+        # The branches in the order of their names, and the bit of each.
+        self.branches = ([], {})
+        # book id -> (version, time read, branches, bitset), the books
+        # looked up most recently last
+        self.books = OrderedDict()
+
+    def load_branches(self, branch_versions):
+        library_branches = list(LibraryBranch.objects.order_by('name', 'id')
+                                .values_list('id', 'name'))
+        branch_bits = dict((library_branch_id, 1 << position)
+                           for position, (library_branch_id, name)
+                           in enumerate(library_branches))
+        with self.lock:
+            self.branches = (library_branches, branch_bits)
+            self.books = OrderedDict()
+            self.branch_versions = branch_versions
+
+    def load_book(self, book_id, version):
+        branches = self.branches
+        bitset = 0
+        for library_branch_id in BookAvailability.objects \
+                .filter(book=book_id, available_count__gt=0) \
+                .values_list('library_branch', flat=True):
+            bitset |= branches[1].get(library_branch_id, 0)
+        entry = (version, time(), branches, bitset)
+        with self.lock:
+            self.books.pop(book_id, None)
+            self.books[book_id] = entry
+            while len(self.books) > INDEX_SIZE:
+                self.books.popitem(last=False)
+        return entry
+
+    def lookup(self, book_id):
+        """
+        @return (Array<(int, string)>, int), the branches in the order of
+                their names and the bitset of the ones with an available
+                copy of a book
+        """
+        branch_version, rebuild_version, version = versions.get_versions(
+            ['librarybranch', 'availability', 'availability.%d' % book_id])
+        if self.branch_versions != (branch_version, rebuild_version):
+            self.load_branches((branch_version, rebuild_version))
+        with self.lock:
+            entry = self.books.pop(book_id, None)
+            if entry is not None:
+                self.books[book_id] = entry
+        if entry is None or entry[0] != version or time() - entry[1] > INDEX_TIMEOUT:
+            entry = self.load_book(book_id, version)
+        return entry[2][0], entry[3]
+
+    def available_branches(self, book_id, home_branch_id=None):
+        """
+        @param home_branch_id:int | None, the branch the reader prefers
+        @return Array<(int, string)>, the id and name of each branch with an
+                available copy of the book, the home branch first and the
+                others by name
+        """
+        library_branches, bitset = self.lookup(book_id)
+        result = []
+        position = 0
+        while bitset:
+            if bitset & 1:
+                library_branch = library_branches[position]
+                if library_branch[0] == home_branch_id:
+                    result.insert(0, library_branch)
+                else:
+                    result.append(library_branch)
+            bitset >>= 1
+            position += 1
+        return result
+
+
+# The index of this process.
+availability_index = AvailabilityIndex()
+
+
+def available_branches(book_id, home_branch_id=None):
+    """
+    @return Array<(int, string)>, see AvailabilityIndex.available_branches()
+    """
+    return availability_index.available_branches(book_id, home_branch_id)
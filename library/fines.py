@@ -0,0 +1,102 @@
+"""
+Computing fines for books returned late.
+
+A book may be kept for FINE_FREE_DAYS days, after which every whole day
+costs FINE_CENTS_PER_DAY cents.  The fines of many checkouts are computed
+in batches from their borrow and return dates, so the results are the same
+whatever database the dates were read from.  NumPy is used for the batches
+when it is installed, otherwise the same arithmetic is done in Python.
+"""
+
+from datetime import datetime, timedelta
+import pytz
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Books may be kept this many days before a fine is due.
+FINE_FREE_DAYS = 20
+
+# The fine for every day a book is late.
+FINE_CENTS_PER_DAY = 20
+
+# The number of microseconds in a day, the unit of timedelta.days.
+DAY_MICROSECONDS = 24 * 60 * 60 * 1000000
+
+EPOCH = datetime(1970, 1, 1, tzinfo=pytz.utc)
+
+
+def late_days(borrow_date, end_date):
+    """
+    Count the whole days a book was kept past its return-by date.
+    @return int, zero if the book was not late
+    """
+    return max((end_date - borrow_date).days - FINE_FREE_DAYS, 0)
+
+
+def fine_for_days(days):
+    """
+    @param days:int, days late
+    @return float, the fine in dollars
+    """
+    return (FINE_CENTS_PER_DAY * days) / 100.0
+
+
+def get_fine(borrow_date, now):
+    """
+    Compute the fine owed for a book borrowed at 'borrow_date' if it were
+    returned 'now'.
+    @return Float | None, None if the book is not overdue
+    """
+    if borrow_date:
+        return_by_date = borrow_date + timedelta(days=FINE_FREE_DAYS)
+        if now > return_by_date:
+            return fine_for_days((now - return_by_date).days)
+    return None
+
+
+def to_microseconds(dates):
+    """
+    Convert aware datetimes to integer microseconds since the epoch.
+    @param dates:Array<datetime>
+    @return Array<int>
+    """
+    microseconds = []
+    for date in dates:
+        delta = date - EPOCH
+        microseconds.append((delta.days * 86400 + delta.seconds) * 1000000
+                            + delta.microseconds)
+    return microseconds
+
+
+def late_days_batch(borrow_dates, end_dates, use_numpy=True):
+    """
+    Compute late_days() for many checkouts at once.
+    @param borrow_dates:Array<datetime>
+    @param end_dates:Array<datetime>, the return dates, or now for books
+                     still out
+    @param use_numpy:bool, False to force the pure Python computation
+    @return Array<int>
+    """
+    borrow_us = to_microseconds(borrow_dates)
+    end_us = to_microseconds(end_dates)
+    if numpy is not None and use_numpy:
+        # Floor division matches the rounding of timedelta.days.
+        days = (numpy.array(end_us, dtype=numpy.int64)
+                - numpy.array(borrow_us, dtype=numpy.int64)) // DAY_MICROSECONDS
+        return numpy.maximum(days - FINE_FREE_DAYS, 0)
+    return [max((end - borrow) // DAY_MICROSECONDS - FINE_FREE_DAYS, 0)
+            for borrow, end in zip(borrow_us, end_us)]
+
+
+def late_totals(borrow_dates, end_dates, use_numpy=True):
+    """
+    Count the late checkouts of a batch and add up their late days.
+    @return (int, int), the number of late checkouts and their late days
+    """
+    days = late_days_batch(borrow_dates, end_dates, use_numpy)
+    if numpy is not None and use_numpy:
+        return int(numpy.count_nonzero(days)), int(days.sum())
+    return len([d for d in days if d > 0]), sum(days)
@@ -0,0 +1,132 @@
+"""
+Queues of readers waiting for a book, whatever its copy.
+
+A reader may hold a book when no copy of it is available (see
+library.availability).  The holds of a book wait in the order they were
+made, the order of their ids, so the next reader is found with a single
+seek on the (book, status, id) index.  When a copy is returned, or its
+reservation expires, it is reserved for the next reader in the same
+transaction, instead of being made available to whoever asks first.  The
+reservation is like any other: the reader has until 6PM to borrow it, and
+it counts toward MAX_ACTIVE_CHECKOUTS, so a reader at the limit is passed
+over and keeps their place for a later copy.
+Holds whose reservations were not claimed are expired in batches by the
+'expire_reservations' command, which also passes their copies on.
+"""
+
+from django.contrib.auth.models import User
+
+from .models import (BookAvailability, BookCopy, BookCopyCheckout, BookHold,
+                     MAX_ACTIVE_CHECKOUTS, reserve_cutoff_date)
+
+# A reader may not wait for more books than this at a time.
+MAX_HOLDS = 5
+
+# The holds that still have a place in the queue of their book.
+ACTIVE_STATUSES = ('waiting', 'ready')
+
+
+def place_hold(user, book_id, now):
+    """
+    Put a reader at the end of the queue of a book.  The caller locks the
+    user row, so the checks hold until the hold is made.
+    @return BookHold
+    """
+    if BookAvailability.objects.filter(book=book_id, available_count__gt=0).exists():
+        raise ValueError("A copy is available, borrow or reserve it instead!")
+    if BookHold.objects.filter(user=user, status__in=ACTIVE_STATUSES, book=book_id).exists():
+        raise ValueError("User already holds this book!")
+    if BookHold.objects.filter(user=user, status__in=ACTIVE_STATUSES).count() >= MAX_HOLDS:
+        raise ValueError("User may not hold more than %d books!" % MAX_HOLDS)
+    return BookHold.objects.create(book_id=book_id, user=user, hold_date=now)
+
+
+def claim_holds(user, book_id):
+    """
+    Take a reader out of the queue of a book they borrowed or reserved.
+    """
+    BookHold.objects.filter(user=user, status__in=ACTIVE_STATUSES, book=book_id) \
+        .update(status='claimed')
+
+
+def allocate_copy(bookcopy_id, book_id, library_branch_id, now):
+    """
+    Reserve a copy given back for the first reader waiting for its book
+    who is not at the checkout limit.  The caller saves the reservation as
+    the current checkout of the copy.
+    @return BookCopyCheckout | None, the reservation, None if no reader
+            waiting may take the copy
+    """
+    last_id = 0
+    while True:
+        holds = list(BookHold.objects.filter(book=book_id, status='waiting', id__gt=last_id)
+                     .order_by('id').values_list('id', 'user')[:1])
+        if not holds:
+            return None
+        hold_id, user_id = holds[0]
+        last_id = hold_id
+        # The user row is locked after the copy, as when checking out, so
+        # the reader's checkouts are counted in turn, with locking reads so
+        # that checkouts committed since the transaction began are counted.
+        list(User.objects.select_for_update().filter(pk=user_id).values_list('id', flat=True))
+        if BookCopyCheckout.objects.active_count(user_id, now, lock=True) \
+                >= MAX_ACTIVE_CHECKOUTS:
+            continue
+        # A copy returned at the same time may have taken the hold already.
+        if BookHold.objects.filter(id=hold_id, status='waiting') \
+                .update(status='ready', bookcopy=bookcopy_id, ready_date=now):
+            break
+    checkout = BookCopyCheckout.objects.create(user_id=user_id, bookcopy_id=bookcopy_id,
+                                               library_branch_id=library_branch_id,
+                                               reserve_date=now)
+    BookHold.objects.filter(id=hold_id).update(checkout=checkout)
+    return checkout
+
+
+def allocate_copies(bookcopies, now):
+    """
+    Reserve copies whose reservations were cleared for the readers waiting
+    for their books.
+    @param bookcopies:Array<(int, int, int)>, the id, book id and library
+           branch id of each copy
+    @return Array<(int, int, int)>, the copies nobody was waiting for
+    """
+    waiting = set(BookHold.objects
+                  .filter(book__in=set(book_id for bookcopy_id, book_id, library_branch_id
+                                       in bookcopies), status='waiting')
+                  .values_list('book', flat=True).distinct())
+    left = []
+    for bookcopy_id, book_id, library_branch_id in bookcopies:
+        checkout = None
+        if book_id in waiting:
+            checkout = allocate_copy(bookcopy_id, book_id, library_branch_id, now)
+        if checkout:
+            BookCopy.objects.filter(id=bookcopy_id).update(current_checkout=checkout)
+        else:
+            waiting.discard(book_id)
+            left.append((bookcopy_id, book_id, library_branch_id))
+    return left
+
+
+def unclaimed_holds(now):
+    """
+    Select the ready holds whose reservations expired before being borrowed.
+    @return QuerySet<BookHold>
+    """
+    return BookHold.objects.filter(status='ready', ready_date__lt=reserve_cutoff_date(now))
+
+
+def expire_holds(now, **filters):
+    """
+    @param filters: optional lookups narrowing the holds, e.g. id__in
+    @return int, the number of holds expired
+    """
+    return unclaimed_holds(now).filter(**filters).update(status='expired')
+
+
+def queue_position(hold):
+    """
+    @return int, the place of a waiting hold in the queue of its book, from 1
+    """
+    return BookHold.objects.filter(book=hold.book_id, status='waiting',
+                                   id__lte=hold.id).count()
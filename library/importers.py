@@ -0,0 +1,481 @@
+"""
+Importing many book copies or readers at once, e.g. a shipment for a
+branch or the students of a school district.
+
+The input is read one row at a time from CSV, with a header line, or from
+JSON lines, one object per line.  Each book copy row names a book by its
+ISBN and a branch by its name:
+
+    isbn,library_branch,copy_number,position
+    9780000000001,Texas Main Library,1,A00001
+
+Rows are handled in chunks.  The books and branches of a chunk are found
+with one query each, the positions are checked against the rest of the
+import in memory and against the database with one query, and the valid
+rows are inserted with a single bulk_create.  Invalid rows are skipped and
+reported with their line numbers.
+
+Readers are imported the same way.  Hashing their passwords is by far the
+slowest part, so the hashes of a chunk are computed by a pool of processes.
+Files of readers uploaded from the admin pages are saved to IMPORT_DIR and
+imported by 'import_readers --pending', run by cron, so the web server
+neither hashes passwords nor starts processes.
+"""
+
+import codecs
+import csv
+import json
+import multiprocessing
+import os
+import re
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import transaction
+
+from .models import Book, BookCopy, LibraryBranch, Reader
+from . import availability, versions
+from .search import normalize_isbn
+
+# The number of rows looked up and inserted together.
+IMPORT_CHUNK_SIZE = 1000
+
+# The most errors kept for the report, so a bad file does not fill memory.
+MAX_ERRORS = 100
+
+# Where uploaded reader files and the progress of their imports are kept.
+# The web server and the cron job importing the files must share it.
+IMPORT_DIR = getattr(settings, 'LIBRARY_IMPORT_DIR', tempfile.gettempdir())
+
+# The columns of the book copy and reader imports.
+COLUMNS = ('isbn', 'library_branch', 'copy_number', 'position')
+READER_COLUMNS = ('username', 'email', 'first_name', 'last_name', 'address',
+                  'phone_number', 'password')
+
+FORMATS = ('csv', 'jsonl')
+
+
+class ImportFileError(ValueError):
+    """
+    The input cannot be read at all, e.g. a CSV file without its header.
+    """
+    pass
+
+
+class ImportResult(object):
+    """
+    What an import did: the rows read and created, and the errors found.
+    """
+    def __init__(self):
+        self.row_count = 0
+        self.created_count = 0
+        self.error_count = 0
+        self.errors = []
+        self.elapsed = 0.0
+
+    def add_error(self, line, message):
+        self.error_count += 1
+        if len(self.errors) < MAX_ERRORS:
+            self.errors.append((line, message))
+
+    @property
+    def rows_per_second(self):
+        return self.row_count / max(self.elapsed, 0.001)
+
+    def as_dict(self):
+        return {
+            'row_count' : self.row_count,
+            'created_count' : self.created_count,
+            'error_count' : self.error_count,
+            'errors' : self.errors,
+            'elapsed' : self.elapsed,
+            'rows_per_second' : self.rows_per_second,
+            }
+
+
+def guess_format(filename):
+    """
+    @return string, 'jsonl' for .json and .jsonl files, otherwise 'csv'
+    """
+    if filename.lower().endswith(('.json', '.jsonl')):
+        return 'jsonl'
+    return 'csv'
+
+
+def read_rows(lines, format, columns=COLUMNS):
+    """
+    Read the rows of an import file.
+    @param lines:an iterable of lines, e.g. an open file
+    @param format:string, 'csv' or 'jsonl'
+    @param columns:the columns a CSV file must have
+    @return generator of (int, dict | None), the line number and the row,
+            None when the line is not a valid row, e.g. not UTF-8
+    """
+    if format == 'csv':
+        reader = csv.reader(lines)
+        try:
+            header = next(reader)
+        except StopIteration:
+            return
+        # Spreadsheets often start the UTF-8 they save with a byte order mark.
+        if header and header[0].startswith(codecs.BOM_UTF8):
+            header[0] = header[0][len(codecs.BOM_UTF8):]
+        header = [column.strip().lower() for column in header]
+        missing = [column for column in columns if column not in header]
+        if missing:
+            raise ImportFileError('The CSV header lacks the columns: %s.' % ', '.join(missing))
+        for values in reader:
+            if not values:
+                continue
+            if len(values) != len(header):
+                yield reader.line_num, None
+                continue
+            try:
+                yield reader.line_num, dict(
+                    (column, value.decode('utf-8')) for column, value in zip(header, values))
+            except UnicodeDecodeError:
+                yield reader.line_num, None
+    elif format == 'jsonl':
+        for index, line in enumerate(lines):
+            if index == 0 and line.startswith(codecs.BOM_UTF8):
+                line = line[len(codecs.BOM_UTF8):]
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                row = json.loads(line)
+            except ValueError:
+                row = None
+            yield index + 1, row if isinstance(row, dict) else None
+    else:
+        raise ImportFileError('Unknown format "%s".' % format)
+
+
+def run_import(rows, handle_chunk, chunk_size, progress):
+    """
+    Read the rows of an import and hand them over in chunks.
+    @param rows:iterable of (int, dict | None), as made by read_rows()
+    @param handle_chunk:function(chunk, ImportResult)
+    @param chunk_size:int
+    @param progress:function(ImportResult) | None, called after each chunk
+    @return ImportResult
+    """
+    result = ImportResult()
+    start_time = time.time()
+    chunk = []
+    for line, row in rows:
+        result.row_count += 1
+        chunk.append((line, row))
+        if len(chunk) >= chunk_size:
+            handle_chunk(chunk, result)
+            chunk = []
+            result.elapsed = time.time() - start_time
+            if progress:
+                progress(result)
+    if chunk:
+        handle_chunk(chunk, result)
+    result.elapsed = time.time() - start_time
+    if progress:
+        progress(result)
+    return result
+
+
+def import_bookcopies(rows, chunk_size=IMPORT_CHUNK_SIZE, dry_run=False, progress=None):
+    """
+    Create the book copies of an import.
+    @param rows:iterable of (int, dict | None), as made by read_rows()
+    @param chunk_size:int, the rows looked up and inserted together
+    @param dry_run:bool, True to check the rows without creating copies
+    @param progress:function(ImportResult) | None, called after each chunk
+    @return ImportResult
+    """
+    # Lookups are kept for the whole import, shipments repeat their books.
+    book_ids = {}
+    librarybranch_ids = {}
+    positions = set()
+    return run_import(rows, lambda chunk, result: import_chunk(
+            chunk, result, book_ids, librarybranch_ids, positions, dry_run),
+                      chunk_size, progress)
+
+
+def clean_row(row):
+    """
+    Check the values of a row.
+    @return (string, string, int, string) | string, the ISBN, branch name,
+            copy number and position, or an error message
+    """
+    if row is None:
+        return 'The line is not a valid row.'
+    values = [row.get(column) for column in COLUMNS]
+    if None in values:
+        return 'The row lacks a value for %s.' % COLUMNS[values.index(None)]
+    isbn, library_branch, copy_number, position = [unicode(value).strip() for value in values]
+    try:
+        copy_number = int(copy_number)
+    except ValueError:
+        return 'The copy number "%s" is not a number.' % copy_number
+    if copy_number < 1:
+        return 'The copy number must be positive.'
+    max_length = BookCopy._meta.get_field('position').max_length
+    if not position or len(position) > max_length:
+        return 'The position must have 1 to %d characters.' % max_length
+    return normalize_isbn(isbn), library_branch, copy_number, position
+
+
+def import_chunk(chunk, result, book_ids, librarybranch_ids, positions, dry_run):
+    """
+    Check and insert one chunk of rows, adding to the lookups and result.
+    """
+    cleaned = []
+    for line, row in chunk:
+        values = clean_row(row)
+        if isinstance(values, basestring):
+            result.add_error(line, values)
+        else:
+            cleaned.append((line, values))
+
+    # Look up everything the chunk refers to that is not known yet.  Values
+    # that are not found are remembered as None, so they are not looked up again.
+    isbns = set(values[0] for line, values in cleaned) - set(book_ids)
+    if isbns:
+        book_ids.update(dict.fromkeys(isbns))
+        book_ids.update(Book.objects.filter(isbn__in=isbns).values_list('isbn', 'id'))
+    names = set(values[1] for line, values in cleaned) - set(librarybranch_ids)
+    if names:
+        librarybranch_ids.update(dict.fromkeys(names))
+        librarybranch_ids.update(LibraryBranch.objects.filter(name__in=names)
+                                 .values_list('name', 'id'))
+    taken = set()
+    if cleaned:
+        taken.update(BookCopy.objects
+                     .filter(position__in=[values[3] for line, values in cleaned])
+                     .values_list('position', flat=True))
+
+    bookcopies = []
+    for line, (isbn, library_branch, copy_number, position) in cleaned:
+        if book_ids[isbn] is None:
+            result.add_error(line, 'No book has the ISBN "%s".' % isbn)
+        elif librarybranch_ids[library_branch] is None:
+            result.add_error(line, 'No library branch is named "%s".' % library_branch)
+        elif position in positions or position in taken:
+            result.add_error(line, 'The position "%s" is already used.' % position)
+        else:
+            positions.add(position)
+            bookcopies.append(BookCopy(
+                    book_id=book_ids[isbn], library_branch_id=librarybranch_ids[library_branch],
+                    copy_number=copy_number, position=position))
+    if bookcopies and not dry_run:
+        with transaction.commit_on_success():
+            BookCopy.objects.bulk_create(bookcopies)
+            availability.add_copies(bookcopies)
+        # bulk_create sends no signals, so the cached lists are dropped here.
+        versions.bump('bookcopy')
+    result.created_count += len(bookcopies)
+
+
+def clean_reader_row(row):
+    """
+    Check the values of a reader row.
+    @return dict | string, the values or an error message
+    """
+    if row is None:
+        return 'The line is not a valid row.'
+    values = {}
+    for column in READER_COLUMNS:
+        values[column] = unicode(row.get(column) or '').strip()
+    if not values['username']:
+        return 'The row lacks a username.'
+    for column in ('username', 'email', 'first_name', 'last_name'):
+        max_length = User._meta.get_field(column).max_length
+        if len(values[column]) > max_length:
+            return 'The %s must have at most %d characters.' % (column, max_length)
+    if len(values['phone_number']) > Reader._meta.get_field('phone_number').max_length:
+        return 'The phone number is too long.'
+    if values['email']:
+        try:
+            validate_email(values['email'])
+        except ValidationError:
+            return 'The email "%s" is not valid.' % values['email']
+    return values
+
+
+def hash_passwords(passwords, pool):
+    """
+    Hash many passwords, in parallel if there is a pool.  Blank passwords
+    are made unusable, the reader then has to have one set.
+    @param passwords:Array<string>
+    @param pool:multiprocessing.Pool | None
+    @return Array<string>
+    """
+    passwords = [password or None for password in passwords]
+    if pool is None:
+        return [make_password(password) for password in passwords]
+    return pool.map(make_password, passwords)
+
+
+def import_readers(rows, chunk_size=IMPORT_CHUNK_SIZE, processes=None, progress=None):
+    """
+    Create the users and readers of an import.
+    @param rows:iterable of (int, dict | None), as made by read_rows()
+    @param chunk_size:int, the rows hashed and inserted together
+    @param processes:int | None, the processes hashing passwords, by default
+                     one per CPU, 1 to hash them in this process
+    @param progress:function(ImportResult) | None, called after each chunk
+    @return ImportResult
+    """
+    if processes is None:
+        processes = multiprocessing.cpu_count()
+    pool = None
+    if processes > 1:
+        pool = multiprocessing.Pool(processes)
+    usernames = set()
+    try:
+        return run_import(rows, lambda chunk, result: import_reader_chunk(
+                chunk, result, usernames, pool), chunk_size, progress)
+    finally:
+        if pool is not None:
+            pool.terminate()
+            pool.join()
+
+
+def import_reader_chunk(chunk, result, usernames, pool):
+    """
+    Check, hash and insert one chunk of readers, adding to the result.
+    """
+    cleaned = []
+    for line, row in chunk:
+        values = clean_reader_row(row)
+        if isinstance(values, basestring):
+            result.add_error(line, values)
+        else:
+            cleaned.append((line, values))
+    taken = set()
+    if cleaned:
+        taken.update(User.objects
+                     .filter(username__in=[values['username'] for line, values in cleaned])
+                     .values_list('username', flat=True))
+    valid = []
+    for line, values in cleaned:
+        if values['username'] in usernames or values['username'] in taken:
+            result.add_error(line, 'The username "%s" is already used.' % values['username'])
+        else:
+            usernames.add(values['username'])
+            valid.append(values)
+    if not valid:
+        return
+
+    passwords = hash_passwords([values['password'] for values in valid], pool)
+    with transaction.commit_on_success():
+        User.objects.bulk_create([
+                User(username=values['username'], email=values['email'],
+                     first_name=values['first_name'], last_name=values['last_name'],
+                     password=password)
+                for values, password in zip(valid, passwords)])
+        # bulk_create does not return the new ids, so they are read back.
+        user_ids = dict(User.objects
+                        .filter(username__in=[values['username'] for values in valid])
+                        .values_list('username', 'id'))
+        Reader.objects.bulk_create([
+                Reader(user_id=user_ids[values['username']], address=values['address'],
+                       phone_number=values['phone_number'])
+                for values in valid])
+    versions.bump('reader')
+    result.created_count += len(valid)
+
+
+def write_progress(path, result, done=False):
+    """
+    Save the progress of an import for another process to read.
+    @param path:string, the file written
+    @param result:ImportResult
+    @param done:bool, True when the import has finished
+    """
+    progress = result.as_dict()
+    progress['done'] = done
+    save_progress(path, progress)
+
+
+def save_progress(path, progress):
+    # Write a new file and rename it, so readers never see half a file.
+    with open(path + '.tmp', 'w') as f:
+        json.dump(progress, f)
+    os.rename(path + '.tmp', path)
+
+
+def read_progress(path):
+    """
+    @return dict | None, as saved by write_progress(), None before the
+            import has saved anything
+    """
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (IOError, ValueError):
+        return None
+
+
+def progress_path(job):
+    return os.path.join(IMPORT_DIR, 'library-readers-%s.progress' % job)
+
+
+def upload_path(job, format):
+    return os.path.join(IMPORT_DIR, 'library-readers-%s.%s' % (job, format))
+
+
+def start_reader_import(upload, format):
+    """
+    Save an uploaded file of readers for 'import_readers --pending' to
+    import, see pending_reader_imports().
+    @param upload:UploadedFile
+    @param format:string, 'csv' or 'jsonl'
+    @return string, the job id, for read_progress(progress_path(job))
+    """
+    job = uuid.uuid4().hex
+    path = upload_path(job, format)
+    # The file is written under another name and renamed, so it is never
+    # picked up half written.
+    with open(path + '.upload', 'wb') as f:
+        for data in upload.chunks():
+            f.write(data)
+    save_progress(progress_path(job), dict(ImportResult().as_dict(), done=False, queued=True))
+    os.rename(path + '.upload', path)
+    return job
+
+
+def pending_reader_imports():
+    """
+    Find the uploaded files of readers waiting to be imported.
+    @return Array<(string, string, string)>, the job id, file name and
+            format of each file, the oldest first
+    """
+    pending = []
+    for name in os.listdir(IMPORT_DIR):
+        match = re.match(r'^library-readers-([0-9a-f]{32})\.(%s)$' % '|'.join(FORMATS), name)
+        if match:
+            path = os.path.join(IMPORT_DIR, name)
+            try:
+                pending.append((os.path.getmtime(path), match.group(1), path, match.group(2)))
+            except OSError:
+                # Another run took the file meanwhile.
+                pass
+    return [(job, path, format) for mtime, job, path, format in sorted(pending)]
+
+
+def claim_reader_import(path):
+    """
+    Take an uploaded file for this run, so concurrent runs do not import it
+    twice.
+    @return string | None, the new name of the file, None if another run
+            took it first
+    """
+    try:
+        os.rename(path, path + '.running')
+    except OSError:
+        return None
+    return path + '.running'
@@ -0,0 +1,251 @@
+"""
+Measuring the SQL queries made while handling requests.
+
+record_queries() wraps the cursors of a database connection so every
+query is counted and timed, and every row fetched is counted.  Nothing is
+wrapped outside of it, so code that is not measured pays nothing.
+record_rendering() likewise times the templates rendered by a thread, and
+RequestStats adds up the measurements of many requests by view.
+"""
+
+from contextlib import contextmanager
+from time import time
+import math
+import threading
+
+from django.conf import settings
+from django.db import connections
+from django.db.backends.util import CursorWrapper
+from django.template.base import Template
+
+
+class QueryStats(object):
+    """
+    Totals of the queries made on a connection.
+    """
+    __slots__ = ('count', 'time', 'rows')
+
+    def __init__(self):
+        self.count = 0
+        self.time = 0.0
+        self.rows = 0
+
+
+class StatsCursorWrapper(CursorWrapper):
+    """
+    A cursor that adds its queries and fetched rows to a QueryStats.
+    """
+    def __init__(self, cursor, db, stats):
+        super(StatsCursorWrapper, self).__init__(cursor, db)
+        self.stats = stats
+
+    def execute(self, sql, params=()):
+        self.set_dirty()
+        start = time()
+        try:
+            return self.cursor.execute(sql, params)
+        finally:
+            self.stats.count += 1
+            self.stats.time += time() - start
+
+    def executemany(self, sql, param_list):
+        self.set_dirty()
+        start = time()
+        try:
+            return self.cursor.executemany(sql, param_list)
+        finally:
+            self.stats.count += 1
+            self.stats.time += time() - start
+
+    def fetchone(self):
+        row = self.cursor.fetchone()
+        if row is not None:
+            self.stats.rows += 1
+        return row
+
+    def fetchmany(self, size=None):
+        if size is None:
+            rows = self.cursor.fetchmany()
+        else:
+            rows = self.cursor.fetchmany(size)
+        self.stats.rows += len(rows)
+        return rows
+
+    def fetchall(self):
+        rows = self.cursor.fetchall()
+        self.stats.rows += len(rows)
+        return rows
+
+    def __iter__(self):
+        for row in self.cursor:
+            self.stats.rows += 1
+            yield row
+
+
+@contextmanager
+def record_queries(connection):
+    """
+    Count the queries, query time and rows fetched on a connection.
+    Nested use is allowed, every QueryStats sees all the queries.
+    @param connection:a database connection, e.g. django.db.connection
+    @return QueryStats, filled in as queries are made
+    """
+    # Patch the connection itself, not django.db.connection which proxies it.
+    connection = connections[connection.alias]
+    stats = QueryStats()
+    debug = (connection.use_debug_cursor or
+             (connection.use_debug_cursor is None and settings.DEBUG))
+    had_own_maker = 'make_debug_cursor' in connection.__dict__
+    make_debug_cursor = connection.make_debug_cursor
+    use_debug_cursor = connection.use_debug_cursor
+
+    def make_stats_cursor(cursor):
+        if debug:
+            # Keep the wrapper that was in use, e.g. query logging.
+            cursor = make_debug_cursor(cursor)
+        return StatsCursorWrapper(cursor, connection, stats)
+
+    connection.make_debug_cursor = make_stats_cursor
+    connection.use_debug_cursor = True
+    try:
+        yield stats
+    finally:
+        connection.use_debug_cursor = use_debug_cursor
+        if had_own_maker:
+            connection.make_debug_cursor = make_debug_cursor
+        else:
+            del connection.make_debug_cursor
+
+
+def percentile(values, percent):
+    """
+    The nearest-rank percentile of a list of numbers.
+    """
+    values = sorted(values)
+    index = int(math.ceil(percent / 100.0 * len(values))) - 1
+    return values[max(index, 0)]
+
+
+def summarize(samples):
+    """
+    Summarize the measurements of many requests, e.g. for a benchmark.
+    @param samples:Array<(float, int, int)>, milliseconds, queries and rows
+    @return dict
+    """
+    latencies = [sample[0] for sample in samples]
+    queries = [sample[1] for sample in samples]
+    rows = [sample[2] for sample in samples]
+    return {
+        'requests' : len(samples),
+        'p50_ms' : round(percentile(latencies, 50), 3),
+        'p99_ms' : round(percentile(latencies, 99), 3),
+        'queries_mean' : round(float(sum(queries)) / len(queries), 2),
+        'queries_max' : max(queries),
+        'rows_mean' : round(float(sum(rows)) / len(rows), 2),
+        'rows_max' : max(rows),
+        }
+
+
+class RenderTimer(object):
+    """
+    The time spent rendering templates, not counting included templates twice.
+    """
+    __slots__ = ('depth', 'time')
+
+    def __init__(self):
+        self.depth = 0
+        self.time = 0.0
+
+
+_render_state = threading.local()
+_template_render = None
+
+
+def timed_render(self, context):
+    timer = getattr(_render_state, 'timer', None)
+    if timer is None:
+        return _template_render(self, context)
+    timer.depth += 1
+    start = time()
+    try:
+        return _template_render(self, context)
+    finally:
+        timer.depth -= 1
+        if timer.depth == 0:
+            timer.time += time() - start
+
+
+def install_render_timer():
+    """
+    Patch Template.render so record_rendering() can time it.  Threads that
+    are not recording only pay for one thread local lookup per template.
+    """
+    global _template_render
+    if _template_render is None:
+        _template_render = Template.render
+        Template.render = timed_render
+
+
+@contextmanager
+def record_rendering():
+    """
+    Time the templates rendered by this thread.
+    @return RenderTimer, filled in as templates are rendered
+    """
+    install_render_timer()
+    previous = getattr(_render_state, 'timer', None)
+    timer = _render_state.timer = RenderTimer()
+    try:
+        yield timer
+    finally:
+        _render_state.timer = previous
+
+
+class RequestStats(object):
+    """
+    Totals and maximums of the measurements of requests, by view.
+    The totals are kept in memory and are shared by the threads of a process.
+    """
+    METRICS = ('queries', 'rows', 'db_ms', 'view_ms', 'render_ms')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.views = {}
+
+    def add(self, view, **metrics):
+        """
+        @param view:string, the name of the view
+        @param metrics:the values of METRICS for one request
+        """
+        with self.lock:
+            totals = self.views.get(view)
+            if totals is None:
+                totals = self.views[view] = {'requests' : 0}
+                for name in self.METRICS:
+                    totals[name] = 0
+                    totals[name + '_max'] = 0
+            totals['requests'] += 1
+            for name in self.METRICS:
+                value = metrics.get(name, 0)
+                totals[name] += value
+                totals[name + '_max'] = max(totals[name + '_max'], value)
+
+    def summary(self):
+        """
+        @return dict, by view name, the request count with the mean and
+                maximum of every metric
+        """
+        with self.lock:
+            views = dict((view, dict(totals)) for view, totals in self.views.items())
+        summary = {}
+        for view, totals in views.items():
+            count = totals['requests']
+            summary[view] = {'requests' : count}
+            for name in self.METRICS:
+                summary[view][name + '_mean'] = round(float(totals[name]) / count, 3)
+                summary[view][name + '_max'] = round(totals[name + '_max'], 3)
+        return summary
+
+    def reset(self):
+        with self.lock:
+            self.views = {}
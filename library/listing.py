@@ -0,0 +1,251 @@
+"""
+Helpers for listing pages of models without loading whole tables.
+
+The counting and slicing is done by the database, so only the rows that
+are shown on a page are ever fetched.  KeysetPage goes further for long
+lists: pages start after or before a primary key instead of an OFFSET, so
+every page costs the same however deep it is.
+"""
+
+from django.core import signing
+from django.utils.functional import SimpleLazyObject
+
+from .models import BookCopy, BookCopyCheckout
+from . import versions
+
+# The number of rows shown on a single listing page.
+PAGE_LIMIT = 10
+
+# The number of page links shown on each side of the current page.
+PAGE_WINDOW = 2
+
+# Separates the cursor tokens from other signed values.
+CURSOR_SALT = 'library.listing.cursor'
+
+
+def get_page_number(request):
+    """
+    Read the requested page number from the query string.
+    @param request:HttpRequest
+    @return int
+    """
+    try:
+        return max(int(request.GET.get('page', '1')), 1)
+    except ValueError:
+        return 1
+
+
+class Page(object):
+    """
+    A single page of a QuerySet, counted and sliced in SQL.
+    """
+    def __init__(self, queryset, number, limit=PAGE_LIMIT):
+        self.queryset = queryset
+        self.limit = limit
+        self.count = queryset.count()
+        self.page_count = max((self.count + limit - 1) // limit, 1)
+        # Requests beyond the last page show the last page.
+        self.number = min(number, self.page_count)
+        offset = limit * (self.number - 1)
+        self.object_list = queryset[offset : offset + limit]
+
+    def context(self):
+        """
+        Template variables used by the pagination controls.
+        @return dict
+        """
+        return {
+            "page_count" : self.page_count,
+            "page" : self.number,
+            "pages" : range(1, self.page_count + 1),
+            "page_prev" : max(self.number - 1, 1),
+            "page_next" : min(self.number + 1, self.page_count)
+            }
+
+
+def encode_cursor(direction, key, number):
+    """
+    Make the opaque token of a keyset page.
+    @param direction:string, 'after' or 'before' the key
+    @param key:int | None, a primary key, None for the end of the list
+    @param number:int | None, the page number shown, None if not known
+    @return string
+    """
+    return signing.dumps([direction, key, number], salt=CURSOR_SALT)
+
+
+def decode_cursor(token):
+    """
+    Read a token made by encode_cursor().
+    @return (string, int, int) | None, None for the first page or a bad token
+    """
+    if not token:
+        return None
+    try:
+        direction, key, number = signing.loads(token, salt=CURSOR_SALT)
+    except (signing.BadSignature, TypeError, ValueError):
+        return None
+    if direction not in ('after', 'before'):
+        return None
+    return direction, key, number
+
+
+class KeysetPage(object):
+    """
+    A single page of a QuerySet, found from the primary key at the edge of
+    the page next to it.
+
+    Pages are named by opaque cursor tokens, read from the 'cursor' query
+    parameter, and only the PAGE_WINDOW pages on each side of the current
+    page are linked.  Page numbers are carried in the tokens and are only
+    a guide: rows added or deleted since a page was shown shift them.  The
+    last page is read backwards from the end without counting the rows, so
+    it and the pages reached from it have no number.
+    """
+    def __init__(self, queryset, token=None, limit=PAGE_LIMIT):
+        self.limit = limit
+        cursor = decode_cursor(token)
+        direction, key, number = cursor or ('after', None, 1)
+        if direction == 'after':
+            rows = queryset.order_by('pk')
+            if key is not None:
+                rows = rows.filter(pk__gt=key)
+            rows = list(rows[:limit])
+            if not rows and key is not None:
+                # Past the end, show the last page.
+                direction, key, number = 'before', None, None
+        if direction == 'before':
+            rows = queryset.order_by('-pk')
+            if key is not None:
+                rows = rows.filter(pk__lt=key)
+            rows = list(rows[:limit])
+            rows.reverse()
+            if len(rows) < limit:
+                # Near the start, show the first page in full.
+                number = 1
+                rows = list(queryset.order_by('pk')[:limit])
+        self.object_list = rows
+        self.number = number
+
+        # Find where the nearby pages start from the keys next to this page.
+        window = PAGE_WINDOW * limit
+        if rows:
+            after_keys = list(queryset.filter(pk__gt=rows[-1].pk).order_by('pk')
+                              .values_list('pk', flat=True)[:window])
+            before_keys = list(queryset.filter(pk__lt=rows[0].pk).order_by('-pk')
+                               .values_list('pk', flat=True)[:window])
+        else:
+            after_keys = before_keys = []
+        self.links = []
+        for index in range(PAGE_WINDOW, 0, -1):
+            if len(before_keys) > (index - 1) * limit:
+                edge = rows[0].pk if index == 1 else before_keys[(index - 1) * limit - 1]
+                self.links.append(self.link('before', edge, -index))
+        self.links.append({'cursor' : token or '', 'number' : number, 'active' : True})
+        for index in range(1, PAGE_WINDOW + 1):
+            if len(after_keys) > (index - 1) * limit:
+                edge = rows[-1].pk if index == 1 else after_keys[(index - 1) * limit - 1]
+                self.links.append(self.link('after', edge, index))
+
+        self.has_prev = bool(before_keys)
+        self.has_next = bool(after_keys)
+        self.prev_cursor = self.has_prev and encode_cursor('before', rows[0].pk, self.offset(-1))
+        self.next_cursor = self.has_next and encode_cursor('after', rows[-1].pk, self.offset(1))
+        self.last_cursor = encode_cursor('before', None, None)
+
+    def offset(self, pages):
+        """
+        @return int | None, the number of the page 'pages' away from this one
+        """
+        if self.number is None:
+            return None
+        return max(self.number + pages, 1)
+
+    def link(self, direction, key, pages):
+        return {'cursor' : encode_cursor(direction, key, self.offset(pages)),
+                'number' : self.offset(pages), 'active' : False}
+
+    def context(self):
+        """
+        Template variables used by library/keyset_pager.html.
+        @return dict
+        """
+        return {"pager" : self}
+
+
+def cached_keyset_context(queryset, token, list_name, version_names):
+    """
+    Template variables for a keyset page shown in a cached fragment.  The
+    page is only fetched when the template uses it, i.e. when the fragment
+    is not in the cache.
+    @param queryset:QuerySet
+    @param token:string | None, the cursor of the page
+    @param list_name:string, the variable holding the rows of the page
+    @param version_names:Array<string>, the versions the rows depend on
+    @return dict
+    """
+    pager = SimpleLazyObject(lambda: KeysetPage(queryset, token))
+    return {
+        list_name : lambda: pager.object_list,
+        "pager" : pager,
+        "fragment_key" : versions.fragment_key(token, versions.get_versions(version_names)),
+        "fragment_timeout" : versions.FRAGMENT_TIMEOUT,
+        }
+
+
+class BookCopyRow(object):
+    """
+    A lightweight, read-only view of a BookCopy joined with its branch,
+    book, publisher and current checkout.
+    """
+    __slots__ = ('id', 'copy_number', 'position', 'library_branch_name',
+                 'title', 'isbn', 'publisher_name', 'checkout', 'status')
+
+    # Columns selected by bookcopy_rows(), in the order they are unpacked.
+    FIELDS = ('id', 'copy_number', 'position', 'library_branch__name',
+              'book__title', 'book__isbn', 'book__publisher__name',
+              'current_checkout__id', 'current_checkout__user',
+              'current_checkout__reserve_date', 'current_checkout__borrow_date',
+              'current_checkout__return_date')
+
+    def __init__(self, values, user, now):
+        (self.id, self.copy_number, self.position, self.library_branch_name,
+         self.title, self.isbn, self.publisher_name, checkout_id, user_id,
+         reserve_date, borrow_date, return_date) = values
+        if checkout_id is None:
+            self.checkout = None
+            self.status = 'available'
+        else:
+            # An unsaved instance, so the checkout logic can be reused.
+            self.checkout = BookCopyCheckout(
+                id=checkout_id, user_id=user_id, reserve_date=reserve_date,
+                borrow_date=borrow_date, return_date=return_date)
+            self.status = self.checkout.status(user, now)
+
+
+def bookcopy_rows(queryset, user, now):
+    """
+    Fetch BookCopy rows together with everything a listing displays in a
+    single joined query.
+    @param queryset:QuerySet<BookCopy>, usually a Page.object_list
+    @param user:User whose point of view determines the status
+    @param now:datetime used for finding the status
+    @return Array<BookCopyRow>
+    """
+    # Extra columns, such as a search rank, are selected so they may be
+    # used for ordering, but they are not part of the row.
+    fields = BookCopyRow.FIELDS + tuple(queryset.query.extra_select)
+    field_count = len(BookCopyRow.FIELDS)
+    return [BookCopyRow(values[0:field_count], user, now)
+            for values in queryset.values_list(*fields)]
+
+
+def bookcopy_rows_by_id(bookcopy_ids, user, now):
+    """
+    Fetch the BookCopyRows of known book copies, in the order given.
+    @param bookcopy_ids:Array<int>
+    @return Array<BookCopyRow>
+    """
+    rows = dict((row.id, row) for row in bookcopy_rows(
+            BookCopy.objects.filter(id__in=bookcopy_ids), user, now))
+    return [rows[bookcopy_id] for bookcopy_id in bookcopy_ids if bookcopy_id in rows]
@@ -0,0 +1,238 @@
+from django.conf import settings
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.contrib.auth.models import User
+from django.db import connection
+from django.template import Template
+from django.test.client import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from library.instrumentation import record_queries, summarize
+from library.models import BookCopy, LibraryBranch, Reader
+from library.checkout import checkout_bookcopy
+
+from datetime import datetime
+from optparse import make_option
+import json
+import pytz
+import random
+import time
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = ('Generates a dataset in a test database and measures the latency, '
+            'queries and rows fetched of the reader and admin views.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--books', type='int', dest='books', default=1000,
+                    help='Number of books to generate.'),
+        make_option('--branches', type='int', dest='branches', default=5,
+                    help='Number of library branches to generate.'),
+        make_option('--readers', type='int', dest='readers', default=200,
+                    help='Number of readers to generate.'),
+        make_option('--checkouts', type='int', dest='checkouts', default=20000,
+                    help='Number of checkouts to generate.'),
+        make_option('--seed', type='int', dest='seed', default=1,
+                    help='Seed for the generated data and the requests.'),
+        make_option('--requests', type='int', dest='requests', default=50,
+                    help='Number of requests made to each view.'),
+        make_option('--existing', action='store_true', dest='existing', default=False,
+                    help='Measure the configured database as it is, instead of '
+                         'generating a test database.  This writes to it: a '
+                         'reader and an admin user are created for the run and '
+                         'deleted after it, and copies are borrowed and returned, '
+                         'which changes the statistics.  Requires --allow-writes.'),
+        make_option('--allow-writes', action='store_true', dest='allow_writes', default=False,
+                    help='Confirm that --existing may write to the configured database.'),
+        make_option('--output', dest='output', default=None,
+                    help='Write the results as JSON to this file.'),
+        make_option('--thresholds', dest='thresholds', default=None,
+                    help='JSON file of limits, e.g. {"reader_bookcopy": {"p99_ms": 200}}. '
+                         'The run fails if a result is above its limit.'),
+        )
+
+    # The measured views, in the order they are run.
+    VIEWS = ['reader_bookcopy', 'reader_mybooks', 'reader_checkout',
+             'admin_librarybranch_statistics']
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('--requests must be positive.')
+        if options['existing'] and not options['allow_writes']:
+            raise CommandError('--existing creates users and borrows and returns books '
+                               'in the configured database.  Never run it against '
+                               'production data; add --allow-writes to confirm.')
+        thresholds = {}
+        if options['thresholds']:
+            with open(options['thresholds']) as f:
+                thresholds = json.load(f)
+
+        # Measure the views as they are served, not as they are debugged.
+        debug = settings.DEBUG
+        settings.DEBUG = False
+        # The test runner has already set up the environment under 'manage.py test'.
+        set_up = not hasattr(Template, 'original_render')
+        if set_up:
+            setup_test_environment()
+        old_name = None
+        try:
+            if not options['existing']:
+                old_name = connection.settings_dict['NAME']
+                connection.creation.create_test_db(verbosity=0, autoclobber=True)
+                call_command('initdata', books=options['books'],
+                             branches=options['branches'], readers=options['readers'],
+                             checkouts=options['checkouts'], seed=options['seed'],
+                             stdout=self.stdout)
+            results = self.run_views(options['requests'], random.Random(options['seed']))
+        finally:
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            if set_up:
+                teardown_test_environment()
+            settings.DEBUG = debug
+
+        self.write_results(results)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+        failures = self.check_thresholds(results, thresholds)
+        if failures:
+            raise CommandError('Benchmark thresholds exceeded:\n' + '\n'.join(failures))
+
+    def login(self, prefix, **extra):
+        """
+        Create a user for the run, with a random name and password, and a
+        client logged in as it.
+        @return (User, Client)
+        """
+        username = '%s_%s' % (prefix, User.objects.make_random_password(
+                8, 'abcdefghjkmnpqrstuvwxyz23456789'))
+        password = User.objects.make_random_password()
+        user = User.objects.create_user(username, password=password)
+        for name, value in extra.items():
+            setattr(user, name, value)
+        user.save()
+        client = Client()
+        client.login(username=username, password=password)
+        return user, client
+
+    def remove_user(self, user):
+        """
+        Delete a user made for the run, returning the copies it still has.
+        """
+        # Deleting a checkout would delete the copy it is the current
+        # checkout of.
+        now = datetime.now(pytz.utc)
+        for bookcopy_id in BookCopy.objects.filter(current_checkout__user=user) \
+                .values_list('id', flat=True):
+            checkout_bookcopy(user, bookcopy_id, 'return', now)
+        user.delete()
+
+    def run_views(self, count, rand):
+        """
+        Make 'count' requests to each view, as a reader and an admin made for
+        the run, and summarize them.
+        @return dict, by view name
+        """
+        users = []
+        try:
+            reader, reader_client = self.login('benchmark_reader')
+            users.append(reader)
+            Reader.objects.create(user=reader, address='-', phone_number='-')
+            admin, admin_client = self.login('benchmark_admin', is_staff=True,
+                                             is_superuser=True)
+            users.append(admin)
+            return self.measure_views(count, rand, reader, reader_client, admin_client)
+        finally:
+            for user in users:
+                self.remove_user(user)
+
+    def measure_views(self, count, rand, reader, reader_client, admin_client):
+        """
+        @return dict, by view name, see run_views()
+        """
+        bookcopy_ids = list(BookCopy.objects.values_list('id', flat=True))
+        librarybranch_ids = list(LibraryBranch.objects.values_list('id', flat=True))
+        if not bookcopy_ids:
+            raise CommandError('The database has no book copies.')
+        page_count = max(len(bookcopy_ids) // 10, 1)
+        words = ['birds', 'cook', 'oxford', 'jessica', 'press', 'lizards']
+
+        def reader_bookcopy():
+            if rand.random() < 0.3:
+                return reader_client.get(reverse('reader_bookcopy'), {
+                        'q' : rand.choice(words), 'by' : 'all'})
+            return reader_client.get(reverse('reader_bookcopy'), {
+                    'page' : rand.randint(1, page_count)})
+
+        def reader_mybooks():
+            return reader_client.get(reverse('reader_mybooks'))
+
+        def reader_checkout():
+            bookcopy_id = rand.choice(bookcopy_ids)
+            if rand.random() < 0.5:
+                return reader_client.get(reverse('reader_checkout'), {'id' : bookcopy_id})
+            # Borrow a copy, which is returned after it is measured.
+            bookcopy_ids_out.append(bookcopy_id)
+            return reader_client.post(reverse('reader_checkout'), {
+                    'id' : bookcopy_id, 'title' : '-', 'authors' : '-', 'action' : 'borrow'})
+
+        def admin_librarybranch_statistics():
+            return admin_client.post(reverse('admin_librarybranch_statistics'), {
+                    'library_branch' : rand.choice(librarybranch_ids),
+                    'statistic' : rand.choice(['borrow', 'books', 'avg_fine'])})
+
+        requests = {
+            'reader_bookcopy' : reader_bookcopy,
+            'reader_mybooks' : reader_mybooks,
+            'reader_checkout' : reader_checkout,
+            'admin_librarybranch_statistics' : admin_librarybranch_statistics,
+            }
+        results = {}
+        for name in self.VIEWS:
+            samples = []
+            for x in range(0, count):
+                bookcopy_ids_out = []
+                with record_queries(connection) as stats:
+                    start = time.time()
+                    response = requests[name]()
+                    elapsed = time.time() - start
+                if response.status_code >= 400:
+                    raise CommandError('%s returned status %d.' % (name, response.status_code))
+                samples.append((elapsed * 1000.0, stats.count, stats.rows))
+                for bookcopy_id in bookcopy_ids_out:
+                    bookcopy = BookCopy.objects.get(id=bookcopy_id)
+                    if bookcopy.current_checkout and \
+                            bookcopy.current_checkout.user_id == reader.id:
+                        bookcopy.do_return(reader, bookcopy.current_checkout.borrow_date)
+            results[name] = summarize(samples)
+        return results
+
+    def write_results(self, results):
+        self.stdout.write('%-32s %10s %10s %10s %10s %10s %10s' % (
+                'view', 'p50 ms', 'p99 ms', 'queries', 'max', 'rows', 'max'))
+        for name in self.VIEWS:
+            result = results[name]
+            self.stdout.write('%-32s %10.2f %10.2f %10.2f %10d %10.2f %10d' % (
+                    name, result['p50_ms'], result['p99_ms'], result['queries_mean'],
+                    result['queries_max'], result['rows_mean'], result['rows_max']))
+
+    def check_thresholds(self, results, thresholds):
+        """
+        Compare the results with their limits.
+        @return Array<string>, a message for every limit exceeded
+        """
+        failures = []
+        for name, limits in sorted(thresholds.items()):
+            if name not in results:
+                failures.append('%s: unknown view' % name)
+                continue
+            for metric, limit in sorted(limits.items()):
+                if metric not in results[name]:
+                    failures.append('%s: unknown metric %s' % (name, metric))
+                elif results[name][metric] > limit:
+                    failures.append('%s: %s is %s, above %s' % (
+                            name, metric, results[name][metric], limit))
+        return failures
@@ -0,0 +1,52 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from library import fines
+
+from datetime import datetime, timedelta
+from optparse import make_option
+import pytz
+import random
+import time
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = 'Times the batch fine computation on generated checkout dates.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--count', type='int', dest='count', default=1000000,
+                    help='Number of checkouts to compute fines for.'),
+        make_option('--seed', type='int', dest='seed', default=0,
+                    help='Seed for the generated dates.'),
+        )
+
+    def handle(self, *args, **options):
+        count = options['count']
+        if count < 1:
+            raise CommandError('--count must be positive.')
+        rand = random.Random(options['seed'])
+
+        # Borrowed in the last two years, kept for up to 60 days.
+        now = datetime.now(pytz.utc)
+        borrow_dates = []
+        return_dates = []
+        for x in xrange(0, count):
+            borrow_date = now - timedelta(seconds=rand.randint(0, 2 * 365 * 86400))
+            borrow_dates.append(borrow_date)
+            return_dates.append(borrow_date + timedelta(seconds=rand.randint(0, 60 * 86400)))
+
+        results = {}
+        modes = [('python', False)]
+        if fines.numpy is not None:
+            modes.append(('numpy', True))
+        else:
+            self.stdout.write('NumPy is not installed, only timing Python.')
+        for name, use_numpy in modes:
+            start_time = time.time()
+            results[name] = fines.late_totals(borrow_dates, return_dates, use_numpy)
+            elapsed = time.time() - start_time
+            late_count, late_days = results[name]
+            self.stdout.write('%-6s %d checkouts in %.2fs (%.0f rows/s), %d late, %d late days.' % (
+                    name, count, elapsed, count / max(elapsed, 0.001), late_count, late_days))
+
+        if len(set(results.values())) != 1:
+            raise CommandError('Python and NumPy results differ: %r' % results)
@@ -0,0 +1,114 @@
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.core.urlresolvers import reverse
+from django.db import connection
+from django.template import Template
+from django.test.client import Client
+from django.test.utils import setup_test_environment, teardown_test_environment
+
+from library.instrumentation import record_queries, summarize
+
+from optparse import make_option
+import json
+import time
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = ('Measures the database queries and time of the requests of a logged in '
+            'reader with each way of keeping sessions.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--sessions', dest='sessions', default=None,
+                    help='Comma separated session stores to compare, by default '
+                         'all of: %s.' % ', '.join(sorted(settings.SESSION_ENGINES))),
+        make_option('--view', dest='view', default='dashboard',
+                    help='Name of the URL requested.'),
+        make_option('--requests', type='int', dest='requests', default=100,
+                    help='Number of requests made with each session store.'),
+        make_option('--existing', action='store_true', dest='existing', default=False,
+                    help='Use the configured database instead of a test database.  '
+                         'This writes to it: a user is created for the run and '
+                         'deleted after it.  Requires --allow-writes.'),
+        make_option('--allow-writes', action='store_true', dest='allow_writes', default=False,
+                    help='Confirm that --existing may write to the configured database.'),
+        make_option('--output', dest='output', default=None,
+                    help='Write the results as JSON to this file.'),
+        )
+
+    def handle(self, *args, **options):
+        if options['requests'] < 1:
+            raise CommandError('--requests must be positive.')
+        if options['existing'] and not options['allow_writes']:
+            raise CommandError('--existing creates a user in the configured database.  '
+                               'Never run it against production data; add '
+                               '--allow-writes to confirm.')
+        sessions = sorted(settings.SESSION_ENGINES)
+        if options['sessions']:
+            sessions = options['sessions'].split(',')
+        for name in sessions:
+            if name not in settings.SESSION_ENGINES:
+                raise CommandError('Unknown session store "%s".' % name)
+
+        debug = settings.DEBUG
+        settings.DEBUG = False
+        session_engine = settings.SESSION_ENGINE
+        set_up = not hasattr(Template, 'original_render')
+        if set_up:
+            setup_test_environment()
+        old_name = None
+        user = None
+        try:
+            if not options['existing']:
+                old_name = connection.settings_dict['NAME']
+                connection.creation.create_test_db(verbosity=0, autoclobber=True)
+            # A user for the run only, with a random name and password.
+            self.username = 'benchmark_reader_%s' % User.objects.make_random_password(
+                8, 'abcdefghjkmnpqrstuvwxyz23456789')
+            self.password = User.objects.make_random_password()
+            user = User.objects.create_user(self.username, password=self.password)
+            results = {}
+            for name in sessions:
+                settings.SESSION_ENGINE = settings.SESSION_ENGINES[name]
+                results[name] = self.measure(reverse(options['view']), options['requests'])
+        finally:
+            settings.SESSION_ENGINE = session_engine
+            if user is not None:
+                user.delete()
+            if old_name is not None:
+                connection.creation.destroy_test_db(old_name, verbosity=0)
+            if set_up:
+                teardown_test_environment()
+            settings.DEBUG = debug
+
+        self.stdout.write('%-16s %10s %10s %10s' % ('sessions', 'p50 ms', 'p99 ms', 'queries'))
+        for name in sessions:
+            result = results[name]
+            self.stdout.write('%-16s %10.2f %10.2f %10.2f' % (
+                    name, result['p50_ms'], result['p99_ms'], result['queries_mean']))
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                json.dump(results, f, indent=2, sort_keys=True)
+
+    def measure(self, path, count):
+        """
+        Log in with the current SESSION_ENGINE and request a page.
+        @return dict, as made by summarize()
+        """
+        client = Client()
+        if not client.login(username=self.username, password=self.password):
+            raise CommandError('Cannot log in as %s.' % self.username)
+        # The first request may fill the cache.
+        client.get(path)
+        samples = []
+        for x in range(0, count):
+            with record_queries(connection) as stats:
+                start = time.time()
+                response = client.get(path)
+                elapsed = time.time() - start
+            if response.status_code != 200:
+                raise CommandError('%s returned status %d.' % (path, response.status_code))
+            samples.append((elapsed * 1000.0, stats.count, stats.rows))
+        # Drop the session, which the database store would keep.
+        client.logout()
+        return summarize(samples)
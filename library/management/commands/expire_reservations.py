@@ -0,0 +1,104 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from library.models import BookCopy, LibraryBranch
+from library import holds, versions
+
+from datetime import datetime
+from optparse import make_option
+import pytz
+import time
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = ('Clears book reservations that expired at 6PM, passing the copies of held '
+            'books to the next reader waiting, and expires the holds not claimed.  '
+            'Run it every evening.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--branch', dest='branch', default=None,
+                    help='Only expire reservations at the library branch with this id or name.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Count the expired reservations without clearing them.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=1000,
+                    help='Number of book copies updated in each transaction.'),
+        )
+
+    def handle(self, *args, **options):
+        now = datetime.now(pytz.utc)
+        batch_size = options['batch_size']
+        if batch_size < 1:
+            raise CommandError('--batch-size must be positive.')
+
+        bookcopy_set = BookCopy.objects.expired_reservations(now)
+        hold_set = holds.unclaimed_holds(now)
+        if options['branch']:
+            library_branch = self.get_librarybranch(options['branch'])
+            bookcopy_set = bookcopy_set.filter(library_branch=library_branch)
+            hold_set = hold_set.filter(bookcopy__library_branch=library_branch)
+
+        start_time = time.time()
+        total = 0
+        last_id = 0
+        while True:
+            # Walk the expired copies in primary key order, one batch at a time.
+            ids = list(bookcopy_set.filter(id__gt=last_id).order_by('id')
+                       .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            if options['dry_run']:
+                total += len(ids)
+            else:
+                with transaction.commit_on_success():
+                    # The conditions are checked again, so a copy borrowed
+                    # since the SELECT is left alone.
+                    total += BookCopy.objects.expire_reservations(now, id__in=ids)
+                # Bumped after the commit, so no page is cached with the
+                # old status under the new versions.
+                versions.bump_bookcopies(ids)
+                versions.bump_availability(BookCopy.objects.filter(id__in=ids)
+                                           .values_list('book', flat=True))
+
+        hold_total = self.expire_holds(hold_set, now, batch_size, options['dry_run'])
+
+        elapsed = time.time() - start_time
+        if options['dry_run']:
+            verb = 'Found'
+        else:
+            verb = 'Expired'
+        self.stdout.write('%s %d reservations and %d holds in %.2fs (%.0f rows/s).' % (
+                verb, total, hold_total, elapsed, (total + hold_total) / max(elapsed, 0.001)))
+
+    def expire_holds(self, hold_set, now, batch_size, dry_run):
+        """
+        Expire the holds whose reservations were not claimed, one batch at a time.
+        @return int, the number of holds
+        """
+        total = 0
+        last_id = 0
+        while True:
+            ids = list(hold_set.filter(id__gt=last_id).order_by('id')
+                       .values_list('id', flat=True)[:batch_size])
+            if not ids:
+                break
+            last_id = ids[-1]
+            if dry_run:
+                total += len(ids)
+            else:
+                with transaction.commit_on_success():
+                    total += holds.expire_holds(now, id__in=ids)
+        return total
+
+    def get_librarybranch(self, branch):
+        """
+        Look up a library branch by its id or its name.
+        @param branch:string
+        @return LibraryBranch
+        """
+        try:
+            if branch.isdigit():
+                return LibraryBranch.objects.get(id=int(branch))
+            return LibraryBranch.objects.get(name=branch)
+        except LibraryBranch.DoesNotExist:
+            raise CommandError('Library branch "%s" does not exist.' % branch)
@@ -0,0 +1,103 @@
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+
+from library.fines import FINE_FREE_DAYS
+from library.models import BookCopy, BookCopyCheckout, LibraryBranch
+
+from datetime import datetime, timedelta
+from optparse import make_option
+import pytz
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = ('Prints the query plans the database chooses for the frequent and '
+            'expensive checkout queries.  Run it before and after upgrade_schema '
+            'and compare the outputs.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--branch', type='int', dest='branch', default=None,
+                    help='Id of the library branch queried, by default the first.'),
+        make_option('--user', dest='user', default=None,
+                    help='Username of the reader queried, by default the first.'),
+        make_option('--joined', action='store_true', dest='joined', default=False,
+                    help='Find the branch of a checkout through its book copy, as '
+                         'before the checkouts had a library_branch column.'),
+        make_option('--output', dest='output', default=None,
+                    help='Write the plans to this file instead of the standard output.'),
+        )
+
+    def handle(self, *args, **options):
+        now = datetime.now(pytz.utc)
+        cursor = connection.cursor()
+        columns = set(row[0] for row in connection.introspection.get_table_description(
+                cursor, BookCopyCheckout._meta.db_table))
+        joined = options['joined'] or 'library_branch_id' not in columns
+        try:
+            if options['branch'] is None:
+                library_branch = LibraryBranch.objects.order_by('id')[0]
+            else:
+                library_branch = LibraryBranch.objects.get(id=options['branch'])
+            if options['user'] is None:
+                user = User.objects.filter(reader__isnull=False).order_by('id')[0]
+            else:
+                user = User.objects.get(username=options['user'])
+        except (IndexError, LibraryBranch.DoesNotExist, User.DoesNotExist):
+            raise CommandError('The library branch or reader does not exist.')
+
+        lines = ['vendor: %s' % connection.vendor,
+                 'branch lookup: %s' % ('bookcopy__library_branch' if joined
+                                        else 'library_branch')]
+        for name, queryset in self.hot_queries(user, library_branch, now, joined):
+            sql, params = queryset.query.sql_with_params()
+            lines.append('')
+            lines.append('== %s' % name)
+            lines.append(sql)
+            lines.append('params: %r' % (params,))
+            for row in self.explain(cursor, sql, params):
+                lines.append('  ' + ' | '.join(unicode(value) for value in row))
+        output = '\n'.join(lines) + '\n'
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(output.encode('utf-8'))
+        else:
+            self.stdout.write(output, ending='')
+
+    def hot_queries(self, user, library_branch, now, joined):
+        """
+        The checkout queries of the views, the statistics and the sweeper.
+        @return Array<(string, QuerySet)>
+        """
+        branch = 'bookcopy__library_branch' if joined else 'library_branch'
+        branch_set = BookCopyCheckout.objects.filter(**{branch : library_branch})
+        active_set = BookCopyCheckout.objects.active(user, now)
+        if joined:
+            # The column may not exist yet.
+            active_set = active_set.defer('library_branch')
+        return [
+            ('active checkouts of a reader', active_set),
+            ('books of a reader',
+             BookCopy.objects.filter(current_checkout__user=user)),
+            ('expired reservations',
+             BookCopy.objects.expired_reservations(now)),
+            ('late books still out at a branch',
+             branch_set.filter(return_date__isnull=True,
+                               borrow_date__lte=now - timedelta(days=FINE_FREE_DAYS + 1))
+             .values_list('borrow_date', flat=True)),
+            ('borrowers at a branch',
+             branch_set.values_list(branch, 'user').annotate(count=Count('id')).order_by()),
+            ('returned checkouts at a branch',
+             branch_set.filter(borrow_date__isnull=False, return_date__isnull=False)
+             .values_list(branch, 'borrow_date', 'return_date')),
+            ]
+
+    def explain(self, cursor, sql, params):
+        """
+        @return Array<tuple>, the rows of the query plan
+        """
+        if connection.vendor == 'sqlite':
+            cursor.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        else:
+            cursor.execute('EXPLAIN ' + sql, params)
+        return cursor.fetchall()
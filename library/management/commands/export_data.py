@@ -0,0 +1,46 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from library import exports
+
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    args = '<%s>' % '|'.join(sorted(exports.EXPORTS))
+    help = 'Exports a table as CSV or JSON lines, reading it a chunk of rows at a time.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default='csv',
+                    help='csv or jsonl.'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+                    help='Compress the output with gzip.'),
+        make_option('--output', dest='output', default=None,
+                    help='Write to this file instead of the standard output.'),
+        make_option('--chunk-size', type='int', dest='chunk_size',
+                    default=exports.EXPORT_CHUNK_SIZE,
+                    help='Number of rows read by each query.'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1 or args[0] not in exports.EXPORTS:
+            raise CommandError('Name one of the exports: %s.' %
+                               ', '.join(sorted(exports.EXPORTS)))
+        if options['format'] not in exports.FORMATS:
+            raise CommandError('Unknown format "%s".' % options['format'])
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+
+        chunks = exports.export(args[0], options['format'], options['gzip'],
+                                options['chunk_size'])
+        if not options['output']:
+            for chunk in chunks:
+                self.stdout.write(chunk, ending='')
+            return
+        start_time = time.time()
+        size = 0
+        with open(options['output'], 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        self.stdout.write('Wrote %d bytes to %s in %.2fs.' % (
+                size, options['output'], time.time() - start_time))
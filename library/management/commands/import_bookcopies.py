@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from library.importers import (FORMATS, IMPORT_CHUNK_SIZE, ImportFileError,
+                               guess_format, import_bookcopies, read_rows)
+
+from optparse import make_option
+import sys
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Adds the book copies listed in a CSV or JSON lines file, '
+            'with the columns isbn, library_branch, copy_number and position.  '
+            'Use "-" to read from standard input.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None, choices=FORMATS,
+                    help='The file format, csv or jsonl.  By default it is '
+                         'guessed from the file name.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=IMPORT_CHUNK_SIZE,
+                    help='Number of rows looked up and inserted together.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Check the rows without adding any copies.'),
+        )
+
+    def handle(self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Give the file to import.')
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+        filename = args[0]
+        format = options['format'] or guess_format(filename)
+
+        def progress(result):
+            self.stdout.write('%d rows read, %d copies added (%.0f rows/s).' % (
+                    result.row_count, result.created_count, result.rows_per_second))
+
+        if filename == '-':
+            lines = sys.stdin
+        else:
+            try:
+                lines = open(filename, 'rb')
+            except IOError as e:
+                raise CommandError('Cannot read %s: %s' % (filename, e))
+        try:
+            result = import_bookcopies(read_rows(lines, format), options['chunk_size'],
+                                       options['dry_run'], progress)
+        except ImportFileError as e:
+            raise CommandError(str(e))
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+
+        for line, message in result.errors:
+            self.stderr.write('Line %d: %s' % (line, message))
+        if result.error_count > len(result.errors):
+            self.stderr.write('... and %d more errors.' % (
+                    result.error_count - len(result.errors)))
+        if options['dry_run']:
+            verb = 'Checked'
+        else:
+            verb = 'Imported'
+        self.stdout.write('%s %d of %d rows in %.2fs (%.0f rows/s), %d errors.' % (
+                verb, result.created_count, result.row_count, result.elapsed,
+                result.rows_per_second, result.error_count))
@@ -0,0 +1,113 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from library.importers import (FORMATS, IMPORT_CHUNK_SIZE, READER_COLUMNS, ImportFileError,
+                               ImportResult, claim_reader_import, guess_format, import_readers,
+                               pending_reader_imports, progress_path, read_rows,
+                               write_progress)
+
+from optparse import make_option
+import os
+import sys
+
+class Command(BaseCommand):
+    args = '<file>'
+    help = ('Adds the readers listed in a CSV or JSON lines file, with the columns '
+            '%s.  Readers without a password have to have one set before they can '
+            'log in.  Use "-" to read from standard input, or --pending to import '
+            'the files uploaded from the admin pages.' % ', '.join(READER_COLUMNS))
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', dest='format', default=None, choices=FORMATS,
+                    help='The file format, csv or jsonl.  By default it is '
+                         'guessed from the file name.'),
+        make_option('--chunk-size', type='int', dest='chunk_size', default=IMPORT_CHUNK_SIZE,
+                    help='Number of readers hashed and inserted together.'),
+        make_option('--processes', type='int', dest='processes', default=None,
+                    help='Number of processes hashing passwords.  By default, '
+                         'one for each CPU.'),
+        make_option('--progress-file', dest='progress_file', default=None,
+                    help='Save the progress as JSON to this file after each chunk.'),
+        make_option('--delete', action='store_true', dest='delete', default=False,
+                    help='Delete the file once it is imported.'),
+        make_option('--pending', action='store_true', dest='pending', default=False,
+                    help='Import the files uploaded from the admin pages that are '
+                         'waiting, oldest first.  Run it from cron.'),
+        )
+
+    def handle(self, *args, **options):
+        if options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be positive.')
+        if options['processes'] is not None and options['processes'] < 1:
+            raise CommandError('--processes must be positive.')
+        if options['pending']:
+            if args:
+                raise CommandError('Give no file with --pending.')
+            for job, filename, format in pending_reader_imports():
+                running = claim_reader_import(filename)
+                if running is None:
+                    # Another run is importing it.
+                    continue
+                try:
+                    self.import_file(running, format, progress_path(job), True, options)
+                except CommandError as e:
+                    self.stderr.write('%s: %s' % (filename, e))
+            return
+        if len(args) != 1:
+            raise CommandError('Give the file to import.')
+        filename = args[0]
+        self.import_file(filename, options['format'] or guess_format(filename),
+                         options['progress_file'], options['delete'], options)
+
+    def import_file(self, filename, format, progress_file, delete, options):
+        """
+        Import one file of readers and report on it.
+        @param progress_file:string | None, where to save the progress
+        @param delete:bool, True to delete the file afterwards
+        """
+        def progress(result):
+            self.stdout.write('%d rows read, %d readers added (%.0f rows/s).' % (
+                    result.row_count, result.created_count, result.rows_per_second))
+            if progress_file:
+                write_progress(progress_file, result)
+
+        def failed(message):
+            if progress_file:
+                result = ImportResult()
+                result.add_error(0, message)
+                write_progress(progress_file, result, done=True)
+
+        if filename == '-':
+            lines = sys.stdin
+        else:
+            try:
+                lines = open(filename, 'rb')
+            except IOError as e:
+                failed('Cannot read the file.')
+                raise CommandError('Cannot read %s: %s' % (filename, e))
+        try:
+            result = import_readers(read_rows(lines, format, READER_COLUMNS),
+                                    options['chunk_size'], options['processes'], progress)
+        except ImportFileError as e:
+            failed(str(e))
+            raise CommandError(str(e))
+        except Exception as e:
+            # Show the failure to whoever follows the progress, and let it
+            # reach the log of the caller too.
+            failed('The import stopped: %s' % e)
+            raise
+        finally:
+            if lines is not sys.stdin:
+                lines.close()
+                if delete:
+                    os.remove(filename)
+
+        if progress_file:
+            write_progress(progress_file, result, done=True)
+        for line, message in result.errors:
+            self.stderr.write('Line %d: %s' % (line, message))
+        if result.error_count > len(result.errors):
+            self.stderr.write('... and %d more errors.' % (
+                    result.error_count - len(result.errors)))
+        self.stdout.write('Imported %d of %d rows in %.2fs (%.0f rows/s), %d errors.' % (
+                result.created_count, result.row_count, result.elapsed,
+                result.rows_per_second, result.error_count))
@@ -1,39 +1,95 @@
+from django.core.management import call_command
 from django.core.management.base import BaseCommand, CommandError
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
-from django.db import IntegrityError
+from django.db import connection, transaction
+from django.db.models import get_app, get_models
 
 from library.models import (Author, Publisher, Book, LibraryBranch,
-                            Reader, BookCopy)
+                            Reader, BookCopy, BookCopyCheckout)
+from library import versions
 
-from datetime import date
+from datetime import date, datetime, timedelta
+from optparse import make_option
+import pytz
 import random
 import string
+import time
 
 class Command(BaseCommand):
     args = '<none>'
-    help = 'Generates initial data for the library database.'
+    help = ('Generates initial data for the library database.  It refuses to run '
+            'on a database that has library data, unless --clear is given.')
 
-    def handle(self, *args, **options):
-        
-        random.seed()
+    option_list = BaseCommand.option_list + (
+        make_option('--authors', type='int', dest='authors', default=100,
+                    help='Number of authors to create.'),
+        make_option('--publishers', type='int', dest='publishers', default=9,
+                    help='Number of publishers to create.'),
+        make_option('--books', type='int', dest='books', default=18,
+                    help='Number of books to create.'),
+        make_option('--branches', type='int', dest='branches', default=5,
+                    help='Number of library branches to create.'),
+        make_option('--readers', type='int', dest='readers', default=10,
+                    help='Number of readers to create.'),
+        make_option('--copies', type='int', dest='copies', default=3,
+                    help='Most copies of each book held by each branch.'),
+        make_option('--checkouts', type='int', dest='checkouts', default=100,
+                    help='Number of checkouts in the generated history.'),
+        make_option('--seed', type='int', dest='seed', default=None,
+                    help='Seed for the random data, for repeatable datasets.'),
+        make_option('--batch-size', type='int', dest='batch_size', default=5000,
+                    help='Number of rows inserted in each transaction.'),
+        make_option('--clear', action='store_true', dest='clear', default=False,
+                    help='Delete the existing library data and the readers first.'),
+        make_option('--noinput', action='store_false', dest='interactive', default=True,
+                    help='Do not ask to confirm --clear.'),
+        )
 
-        self.init_author()
-        self.stdout.write('Successfully created authors.')
+    # The checkout history covers this many days before today.
+    HISTORY_DAYS = 2 * 365
 
-        self.init_publisher()
-        self.stdout.write('Successfully created publishers.')
+    def handle(self, *args, **options):
+        for name in ['authors', 'publishers', 'books', 'branches', 'readers',
+                     'copies', 'batch_size']:
+            if options[name] < 1:
+                raise CommandError('--%s must be positive.' % name.replace('_', '-'))
+        if options['checkouts'] < 0:
+            raise CommandError('--checkouts may not be negative.')
+        if options['checkouts'] and not options['readers']:
+            raise CommandError('Checkouts need at least one reader.')
 
-        self.init_book()
-        self.stdout.write('Successfully created books.')
+        random.seed(options['seed'])
+        self.batch_size = options['batch_size']
+        self.now = datetime.now(pytz.utc)
 
-        self.init_librarybranch()
-        self.stdout.write('Successfully created library branches.')
+        if self.has_data():
+            if not options['clear']:
+                raise CommandError('The database already has library data.  Use --clear '
+                                   'to delete it first.')
+            if options['interactive']:
+                confirm = raw_input('This deletes every book, copy, checkout and reader '
+                                    'in the database "%s".\nType \'yes\' to continue, or '
+                                    '\'no\' to cancel: ' % connection.settings_dict['NAME'])
+                if confirm != 'yes':
+                    raise CommandError('Cancelled, nothing was deleted.')
+            self.clear_data()
+            self.stdout.write('Successfully removed existing data.')
 
-        self.init_reader()
-        self.stdout.write('Successfully created readers.')
+        self.init_author(options['authors'])
+        self.init_publisher(options['publishers'])
+        self.init_book(options['books'])
+        self.init_librarybranch(options['branches'])
+        self.init_reader(options['readers'])
+        self.init_bookcopy(options['copies'])
+        self.init_bookcopycheckout(options['checkouts'])
 
-        self.init_bookcopy()
-        self.stdout.write('Successfully created book copies.')
+        # Derived tables are not updated by bulk inserts, rebuild them.
+        call_command('rebuild_search_index', stdout=self.stdout)
+        call_command('rebuild_statistics', stdout=self.stdout)
+        call_command('rebuild_availability', stdout=self.stdout)
+        # The rows were inserted without signals, so drop the cached values.
+        versions.bump('book', 'librarybranch', 'reader', 'bookcopy')
 
 
     def rand_join(self, char, *args):
@@ -48,105 +104,285 @@ class Command(BaseCommand):
             results.append(arg[random.randint(0, len(arg) - 1)])
         return char.join(results)
 
-    def init_author(self):
-        # Remove existing Author models from the DB.
-        Author.objects.all().delete()
+    def next_id(self, model):
+        """
+        Find the first free primary key of a model, so rows may be inserted
+        in bulk with known ids.
+        @return int
+        """
+        last = model.objects.order_by('-id').values_list('id', flat=True)[:1]
+        return (last[0] if last else 0) + 1
+
+    def bulk_insert(self, model, rows, label):
+        """
+        Insert model instances with bulk_create, one transaction per batch.
+        @param rows:iterator of unsaved model instances
+        @param label:string used to report progress
+        """
+        start_time = time.time()
+        count = 0
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) >= self.batch_size:
+                with transaction.commit_on_success():
+                    model.objects.bulk_create(batch)
+                count += len(batch)
+                batch = []
+        if batch:
+            with transaction.commit_on_success():
+                model.objects.bulk_create(batch)
+            count += len(batch)
+        elapsed = time.time() - start_time
+        self.stdout.write('Successfully created %d %s in %.2fs (%.0f rows/s).' % (
+                count, label, elapsed, count / max(elapsed, 0.001)))
 
+    def has_data(self):
+        """
+        @return bool, True if any table of the library app has a row
+        """
+        return any(model.objects.exists() for model in get_models(get_app('library')))
+
+    def clear_data(self):
+        """
+        Remove the existing library data.  Raw DELETE statements are used,
+        since the ORM would load every row to cascade the delete.
+        """
+        qn = connection.ops.quote_name
+        reader_users = list(Reader.objects.values_list('user', flat=True))
+        # Empty the tables of the library app, each one after the tables
+        # that refer to it.  The reference from copies to their current
+        # checkout is cleared first to break the cycle.
+        remaining = list(get_models(get_app('library'), include_auto_created=True))
+        with transaction.commit_on_success():
+            BookCopy.objects.update(current_checkout=None)
+            cursor = connection.cursor()
+            while remaining:
+                for model in remaining:
+                    referenced = [other for other in remaining
+                                  for field in other._meta.fields
+                                  if other is not model and field.rel and
+                                  field.rel.to is model and
+                                  field is not BookCopy._meta.get_field('current_checkout')]
+                    if not referenced:
+                        cursor.execute('DELETE FROM %s' % qn(model._meta.db_table))
+                        remaining.remove(model)
+                        break
+                else:
+                    raise CommandError('Can not order the tables for deletion.')
+        for start in range(0, len(reader_users), self.batch_size):
+            with transaction.commit_on_success():
+                User.objects.filter(id__in=reader_users[start : start + self.batch_size],
+                                    is_staff=False).delete()
+
+    def init_author(self, count):
         first_names = ["Fred", "George", "Juan", "Pablo", "Rohit", "Graham", "Jessica"]
         last_names = ["Salvador", "Gonzales", "Miller", "Walker", "Crofford", "Adams"]
-        for i in range(1, 100):
-            # Create a random name for the author.
-            name = self.rand_join(' ', first_names, last_names)
-            # Save the author in the DB.
-            author = Author(name=name)
-            author.save()
-
-    def init_publisher(self):
-        for i in range(1, 10):
-            name = self.rand_join(' ',
-                                  ["Wesley", "O'Reilly", "Oxford", "Stanley"],
-                                  ["Press", "Printing", "Publishing", "Inc."])
-
-            address = self.rand_join(' ',
-                                     ["101", "45", "89", "412", "160"],
-                                     ["Harold", "Lexinton", "Houston", "Broadway", "Main"],
-                                     ["Drive", "Avenue", "Parkway", "Place", "Lane"])
-            # Save the publisher in the DB.
-            publisher = Publisher(name=name, address=address)
-            try:
-                publisher.save()
-            except IntegrityError:
-                # Try again.
-                i -= 1
-
-    def init_book(self):
+        def authors():
+            for i in xrange(0, count):
+                # Create a random name for the author.
+                yield Author(name=self.rand_join(' ', first_names, last_names))
+        self.bulk_insert(Author, authors(), 'authors')
+        self.author_ids = list(Author.objects.values_list('id', flat=True))
+
+    def init_publisher(self, count):
+        def publishers():
+            names = set()
+            for i in xrange(0, count):
+                name = self.rand_join(' ',
+                                      ["Wesley", "O'Reilly", "Oxford", "Stanley"],
+                                      ["Press", "Printing", "Publishing", "Inc."])
+                # Publisher names are unique, number the repeats.
+                if name in names:
+                    name = '%s %d' % (name, i)
+                names.add(name)
+                address = self.rand_join(' ',
+                                         ["101", "45", "89", "412", "160"],
+                                         ["Harold", "Lexinton", "Houston", "Broadway", "Main"],
+                                         ["Drive", "Avenue", "Parkway", "Place", "Lane"])
+                yield Publisher(name=name, address=address)
+        self.bulk_insert(Publisher, publishers(), 'publishers')
+
+    def isbn(self, number):
+        """
+        Build a unique ISBN-13 from a sequence number.
+        @return string
+        """
+        digits = '978%09d' % number
+        total = sum(int(digit) * (1 if index % 2 == 0 else 3)
+                    for index, digit in enumerate(digits))
+        return digits + str((10 - total % 10) % 10)
+
+    def init_book(self, count):
         # Define a boundary on random dates.
         start_date = date(1983, 1, 1).toordinal()
         end_date = date.today().toordinal()
-        authors = Author.objects.all()
-        # Now generate the data for books.
-        for publisher in Publisher.objects.all():
-            # Each publisher will get 2 books.
-            for book_index in range(1, 3):
+        publisher_ids = list(Publisher.objects.values_list('id', flat=True))
+        first_id = self.next_id(Book)
+        book_authors = []
+        def books():
+            for index in xrange(0, count):
                 title = self.rand_join(" ",
                                   ["Rearing", "Cooking", "Observing", "Identifying", "Petting"],
                                   ["Birds", "Dogs", "Cats", "Snails", "Lizards"])
-                isbn = ''.join(random.choice(string.ascii_uppercase + string.digits)
-                               for x in range(0, 13))
                 publication_date = date.fromordinal(random.randint(start_date, end_date))
-                book = Book(title=title, isbn=isbn, publisher=publisher,
+                book = Book(id=first_id + index, title=title, isbn=self.isbn(first_id + index),
+                            publisher_id=random.choice(publisher_ids),
                             publication_date=publication_date)
-                book.save()
                 # Now associate the book with a number of authors.
-                for x in range(0, random.randint(1, 3)):
-                    author = authors[random.randint(0, len(authors)-1)]
-                    book.authors.add(author)
-
-
-    def init_librarybranch(self):
-        for x in range(0, 5):
-            name = self.rand_join(" ",
-                                  ["New York", "Texas", "Vermont", "Hawaii"],
-                                  ["Municipal", "City", "Public", "Main"],
-                                  ["Library"])
-            address = self.rand_join(" ",
-                                     ["131", "145", "802", "213", "340"],
-                                     ["Paso", "Atlantic", "El Segundo", "Priarie"],
-                                     ["Drive", "Avenue", "Parkway", "Place", "Lane"])
-            library_branch = LibraryBranch(name=name, address=address)
-            library_branch.save()
-
-    def init_reader(self):
-        # Let's start with just 10 readers.
-        for x in range(0, 10):
-            username = ''.join(random.choice(string.ascii_uppercase + string.digits)
-                           for x in range(0, 13))
-            email = self.rand_join("@",
-                                   ["gummy", "ham", "justin", "ugly", "narwal"],
-                                   ["gmail.com", "yahoo.com", "aol.com", "geocities.net"])
-            first_name = random.choice(["Bill", "Jake", "Finn", "Peter", "Shriram"])
-            last_name = random.choice(["Macher", "Price", "Cooper", "Nader"])
-            user = User(username=username, email=email, first_name=first_name, last_name=last_name)
-            user.save()
-            address = self.rand_join(' ',
-                                     ["222", "333", "444", "555", "666"],
-                                     ["Leeman Russ", "Sentinel", "Ogryn", "Kasrkin"],
-                                     ["Drive", "Avenue", "Parkway", "Place", "Lane"])
-            phone_number = self.rand_join('-',
-                                          ['525', '915', '420', '670', '120', '555'],
-                                          ['5555', '1234', '6513', '8423', '0932'])
-            reader = Reader(user=user, address=address, phone_number=phone_number)
-            reader.save()
-
-    def init_bookcopy(self):
+                for author_id in random.sample(self.author_ids,
+                                               min(random.randint(1, 3), len(self.author_ids))):
+                    book_authors.append(Book.authors.through(book_id=book.id,
+                                                             author_id=author_id))
+                yield book
+        self.bulk_insert(Book, books(), 'books')
+        self.bulk_insert(Book.authors.through, book_authors, 'book authors')
+
+    def init_librarybranch(self, count):
+        def librarybranches():
+            names = set()
+            for x in xrange(0, count):
+                name = self.rand_join(" ",
+                                      ["New York", "Texas", "Vermont", "Hawaii"],
+                                      ["Municipal", "City", "Public", "Main"],
+                                      ["Library"])
+                # Branch names are unique, number the repeats.
+                if name in names:
+                    name = '%s %d' % (name, x)
+                names.add(name)
+                address = self.rand_join(" ",
+                                         ["131", "145", "802", "213", "340"],
+                                         ["Paso", "Atlantic", "El Segundo", "Priarie"],
+                                         ["Drive", "Avenue", "Parkway", "Place", "Lane"])
+                yield LibraryBranch(name=name, address=address)
+        self.bulk_insert(LibraryBranch, librarybranches(), 'library branches')
+
+    def init_reader(self, count):
+        # Generated readers can not log in until a password is set.
+        password = make_password(None)
+        first_id = self.next_id(User)
+        librarybranch_ids = list(LibraryBranch.objects.values_list('id', flat=True))
+        readers = []
+        def users():
+            for index in xrange(0, count):
+                user_id = first_id + index
+                email = self.rand_join("@",
+                                       ["gummy", "ham", "justin", "ugly", "narwal"],
+                                       ["gmail.com", "yahoo.com", "aol.com", "geocities.net"])
+                first_name = random.choice(["Bill", "Jake", "Finn", "Peter", "Shriram"])
+                last_name = random.choice(["Macher", "Price", "Cooper", "Nader"])
+                address = self.rand_join(' ',
+                                         ["222", "333", "444", "555", "666"],
+                                         ["Leeman Russ", "Sentinel", "Ogryn", "Kasrkin"],
+                                         ["Drive", "Avenue", "Parkway", "Place", "Lane"])
+                phone_number = self.rand_join('-',
+                                              ['525', '915', '420', '670', '120', '555'],
+                                              ['5555', '1234', '6513', '8423', '0932'])
+                readers.append(Reader(user_id=user_id, address=address,
+                                      phone_number=phone_number,
+                                      home_branch_id=random.choice(librarybranch_ids)
+                                      if librarybranch_ids else None))
+                yield User(id=user_id, username='reader%d' % user_id, email=email,
+                           first_name=first_name, last_name=last_name, password=password,
+                           date_joined=self.now, last_login=self.now)
+        self.bulk_insert(User, users(), 'users')
+        self.bulk_insert(Reader, readers, 'readers')
+        self.user_ids = [reader.user_id for reader in readers]
+
+    def position(self, number):
+        """
+        Build a unique 6 character shelf position from a sequence number.
+        @return string
+        """
+        digits = string.digits + string.ascii_uppercase
+        position = ''
+        for x in range(0, 6):
+            number, digit = divmod(number, len(digits))
+            position = digits[digit] + position
+        return position
+
+    def init_bookcopy(self, max_copies):
         """
         Create a random number of copies of each book for each branch.
         """
-        for library_branch in LibraryBranch.objects.all():
-            for book in Book.objects.all():
-                for copy_number in range(0, random.randint(1, 3)):
-                    position = ''.join(random.choice(string.ascii_uppercase + string.digits)
-                                       for x in range(0, 6))
-                    bookcopy = BookCopy(book=book, library_branch=library_branch,
-                                        copy_number=copy_number, position=position)
-                    bookcopy.save()
+        librarybranch_ids = list(LibraryBranch.objects.values_list('id', flat=True))
+        book_ids = list(Book.objects.values_list('id', flat=True))
+        first_id = self.next_id(BookCopy)
+        def bookcopies():
+            bookcopy_id = first_id
+            for library_branch_id in librarybranch_ids:
+                for book_id in book_ids:
+                    for copy_number in range(0, random.randint(1, max_copies)):
+                        yield BookCopy(id=bookcopy_id, book_id=book_id,
+                                       library_branch_id=library_branch_id,
+                                       copy_number=copy_number,
+                                       position=self.position(bookcopy_id))
+                        bookcopy_id += 1
+        self.bulk_insert(BookCopy, bookcopies(), 'book copies')
+
+    def init_bookcopycheckout(self, count):
+        """
+        Create a checkout history.  Each copy's share of the checkouts is
+        spread over its own timeline so they never overlap.  Most books are
+        borrowed and returned, some late, a few are reserved first, a few
+        reservations are never picked up, and the last checkout of a copy
+        may still be out.
+        """
+        if count == 0:
+            return
+        librarybranch_ids = dict(BookCopy.objects.values_list('id', 'library_branch'))
+        bookcopy_ids = list(librarybranch_ids)
+        random.shuffle(bookcopy_ids)
+        history_start = self.now - timedelta(days=self.HISTORY_DAYS)
+        first_id = self.next_id(BookCopyCheckout)
+        def checkouts():
+            checkout_id = first_id
+            for index, bookcopy_id in enumerate(bookcopy_ids):
+                copy_count = count // len(bookcopy_ids)
+                if index < count % len(bookcopy_ids):
+                    copy_count += 1
+                if copy_count == 0:
+                    continue
+                slot = timedelta(days=self.HISTORY_DAYS) / copy_count
+                for slot_index in xrange(0, copy_count):
+                    slot_start = history_start + slot * slot_index
+                    checkout = BookCopyCheckout(
+                        id=checkout_id, bookcopy_id=bookcopy_id,
+                        library_branch_id=librarybranch_ids[bookcopy_id],
+                        user_id=random.choice(self.user_ids))
+                    checkout_id += 1
+                    # Start in the first fifth of the slot, and keep the book
+                    # for up to 30 days, sometimes longer, within the slot.
+                    start = slot_start + timedelta(
+                        seconds=random.randint(0, int(slot.total_seconds() / 5)))
+                    kept = timedelta(seconds=random.randint(3600, 30 * 86400))
+                    if random.random() < 0.2:
+                        kept = kept * 2
+                    kept = min(kept, slot_start + slot - start - timedelta(seconds=1))
+                    odds = random.random()
+                    if odds < 0.03 and start < self.now - timedelta(days=2):
+                        # A reservation that was never picked up.
+                        checkout.reserve_date = start
+                        yield checkout
+                        continue
+                    if odds < 0.15:
+                        checkout.reserve_date = start
+                        start = start + timedelta(minutes=random.randint(1, 120))
+                    checkout.borrow_date = start
+                    if start + kept < self.now:
+                        checkout.return_date = start + kept
+                    yield checkout
+        self.bulk_insert(BookCopyCheckout, checkouts(), 'checkouts')
+
+        # Point each copy at its checkout that is still out.
+        qn = connection.ops.quote_name
+        with transaction.commit_on_success():
+            connection.cursor().execute(
+                '\n'.join([
+                        'UPDATE %(bookcopy)s SET current_checkout_id = (',
+                        '  SELECT max(c.id) FROM %(checkout)s c',
+                        '  WHERE c.bookcopy_id = %(bookcopy)s.id',
+                        '    AND c.return_date IS NULL',
+                        '    AND c.borrow_date IS NOT NULL)']) % {
+                    'bookcopy' : qn(BookCopy._meta.db_table),
+                    'checkout' : qn(BookCopyCheckout._meta.db_table)})
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from library.models import BookAvailability
+from library.availability import rebuild_availability
+
+import time
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = 'Recounts the copies of every book at every library branch, and the available ones.'
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        with transaction.commit_on_success():
+            rebuild_availability()
+        self.stdout.write('Counted the copies of %d books and branches in %.2fs.' % (
+                BookAvailability.objects.count(), time.time() - start_time))
@@ -0,0 +1,44 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from library.models import Book, BookSearchDocument, BookSearchTerm
+from library.search import book_document, document_terms
+from library import versions
+
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = 'Rebuilds the book search documents and index from the catalog.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=500,
+                    help='Number of books loaded at a time.'),
+        )
+
+    def handle(self, *args, **options):
+        start_time = time.time()
+        count = 0
+        last_id = 0
+        with transaction.commit_on_success():
+            BookSearchTerm.objects.all().delete()
+            BookSearchDocument.objects.all().delete()
+            while True:
+                # Load the books a batch at a time, with their publisher and authors.
+                books = list(Book.objects.filter(id__gt=last_id).order_by('id')
+                             .select_related('publisher')
+                             .prefetch_related('authors')[:options['batch_size']])
+                if not books:
+                    break
+                last_id = books[-1].id
+                documents = [book_document(book) for book in books]
+                terms = []
+                for document in documents:
+                    terms.extend(document_terms(document))
+                BookSearchDocument.objects.bulk_create(documents)
+                BookSearchTerm.objects.bulk_create(terms)
+                count += len(books)
+        # Searches cached under the old index are dropped, once it is committed.
+        versions.bump('book')
+        self.stdout.write('Indexed %d books in %.2fs.' % (count, time.time() - start_time))
@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from library.models import LibraryBranch
+from library.stats import rebuild_statistics
+
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = 'Recomputes the library branch statistics from the checkout history.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('--branch', dest='branch', default=None,
+                    help='Only rebuild the statistics of the library branch with this id.'),
+        )
+
+    def handle(self, *args, **options):
+        library_branch = None
+        if options['branch']:
+            try:
+                library_branch = LibraryBranch.objects.get(id=int(options['branch']))
+            except (ValueError, LibraryBranch.DoesNotExist):
+                raise CommandError('Library branch "%s" does not exist.' % options['branch'])
+
+        start_time = time.time()
+        with transaction.commit_on_success():
+            rebuild_statistics(library_branch)
+        self.stdout.write('Rebuilt statistics in %.2fs.' % (time.time() - start_time))
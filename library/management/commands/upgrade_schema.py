@@ -0,0 +1,141 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max, get_app, get_models
+
+from library.models import BookCopy, BookCopyCheckout
+
+from optparse import make_option
+import time
+
+class Command(BaseCommand):
+    args = '<none>'
+    help = ('Brings the tables of an existing database up to date with the models. '
+            'syncdb only creates missing tables; this adds the missing columns, '
+            'fills in the ones copied from other tables and creates the missing indexes. '
+            'Running it again does nothing.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch-size', type='int', dest='batch_size', default=10000,
+                    help='Number of rows filled in by each transaction.'),
+        make_option('--dry-run', action='store_true', dest='dry_run', default=False,
+                    help='Print the statements without running them.'),
+        )
+
+    def handle(self, *args, **options):
+        if options['batch_size'] < 1:
+            raise CommandError('--batch-size must be positive.')
+        self.dry_run = options['dry_run']
+        self.verbosity = int(options.get('verbosity', 1))
+        cursor = connection.cursor()
+        tables = set(connection.introspection.table_names(cursor))
+        # Missing tables are left to syncdb.
+        models = [model for model in get_models(get_app('library'))
+                  if model._meta.db_table in tables]
+
+        for model in models:
+            for statement in self.sql_add_columns(cursor, model):
+                self.run_sql(cursor, statement)
+        # The rows are filled in before the indexes exist, so the updates
+        # do not have to maintain them.
+        self.backfill_checkout_branches(cursor, options['batch_size'])
+        for model in models:
+            for statement in self.sql_add_indexes(cursor, model):
+                self.run_sql(cursor, statement)
+
+    def run_sql(self, cursor, statement, params=()):
+        """
+        Run a statement in its own transaction, or only print it with --dry-run.
+        @return int, the number of rows changed
+        """
+        if self.dry_run:
+            self.stdout.write(statement)
+            return 0
+        start_time = time.time()
+        with transaction.commit_on_success():
+            cursor.execute(statement, params)
+        if self.verbosity > 1:
+            self.stdout.write('%s (%.2fs)' % (statement, time.time() - start_time))
+        return cursor.rowcount
+
+    def sql_add_columns(self, cursor, model):
+        """
+        @return Array<string>, ALTER TABLE statements adding the columns of a
+        model that are missing from its table
+        """
+        qn = connection.ops.quote_name
+        table = model._meta.db_table
+        columns = set(row[0] for row in
+                      connection.introspection.get_table_description(cursor, table))
+        output = []
+        for field in model._meta.local_fields:
+            db_type = field.db_type(connection=connection)
+            if field.column in columns or db_type is None:
+                continue
+            if not field.null:
+                raise CommandError('Cannot add the column %s.%s to existing rows, '
+                                   'it is not nullable.' % (table, field.column))
+            # Foreign key constraints are not added to existing tables.
+            output.append('ALTER TABLE %s ADD COLUMN %s %s NULL;' % (
+                    qn(table), qn(field.column), db_type))
+        return output
+
+    def sql_add_indexes(self, cursor, model):
+        """
+        @return Array<string>, CREATE INDEX statements for the indexes of a
+        model that are missing from its table
+        """
+        existing = self.index_names(cursor, model._meta.db_table)
+        output = []
+        for statement in connection.creation.sql_indexes_for_model(model, no_style()):
+            # CREATE INDEX <quoted name> ON ...
+            name = statement.split()[2].strip('`"')
+            if name not in existing:
+                output.append(statement)
+        return output
+
+    def index_names(self, cursor, table):
+        """
+        @return set<string>, the names of the indexes of a table
+        """
+        vendor = connection.vendor
+        if vendor == 'mysql':
+            cursor.execute('SHOW INDEX FROM %s' % connection.ops.quote_name(table))
+            return set(row[2] for row in cursor.fetchall())
+        elif vendor == 'sqlite':
+            cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                           "AND tbl_name = %s", [table])
+        elif vendor == 'postgresql':
+            cursor.execute('SELECT indexname FROM pg_indexes WHERE tablename = %s', [table])
+        else:
+            raise CommandError('Cannot list the indexes of a %s database.' % vendor)
+        return set(row[0] for row in cursor.fetchall())
+
+    def backfill_checkout_branches(self, cursor, batch_size):
+        """
+        Copy the library branch of each book copy to its checkouts that do
+        not have it yet, one range of checkout ids at a time.
+        """
+        if self.dry_run:
+            return
+        qn = connection.ops.quote_name
+        statement = ('UPDATE %(checkout)s SET %(branch)s = '
+                     '(SELECT %(bookcopy)s.%(branch)s FROM %(bookcopy)s '
+                     'WHERE %(bookcopy)s.%(id)s = %(checkout)s.%(bookcopy_id)s) '
+                     'WHERE %(checkout)s.%(id)s > %%s AND %(checkout)s.%(id)s <= %%s '
+                     'AND %(checkout)s.%(branch)s IS NULL' % {
+                'checkout' : qn(BookCopyCheckout._meta.db_table),
+                'bookcopy' : qn(BookCopy._meta.db_table),
+                'branch' : qn('library_branch_id'),
+                'bookcopy_id' : qn('bookcopy_id'),
+                'id' : qn('id'),
+                })
+        start_time = time.time()
+        total = 0
+        last_id = BookCopyCheckout.objects.aggregate(last_id=Max('id'))['last_id'] or 0
+        for first_id in range(0, last_id, batch_size):
+            total += self.run_sql(cursor, statement, [first_id, first_id + batch_size])
+        elapsed = time.time() - start_time
+        if total:
+            self.stdout.write('Filled in the branch of %d checkouts in %.2fs (%.0f rows/s).' % (
+                    total, elapsed, total / max(elapsed, 0.001)))
@@ -0,0 +1,71 @@
+"""
+Middleware that measures the SQL queries and time spent on each request.
+
+A sample of the requests, QUERY_STATS_SAMPLE_RATE of them, is measured.
+Their query count, rows fetched, database time, view time and template
+rendering time are sent back in X-* response headers and added to the
+in-memory totals in request_stats, which staff can read from the
+'admin_query_stats' view.  With a sample rate of 0 the middleware removes
+itself when it is loaded, so it costs nothing.
+"""
+
+import random
+from time import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+from .instrumentation import RequestStats, record_queries, record_rendering
+
+# The totals of the measured requests of this process, by view.
+request_stats = RequestStats()
+
+
+class QueryStatsMiddleware(object):
+    def __init__(self):
+        self.sample_rate = getattr(settings, 'QUERY_STATS_SAMPLE_RATE', 0)
+        if self.sample_rate <= 0:
+            raise MiddlewareNotUsed()
+
+    def process_request(self, request):
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return None
+        queries = record_queries(connection)
+        rendering = record_rendering()
+        request._query_stats = (queries, queries.__enter__(),
+                                rendering, rendering.__enter__())
+        request._query_stats_view = None
+        request._query_stats_start = time()
+        return None
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        if hasattr(request, '_query_stats'):
+            request._query_stats_view = '%s.%s' % (view_func.__module__, view_func.__name__)
+            request._query_stats_start = time()
+        return None
+
+    def process_response(self, request, response):
+        if not hasattr(request, '_query_stats'):
+            return response
+        view_time = time() - request._query_stats_start
+        queries, query_stats, rendering, render_timer = request._query_stats
+        del request._query_stats
+        rendering.__exit__(None, None, None)
+        queries.__exit__(None, None, None)
+
+        metrics = {
+            'queries' : query_stats.count,
+            'rows' : query_stats.rows,
+            'db_ms' : query_stats.time * 1000.0,
+            'view_ms' : view_time * 1000.0,
+            'render_ms' : render_timer.time * 1000.0,
+            }
+        response['X-Query-Count'] = str(metrics['queries'])
+        response['X-Rows-Fetched'] = str(metrics['rows'])
+        response['X-DB-Time-Ms'] = '%.3f' % metrics['db_ms']
+        response['X-View-Time-Ms'] = '%.3f' % metrics['view_ms']
+        response['X-Render-Time-Ms'] = '%.3f' % metrics['render_ms']
+        if request._query_stats_view:
+            request_stats.add(request._query_stats_view, **metrics)
+        return response
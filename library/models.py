@@ -1,8 +1,11 @@
 from datetime import date, datetime, timedelta
 
 from django.db import models
+from django.db.models import Q
 from django.contrib.auth.models import User
 
+from . import fines, signals
+
 # Create your models here.
 
 class Author(models.Model):
@@ -28,6 +31,39 @@ class Book(models.Model):
     publication_date = models.DateField()
     authors = models.ManyToManyField(Author)
 
+class BookSearchDocument(models.Model):
+    """
+    The searchable text of a book, denormalized from its publisher and
+    authors.  The BookSearchTerm rows of a book are built from it.
+    """
+    book = models.OneToOneField(Book, primary_key=True)
+    title = models.CharField(max_length=200)
+    isbn = models.CharField(max_length=13)
+    publisher_name = models.CharField(max_length=200)
+    # The names of all authors, one per line.
+    author_names = models.TextField()
+
+class BookSearchTerm(models.Model):
+    """
+    An entry of the inverted index used to search for books.  Each word of
+    a book's search document is stored lowercase, so a search is an indexed
+    prefix lookup on 'term'.  See library.search.
+    """
+    FIELD_CHOICES = (
+        ('title', 'Title'),
+        ('isbn', 'ISBN'),
+        ('author', 'Author'),
+        ('publisher', 'Publisher'))
+
+    book = models.ForeignKey(Book)
+    field = models.CharField(max_length=10, choices=FIELD_CHOICES)
+    term = models.CharField(max_length=40)
+    # How much a match on this term adds to the rank of the book.
+    weight = models.IntegerField()
+
+    class Meta:
+        index_together = [['term', 'field']]
+
 class LibraryBranch(models.Model):
     """
     A building that holds and keeps track of books.
@@ -42,6 +78,75 @@ class Reader(models.Model):
     user = models.ForeignKey(User, unique=True)
     address = models.TextField()
     phone_number = models.CharField(max_length=20)
+    # The branch the reader usually visits, suggested first when a book
+    # is not available, see library.finder.
+    home_branch = models.ForeignKey(LibraryBranch, null=True, blank=True)
+
+def reserve_expire_date(reserve_date):
+    """
+    Find when a reservation expires, which is 6PM the day of the
+    reservation, or 6PM the next day if it was made after 6PM.
+    @param reserve_date:datetime
+    @return datetime
+    """
+    expire_date = datetime(tzinfo=reserve_date.tzinfo,
+        year=reserve_date.year, month=reserve_date.month,
+        day=reserve_date.day, hour=18)
+    if reserve_date.hour >= expire_date.hour:
+        expire_date = expire_date + timedelta(days=1)
+    return expire_date
+
+def reserve_cutoff_date(now):
+    """
+    Find the most recent 6PM strictly before 'now'.  Every reservation made
+    before this moment has expired, and none made at or after it have.
+    @param now:datetime in the same time zone as the stored dates (UTC)
+    @return datetime
+    """
+    cutoff_date = now.replace(hour=18, minute=0, second=0, microsecond=0)
+    if cutoff_date >= now:
+        cutoff_date = cutoff_date - timedelta(days=1)
+    return cutoff_date
+
+class BookNotAvailable(ValueError):
+    """
+    Raised when a book copy is borrowed or reserved by someone else.
+    """
+    pass
+
+class BookCopyManager(models.Manager):
+    """
+    Table level operations on BookCopy rows.
+    """
+    def expired_reservations(self, now):
+        """
+        Select the copies whose current_checkout is an expired reservation.
+        @return QuerySet<BookCopy>
+        """
+        return self.filter(current_checkout__borrow_date__isnull=True,
+                           current_checkout__reserve_date__lt=reserve_cutoff_date(now))
+
+    def expire_reservations(self, now, **filters):
+        """
+        Clear expired reservations with a single UPDATE statement.  The
+        copies are locked and read first, so they can be reserved for the
+        readers waiting for their books, or else counted as available again.
+        @param filters: optional lookups narrowing the copies, e.g. id__in
+        @return int, the number of book copies made available
+        """
+        bookcopies = list(self.expired_reservations(now).filter(**filters)
+                          .select_for_update().values_list('id', 'book', 'library_branch'))
+        if not bookcopies:
+            return 0
+        count = self.expired_reservations(now) \
+            .filter(id__in=[bookcopy_id for bookcopy_id, book_id, library_branch_id
+                            in bookcopies]) \
+            .update(current_checkout=None)
+        # The copies of books with a queue go to the next reader waiting.
+        bookcopies = holds.allocate_copies(bookcopies, now)
+        availability.copies_returned([(book_id, library_branch_id) for bookcopy_id, book_id,
+                                      library_branch_id in bookcopies])
+        return count
 
 class BookCopy(models.Model):
     """
@@ -60,20 +165,29 @@ class BookCopy(models.Model):
     # Meta-options of the model.
     unique_together = ('book', 'library_branch', 'copy_number')
 
+    objects = BookCopyManager()
+
+    def live_checkout(self, now):
+        """
+        Find the current_checkout if it still determines the status of the
+        book.  An expired reservation is ignored rather than erased, so
+        reading the status never writes to the database.
+        @return BookCopyCheckout | None
+        """
+        checkout = self.current_checkout
+        if checkout == None or not checkout.is_current(now):
+            return None
+        return checkout
+
     def is_available(self, user, now):
         """
         Determine if a book is currenty available for checkout.
         """
-        checkout = self.current_checkout
+        checkout = self.live_checkout(now)
         if checkout == None:
             return True
-        if not checkout.is_current(now):
-            # Erase the current_checkout if it is no longer valid.
-            self.current_checkout = None
-            self.save()
-            return True
         # At this point, there must be a checkout that is current.
-        if checkout.reserve_date and checkout.user == user and not checkout.borrow_date:
+        if checkout.reserve_date and checkout.user_id == user.id and not checkout.borrow_date:
             # The user may borrow a book they have reserved.
             return True
         return False
@@ -83,65 +197,104 @@ class BookCopy(models.Model):
         Determine if a book is currenty available to borrow.
         """
         checkout = self.current_checkout
-        if self.is_available(user, now):
-            if checkout and checkout.reserve_date:
-                return 'reserved (mine)'
-            else:
-                return 'available'
-        # If the book is not available, then there is a current_checkout.
-        if checkout.borrow_date:
-            if checkout.user == user:
-                return 'borrowed (mine)'
-            else:
-                return 'borrowed'
-        if checkout.reserve_date:
-            return 'reserved'
-        raise ValueError("BookCopy current_checkout in bad state!")
+        if checkout == None:
+            return 'available'
+        return checkout.status(user, now)
 
     def do_borrow(self, user, now):
         """
         Update records for a user to borrow a book.
         """
         if not self.is_available(user, now):
-            raise ValueError("Book is not available!")
-        if self.current_checkout and self.current_checkout.user == user:
+            raise BookNotAvailable("Book is not available!")
+        checkout = self.live_checkout(now)
+        if checkout and checkout.user_id == user.id:
             # Checkout exists (a reservation), so update it.
-            self.current_checkout.borrow_date = now
-            self.current_checkout.save()
+            checkout.borrow_date = now
+            checkout.save()
         else:
             # Create a new checkout.
-            checkout = BookCopyCheckout(user=user, bookcopy=self, borrow_date=now)
+            if self.current_checkout_id is None:
+                availability.copy_taken(self)
+            checkout = BookCopyCheckout(user=user, bookcopy=self,
+                                        library_branch_id=self.library_branch_id,
+                                        borrow_date=now)
             checkout.save()
             self.current_checkout = checkout
-            self.save()
+            self.save(update_fields=['current_checkout'])
+        holds.claim_holds(user, self.book_id)
+        versions.bump_bookcopies([self.id])
 
     def do_reserve(self, user, now):
         """
         Update records for a user to reserve a book.
         """
         if not self.is_available(user, now):
-            raise ValueError("Book is not available!")
-        if self.current_checkout and self.current_checkout.user == user:
-            self.current_checkout.reserve_date = now
-            self.current_checkout.save()
+            raise BookNotAvailable("Book is not available!")
+        checkout = self.live_checkout(now)
+        if checkout and checkout.user_id == user.id:
+            checkout.reserve_date = now
+            checkout.save()
         else:
-            checkout = BookCopyCheckout(user=user, bookcopy=self, reserve_date=now)
+            if self.current_checkout_id is None:
+                availability.copy_taken(self)
+            checkout = BookCopyCheckout(user=user, bookcopy=self,
+                                        library_branch_id=self.library_branch_id,
+                                        reserve_date=now)
             checkout.save()
             self.current_checkout = checkout
-            self.save()
+            self.save(update_fields=['current_checkout'])
+        holds.claim_holds(user, self.book_id)
+        versions.bump_bookcopies([self.id])
 
     def do_return(self, user, now):
         """
         Update records for a user to return a book.
         """
         if self.current_checkout and self.current_checkout.borrow_date:
-            self.current_checkout.return_date = now
-            self.current_checkout.save()
-            self.current_checkout = None
-            self.save()
+            checkout = self.current_checkout
+            checkout.return_date = now
+            checkout.save()
+            # The first reader waiting for the book gets the copy reserved.
+            self.current_checkout = holds.allocate_copy(self.id, self.book_id,
+                                                        self.library_branch_id, now)
+            self.save(update_fields=['current_checkout'])
+            if self.current_checkout is None:
+                availability.copy_returned(self)
+            versions.bump_bookcopies([self.id])
+            signals.checkout_returned.send(sender=BookCopyCheckout, checkout=checkout)
         else:
             raise ValueError("Book was not borrowed!")
 
+# A reader may not have more books than this borrowed or reserved at a time.
+MAX_ACTIVE_CHECKOUTS = 10
+
+class BookCopyCheckoutManager(models.Manager):
+    """
+    Table level operations on BookCopyCheckout rows.
+    """
+    def active(self, user, now):
+        """
+        Select the checkouts of a user that are current, the same rows for
+        which is_current() is true, using the (user, return_date) index.
+        @return QuerySet<BookCopyCheckout>
+        """
+        return self.filter(user=user, return_date__isnull=True) \
+            .filter(Q(borrow_date__isnull=False) |
+                    Q(reserve_date__gte=reserve_cutoff_date(now)))
+
+    def active_count(self, user, now, lock=False):
+        """
+        Count the books a user currently has borrowed or reserved.
+        @param lock:bool, lock the checkouts counted, so that inside a
+               transaction they are read as last committed rather than from
+               its snapshot
+        @return int
+        """
+        if lock:
+            return len(self.active(user, now).select_for_update().values_list('id', flat=True))
+        return self.active(user, now).count()
+
 class BookCopyCheckout(models.Model):
     """
     Separate information describing a book being checked out.
@@ -149,10 +302,26 @@ class BookCopyCheckout(models.Model):
     # Information about who/when the book was borrowed.
     user = models.ForeignKey(User)
     bookcopy = models.ForeignKey(BookCopy)
+    # The branch of the book copy, copied when the checkout is made so the
+    # branch statistics need no join.  The (library_branch, ...) index below
+    # serves its foreign key too.
+    library_branch = models.ForeignKey(LibraryBranch, null=True, db_index=False)
     reserve_date = models.DateTimeField(null=True)
     borrow_date = models.DateTimeField(null=True)
     return_date = models.DateTimeField(null=True)
 
+    objects = BookCopyCheckoutManager()
+
+    class Meta:
+        index_together = [
+            # Finds unborrowed reservations older than a cutoff date.
+            ['borrow_date', 'reserve_date'],
+            # Finds the unreturned checkouts of a user.
+            ['user', 'return_date'],
+            # Finds the books still out at a branch, borrowed before a date.
+            ['library_branch', 'return_date', 'borrow_date'],
+            ]
+
     def is_current(self, now):
         """
         Determine if a checkout 'current' at a particular time.
@@ -166,18 +335,32 @@ class BookCopyCheckout(models.Model):
             return True
         elif self.reserve_date:
             # See if the reserve has expired (6PM the day of the reservation).
-            reserve_expire_date = datetime(tzinfo=self.reserve_date.tzinfo,
-                year=self.reserve_date.year, month=self.reserve_date.month,
-                day=self.reserve_date.day, hour=18)
-            if self.reserve_date.hour >= reserve_expire_date.hour:
-                reserve_expire_date = reserve_expire_date + timedelta(days=1)
-            if now > reserve_expire_date:
-                return False
-            else:
-                return True
+            return now <= reserve_expire_date(self.reserve_date)
         # No date information at all.
         return False
 
+    def status(self, user, now):
+        """
+        Describe the status of the book copy this checkout belongs to,
+        as seen by a particular user.  Only the stored dates are used, so
+        no queries are made.
+        @return string
+        """
+        if not self.is_current(now):
+            return 'available'
+        mine = self.user_id == user.id
+        if self.borrow_date:
+            if mine:
+                return 'borrowed (mine)'
+            else:
+                return 'borrowed'
+        if self.reserve_date:
+            if mine:
+                return 'reserved (mine)'
+            else:
+                return 'reserved'
+        raise ValueError("BookCopy current_checkout in bad state!")
+
     def get_fine(self, now):
         """
         If a fine is applicable, compute it as a floating point number.
@@ -185,10 +368,94 @@ class BookCopyCheckout(models.Model):
         None is returned.
         @return Float | None
         """
-        if self.borrow_date:
-            return_by_date = self.borrow_date + timedelta(days=20)
-            if now > return_by_date:
-                return (20 * (now - return_by_date).days) / 100.0
-        return None
+        return fines.get_fine(self.borrow_date, now)
+
+
+class BookHold(models.Model):
+    """
+    A reader's place in the queue for a book, waiting for any of its
+    copies.  The queue of a book is its waiting holds in the order of
+    their ids.  Maintained by library.holds.
+    """
+    STATUS_CHOICES = (
+        ('waiting', 'Waiting'),
+        # A returned copy was reserved for the reader.
+        ('ready', 'Ready'),
+        # The reader borrowed or reserved a copy of the book.
+        ('claimed', 'Claimed'),
+        # The reserved copy was not borrowed in time.
+        ('expired', 'Expired'))
+
+    book = models.ForeignKey(Book, db_index=False)
+    user = models.ForeignKey(User, db_index=False)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default='waiting')
+    hold_date = models.DateTimeField()
+    # The copy reserved for the reader, and when.
+    bookcopy = models.ForeignKey(BookCopy, null=True, db_index=False)
+    checkout = models.ForeignKey(BookCopyCheckout, null=True, db_index=False)
+    ready_date = models.DateTimeField(null=True)
+
+    class Meta:
+        index_together = [
+            # Finds the first waiting hold of a book, and the place of a hold.
+            ['book', 'status', 'id'],
+            # Finds the holds of a user.
+            ['user', 'status'],
+            # Finds the ready holds that were not claimed before a cutoff date.
+            ['status', 'ready_date'],
+            ]
+
+
+class BranchBorrowerStatistic(models.Model):
+    """
+    The number of checkouts a user has made at a library branch.
+    Maintained by library.stats.
+    """
+    library_branch = models.ForeignKey(LibraryBranch)
+    user = models.ForeignKey(User)
+    checkout_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('library_branch', 'user')
+        index_together = [['library_branch', 'checkout_count']]
+
+class BranchBookStatistic(models.Model):
+    """
+    The number of times a book has been checked out at a library branch.
+    Maintained by library.stats.
+    """
+    library_branch = models.ForeignKey(LibraryBranch)
+    book = models.ForeignKey(Book)
+    checkout_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('library_branch', 'book')
+        index_together = [['library_branch', 'checkout_count']]
+
+class BranchFineStatistic(models.Model):
+    """
+    Totals of the returned books that were late at a library branch.
+    Books still out are added when the average is computed, since their
+    fine grows every day.  Maintained by library.stats.
+    """
+    library_branch = models.OneToOneField(LibraryBranch, primary_key=True)
+    late_count = models.IntegerField(default=0)
+    late_days = models.IntegerField(default=0)
+
+class BookAvailability(models.Model):
+    """
+    The number of copies of a book at a library branch, and how many of
+    them have no current checkout.  Maintained by library.availability.
+    """
+    book = models.ForeignKey(Book)
+    library_branch = models.ForeignKey(LibraryBranch)
+    copy_count = models.IntegerField(default=0)
+    available_count = models.IntegerField(default=0)
+
+    class Meta:
+        unique_together = ('book', 'library_branch')
 
 
+# Keep the search index, statistics, availability counts, hold queues and
+# cache versions up to date when models are saved.
+from . import availability, holds, search, stats, versions
@@ -0,0 +1,202 @@
+"""
+Searching the catalog through an inverted index of book words.
+
+Each book has a BookSearchDocument holding its title, ISBN, publisher name
+and author names.  The words of the document are kept in the BookSearchTerm
+table, and both are updated whenever a Book, Author or Publisher is saved.
+A search on any combination of fields is then a prefix lookup on a single
+indexed column, grouped by book and ranked by the weight of the matching
+words, instead of '%q%' scans of several joined tables.
+"""
+
+import re
+
+from django.db.models import Q, Sum
+from django.db.models.signals import m2m_changed, post_save
+
+from .models import Author, Book, BookSearchDocument, BookSearchTerm, Publisher
+
+# The amount a matching word adds to the rank of a book, by field.
+FIELD_WEIGHTS = {
+    'isbn' : 4,
+    'title' : 3,
+    'author' : 2,
+    'publisher' : 1,
+    }
+
+# The most books a single search returns.  The ranked books are listed in
+# a CASE expression, which must stay within the query parameter limits of
+# the databases, so reader_bookcopy tells the reader when a search was cut.
+SEARCH_LIMIT = 200
+
+# Words longer than this are cut to fit BookSearchTerm.term.
+TERM_LENGTH = 40
+
+
+def tokenize(text):
+    """
+    Split text into lowercase words.
+    @param text:string
+    @return Array<string>
+    """
+    return [word[0:TERM_LENGTH] for word in re.findall(r'\w+', text.lower(), re.UNICODE)]
+
+
+def book_document(book):
+    """
+    Build the search document of a book.
+    @param book:Book
+    @return BookSearchDocument, unsaved
+    """
+    return BookSearchDocument(
+        book=book, title=book.title, isbn=book.isbn,
+        publisher_name=book.publisher.name,
+        author_names='\n'.join(author.name for author in book.authors.all()))
+
+
+def document_terms(document):
+    """
+    Build the index entries for a search document.
+    @param document:BookSearchDocument
+    @return Array<BookSearchTerm>
+    """
+    texts = [
+        ('title', document.title),
+        ('isbn', document.isbn),
+        ('publisher', document.publisher_name),
+        ('author', document.author_names)]
+    terms = {}
+    for field, text in texts:
+        for word in tokenize(text):
+            terms[(field, word)] = BookSearchTerm(
+                book_id=document.book_id, field=field, term=word,
+                weight=FIELD_WEIGHTS[field])
+    return terms.values()
+
+
+def same_document(document, other):
+    """
+    Determine if two search documents hold the same text.
+    @return bool
+    """
+    return (document.title == other.title and
+            document.isbn == other.isbn and
+            document.publisher_name == other.publisher_name and
+            document.author_names == other.author_names)
+
+
+def index_book(book):
+    """
+    Update the search document of a book and, if its text changed, the
+    index entries built from it.
+    @param book:Book
+    """
+    document = book_document(book)
+    try:
+        if same_document(document, BookSearchDocument.objects.get(book=book)):
+            return
+    except BookSearchDocument.DoesNotExist:
+        pass
+    document.save()
+    BookSearchTerm.objects.filter(book=book).delete()
+    BookSearchTerm.objects.bulk_create(document_terms(document))
+
+
+def normalize_isbn(query):
+    """
+    Strip the separators people type in an ISBN.
+    @return string
+    """
+    return re.sub(r'[\s-]', '', query).upper()
+
+
+def search_books(query, field=None, limit=SEARCH_LIMIT):
+    """
+    Find the books matching a query, best matches first.
+    Every word of the query is matched as a prefix of the indexed words.
+    An ISBN is first looked up exactly, then as a prefix, using the unique
+    index on Book.isbn.
+    @param query:string
+    @param field:string | None, one of FIELD_WEIGHTS to restrict the
+                 search to, None to search them all
+    @return Array<int>, ids of the matching books
+    """
+    if field == 'isbn':
+        isbn = normalize_isbn(query)
+        if not isbn:
+            return []
+        book_ids = list(Book.objects.filter(isbn=isbn).values_list('id', flat=True))
+        if not book_ids:
+            book_ids = list(Book.objects.filter(isbn__istartswith=isbn)
+                            .order_by('isbn').values_list('id', flat=True)[:limit])
+        return book_ids
+
+    if field is None:
+        # A query that is exactly an ISBN names a single book.
+        book_ids = list(Book.objects.filter(isbn=normalize_isbn(query))
+                        .values_list('id', flat=True))
+        if book_ids:
+            return book_ids
+
+    words = set(tokenize(query))
+    if not words:
+        return []
+    match = Q()
+    for word in words:
+        match |= Q(term__istartswith=word)
+    term_set = BookSearchTerm.objects.filter(match)
+    if field:
+        term_set = term_set.filter(field=field)
+    ranking = term_set.values('book') \
+        .annotate(rank=Sum('weight')) \
+        .order_by('-rank', 'book')[:limit]
+    return [row['book'] for row in ranking]
+
+
+def rank_bookcopies(bookcopy_set, book_ids):
+    """
+    Restrict a BookCopy QuerySet to the given books, ordered like the list.
+    The rank is exposed as the extra column 'search_rank'.
+    @param bookcopy_set:QuerySet<BookCopy>
+    @param book_ids:Array<int>, as returned by search_books()
+    @return QuerySet<BookCopy>
+    """
+    if not book_ids:
+        return bookcopy_set.none()
+    cases = ' '.join(['WHEN %s THEN %d' % ('%s', rank) for rank in range(0, len(book_ids))])
+    return bookcopy_set.filter(book__in=book_ids).extra(
+        select={'search_rank' : 'CASE library_bookcopy.book_id %s END' % cases},
+        select_params=book_ids,
+        order_by=['search_rank', 'id'])
+
+
+def book_saved(sender, instance, **kwargs):
+    index_book(instance)
+
+def book_authors_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    if not reverse:
+        if action.startswith('post_'):
+            index_book(instance)
+    elif action == 'pre_clear':
+        # The books of an author are about to be removed, remember them.
+        instance._search_book_ids = list(instance.book_set.values_list('id', flat=True))
+    elif action.startswith('post_'):
+        if action == 'post_clear':
+            pk_set = instance._search_book_ids
+        for book in Book.objects.filter(pk__in=pk_set):
+            index_book(book)
+
+def author_saved(sender, instance, created, **kwargs):
+    if not created:
+        for book in instance.book_set.all():
+            index_book(book)
+
+def publisher_saved(sender, instance, created, **kwargs):
+    if not created:
+        for book in instance.book_set.all():
+            index_book(book)
+
+post_save.connect(book_saved, sender=Book)
+m2m_changed.connect(book_authors_changed, sender=Book.authors.through)
+post_save.connect(author_saved, sender=Author)
+post_save.connect(publisher_saved, sender=Publisher)
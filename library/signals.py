@@ -0,0 +1,8 @@
+"""
+Signals sent when the checkout state of book copies changes.
+"""
+
+from django.dispatch import Signal
+
+# Sent by BookCopy.do_return after the checkout has been saved.
+checkout_returned = Signal(providing_args=['checkout'])
@@ -0,0 +1,175 @@
+"""
+Per-branch statistics, kept up to date as books are checked out.
+
+Every new BookCopyCheckout adds one to the counters of its user and its
+book at the branch, and every late return adds to the fine totals of the
+branch.  The statistics page then reads the top rows of an index instead
+of grouping the whole checkout history.  rebuild_statistics() recomputes
+everything from the history, e.g. with the 'rebuild_statistics' command.
+"""
+
+from datetime import timedelta
+
+from django.db.models import Count, F
+from django.db.models.signals import post_save
+
+from .fines import FINE_FREE_DAYS, fine_for_days, late_days, late_totals
+from .models import (BookCopyCheckout, BranchBookStatistic,
+                     BranchBorrowerStatistic, BranchFineStatistic)
+from .signals import checkout_returned
+
+# The number of rows shown for the top borrowers and books.
+TOP_COUNT = 10
+
+# The number of checkouts read at a time when rebuilding the fine totals.
+REBUILD_BATCH_SIZE = 10000
+
+
+def increment(model, count_field, **keys):
+    """
+    Add one to a counter row, creating the row if needed.
+    """
+    statistic, created = model.objects.get_or_create(**keys)
+    model.objects.filter(pk=statistic.pk).update(**{count_field : F(count_field) + 1})
+
+
+def record_checkout(checkout):
+    """
+    Count a new checkout towards the statistics of its branch.
+    @param checkout:BookCopyCheckout with its bookcopy
+    """
+    increment(BranchBorrowerStatistic, 'checkout_count',
+              library_branch_id=checkout.library_branch_id, user_id=checkout.user_id)
+    increment(BranchBookStatistic, 'checkout_count',
+              library_branch_id=checkout.library_branch_id, book_id=checkout.bookcopy.book_id)
+
+
+def record_return(checkout):
+    """
+    Add a returned checkout to the fine totals of its branch, if it was late.
+    @param checkout:BookCopyCheckout
+    """
+    days = late_days(checkout.borrow_date, checkout.return_date)
+    if days > 0:
+        statistic, created = BranchFineStatistic.objects.get_or_create(
+            library_branch_id=checkout.library_branch_id)
+        BranchFineStatistic.objects.filter(pk=statistic.pk).update(
+            late_count=F('late_count') + 1, late_days=F('late_days') + days)
+
+
+def top_borrowers(library_branch):
+    """
+    @return Array<(string, int)>, username and number of checkouts
+    """
+    return BranchBorrowerStatistic.objects \
+        .filter(library_branch=library_branch) \
+        .order_by('-checkout_count') \
+        .values_list('user__username', 'checkout_count')[:TOP_COUNT]
+
+
+def top_books(library_branch):
+    """
+    @return Array<(string, int)>, book title and number of checkouts
+    """
+    return BranchBookStatistic.objects \
+        .filter(library_branch=library_branch) \
+        .order_by('-checkout_count') \
+        .values_list('book__title', 'checkout_count')[:TOP_COUNT]
+
+
+def average_fine(library_branch, now):
+    """
+    Average the fines of the late checkouts at a branch, counting books
+    that are still out as if they were returned now.
+    @return float, in dollars
+    """
+    try:
+        statistic = BranchFineStatistic.objects.get(library_branch=library_branch)
+        count, days = statistic.late_count, statistic.late_days
+    except BranchFineStatistic.DoesNotExist:
+        count, days = 0, 0
+    # Only books still out for longer than the free period are late.
+    borrow_dates = list(BookCopyCheckout.objects
+        .filter(library_branch=library_branch, return_date__isnull=True,
+                borrow_date__lte=now - timedelta(days=FINE_FREE_DAYS + 1))
+        .values_list('borrow_date', flat=True))
+    out_count, out_days = late_totals(borrow_dates, [now] * len(borrow_dates))
+    count += out_count
+    days += out_days
+    if count == 0:
+        return 0.0
+    return fine_for_days(days) / count
+
+
+def rebuild_statistics(library_branch=None):
+    """
+    Recompute the statistics of one or all branches from the checkout history.
+    @param library_branch:LibraryBranch | None
+    """
+    checkout_set = BookCopyCheckout.objects.all()
+    borrower_set = BranchBorrowerStatistic.objects.all()
+    book_set = BranchBookStatistic.objects.all()
+    fine_set = BranchFineStatistic.objects.all()
+    if library_branch:
+        checkout_set = checkout_set.filter(library_branch=library_branch)
+        borrower_set = borrower_set.filter(library_branch=library_branch)
+        book_set = book_set.filter(library_branch=library_branch)
+        fine_set = fine_set.filter(library_branch=library_branch)
+    borrower_set.delete()
+    book_set.delete()
+    fine_set.delete()
+
+    BranchBorrowerStatistic.objects.bulk_create([
+            BranchBorrowerStatistic(library_branch_id=branch_id, user_id=user_id,
+                                    checkout_count=count)
+            for branch_id, user_id, count in checkout_set
+            .values_list('library_branch', 'user')
+            .annotate(count=Count('id')).order_by()])
+    BranchBookStatistic.objects.bulk_create([
+            BranchBookStatistic(library_branch_id=branch_id, book_id=book_id,
+                                checkout_count=count)
+            for branch_id, book_id, count in checkout_set
+            .values_list('library_branch', 'bookcopy__book')
+            .annotate(count=Count('id')).order_by()])
+
+    fines = {}
+    def add_fines(branch_id, borrow_dates, return_dates):
+        count, total = fines.get(branch_id, (0, 0))
+        late_count, days = late_totals(borrow_dates, return_dates)
+        fines[branch_id] = (count + late_count, total + days)
+
+    # Compute the fines of the returned checkouts one batch at a time.
+    batch = {}
+    batch_size = 0
+    for branch_id, borrow_date, return_date in checkout_set \
+            .filter(borrow_date__isnull=False, return_date__isnull=False) \
+            .values_list('library_branch', 'borrow_date', 'return_date') \
+            .iterator():
+        borrow_dates, return_dates = batch.setdefault(branch_id, ([], []))
+        borrow_dates.append(borrow_date)
+        return_dates.append(return_date)
+        batch_size += 1
+        if batch_size >= REBUILD_BATCH_SIZE:
+            for branch_id, dates in batch.items():
+                add_fines(branch_id, *dates)
+            batch = {}
+            batch_size = 0
+    for branch_id, dates in batch.items():
+        add_fines(branch_id, *dates)
+
+    BranchFineStatistic.objects.bulk_create([
+            BranchFineStatistic(library_branch_id=branch_id, late_count=count,
+                                late_days=total)
+            for branch_id, (count, total) in fines.items()
+            if count > 0])
+
+
+def checkout_saved(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        record_checkout(instance)
+
+def checkout_was_returned(sender, checkout, **kwargs):
+    record_return(checkout)
+
+post_save.connect(checkout_saved, sender=BookCopyCheckout)
+checkout_returned.connect(checkout_was_returned, sender=BookCopyCheckout)
@@ -5,7 +5,38 @@ when you run "manage.py test".
 Replace this with more appropriate tests for your application.
 """
 
-from django.test import TestCase
+from datetime import date, datetime, timedelta
+from StringIO import StringIO
+import codecs
+import json
+import os
+import pytz
+import tempfile
+import threading
+import zlib
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management.base import CommandError
+from django.core.urlresolvers import reverse
+from django.db import DatabaseError, connection, connections
+from django.db.models import Sum
+from django.test import TestCase, TransactionTestCase
+from django.test.client import Client
+from django.utils.unittest import skipUnless
+
+from . import (checkout, choices, exports, finder, fines, holds, importers, signals, stats,
+               versions, views)
+from .checkout import checkout_bookcopy
+from .instrumentation import record_queries
+from .middleware import request_stats
+from .listing import KeysetPage, Page
+from .models import (Author, Publisher, Book, BookAvailability, BookHold, BookSearchDocument,
+                     BookSearchTerm, LibraryBranch, Reader, BookCopy, BookCopyCheckout,
+                     BranchBookStatistic, BranchBorrowerStatistic, BranchFineStatistic,
+                     BookNotAvailable, MAX_ACTIVE_CHECKOUTS, reserve_cutoff_date)
+from .search import search_books
 
 
 class SimpleTest(TestCase):
@@ -14,3 +45,1382 @@ class SimpleTest(TestCase):
         Tests that 1 + 1 always equals 2.
         """
         self.assertEqual(1 + 1, 2)
+
+
+def create_catalog(copy_count=1, branch_count=1):
+    """
+    Create a small catalog of book copies for tests.
+    @return (Book, Array<LibraryBranch>, Array<BookCopy>)
+    """
+    publisher = Publisher.objects.create(name="Oxford Press", address="101 Main Drive")
+    book = Book.objects.create(title="Rearing Birds", isbn="9780000000001",
+                               publisher=publisher,
+                               publication_date=date(2001, 1, 1))
+    branches = []
+    for index in range(0, branch_count):
+        branches.append(LibraryBranch.objects.create(
+                name="Texas Main Library %d" % index, address="131 Paso Drive"))
+    bookcopies = []
+    for index in range(0, copy_count):
+        bookcopies.append(BookCopy.objects.create(
+                book=book, library_branch=branches[index % branch_count],
+                copy_number=index, position="P%05d" % index))
+    return book, branches, bookcopies
+
+
+class ReaderBookCopyTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=25)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.client.login(username='reader', password='secret')
+
+    def test_page_slices_in_database(self):
+        page = Page(BookCopy.objects.order_by('id'), 3)
+        self.assertEqual(page.count, 25)
+        self.assertEqual(page.page_count, 3)
+        self.assertEqual([bc.id for bc in page.object_list],
+                         [bc.id for bc in self.bookcopies[20:]])
+
+    def test_page_number_is_clamped(self):
+        page = Page(BookCopy.objects.order_by('id'), 99)
+        self.assertEqual(page.number, 3)
+        page = Page(BookCopy.objects.none(), 1)
+        self.assertEqual(page.page_count, 1)
+
+    def test_reader_bookcopy_page(self):
+        response = self.client.get(reverse('reader_bookcopy'), {'page': '2'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual([row.id for row in response.context['bookcopy_list']],
+                         [bc.id for bc in self.bookcopies[10:20]])
+        self.assertEqual(response.context['page_count'], 3)
+
+    def test_cached_pager_links_keep_the_query(self):
+        # Both searches find the same copies, but link to their own pages.
+        self.client.get(reverse('reader_bookcopy'), {'q' : 'bird', 'by' : 'all'})
+        response = self.client.get(reverse('reader_bookcopy'), {'q' : 'rearing', 'by' : 'title'})
+        self.assertTrue('q=rearing&amp;by=title&amp;page=2' in response.content)
+        self.assertFalse('q=bird' in response.content)
+
+    def test_reader_bookcopy_query_count_is_constant(self):
+        other = User.objects.create_user('other', 'other@example.com', 'secret')
+        now = datetime.now(pytz.utc)
+        for bookcopy in self.bookcopies[0:5]:
+            bookcopy.do_borrow(other, now)
+        self.bookcopies[5].do_reserve(self.user, now)
+        # Session, user, count and one joined query for the rows.
+        with self.assertNumQueries(4):
+            response = self.client.get(reverse('reader_bookcopy'))
+        statuses = [row.status for row in response.context['bookcopy_list']]
+        self.assertEqual(statuses[0:7], ['borrowed'] * 5 + ['reserved (mine)', 'available'])
+
+    def test_reader_mybooks(self):
+        now = datetime.now(pytz.utc)
+        self.bookcopies[3].do_borrow(self.user, now - timedelta(days=25))
+        response = self.client.get(reverse('reader_mybooks'))
+        bookcopy_list = response.context['bookcopy_list']
+        self.assertEqual(len(bookcopy_list), 1)
+        self.assertEqual(bookcopy_list[0]['status'], 'borrowed (mine)')
+        self.assertEqual(bookcopy_list[0]['fine'], '$1.00')
+
+
+class ReservationExpiryTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=3)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+
+    def test_reserve_cutoff_date(self):
+        morning = datetime(2013, 6, 10, 9, 0, tzinfo=pytz.utc)
+        evening = datetime(2013, 6, 10, 19, 0, tzinfo=pytz.utc)
+        self.assertEqual(reserve_cutoff_date(morning),
+                         datetime(2013, 6, 9, 18, 0, tzinfo=pytz.utc))
+        self.assertEqual(reserve_cutoff_date(evening),
+                         datetime(2013, 6, 10, 18, 0, tzinfo=pytz.utc))
+        # The cutoff agrees with the per-checkout expiry rule.
+        for hour in range(0, 24):
+            reserve_date = datetime(2013, 6, 10, hour, 30, tzinfo=pytz.utc)
+            checkout = BookCopyCheckout(reserve_date=reserve_date)
+            for now in [evening, evening + timedelta(days=1)]:
+                self.assertEqual(checkout.is_current(now),
+                                 reserve_date >= reserve_cutoff_date(now))
+
+    def test_status_does_not_write(self):
+        reserve_date = datetime(2013, 6, 10, 9, 0, tzinfo=pytz.utc)
+        self.bookcopies[0].do_reserve(self.user, reserve_date)
+        later = reserve_date + timedelta(days=2)
+        bookcopy = BookCopy.objects.get(id=self.bookcopies[0].id)
+        with self.assertNumQueries(1):
+            # Only the current_checkout is loaded.
+            self.assertEqual(bookcopy.status(self.user, later), 'available')
+            self.assertTrue(bookcopy.is_available(self.user, later))
+        self.assertNotEqual(BookCopy.objects.get(id=bookcopy.id).current_checkout_id, None)
+
+    def test_expire_reservations(self):
+        reserve_date = datetime(2013, 6, 10, 9, 0, tzinfo=pytz.utc)
+        self.bookcopies[0].do_reserve(self.user, reserve_date)
+        self.bookcopies[1].do_reserve(self.user, reserve_date + timedelta(days=2))
+        self.bookcopies[2].do_borrow(self.user, reserve_date)
+        now = reserve_date + timedelta(days=2, hours=1)
+        self.assertEqual(BookCopy.objects.expire_reservations(now), 1)
+        self.assertEqual(
+            list(BookCopy.objects.filter(current_checkout=None).values_list('id', flat=True)),
+            [self.bookcopies[0].id])
+
+    def test_expire_reservations_command(self):
+        other_branch = LibraryBranch.objects.create(name="Vermont City Library",
+                                                    address="802 Atlantic Lane")
+        self.bookcopies[2].library_branch = other_branch
+        self.bookcopies[2].save()
+        reserve_date = datetime(2013, 6, 10, 9, 0, tzinfo=pytz.utc)
+        for bookcopy in self.bookcopies:
+            bookcopy.do_reserve(self.user, reserve_date)
+
+        stdout = StringIO()
+        call_command('expire_reservations', dry_run=True, stdout=stdout)
+        self.assertTrue(stdout.getvalue().startswith('Found 3 reservations'))
+        self.assertEqual(BookCopy.objects.filter(current_checkout=None).count(), 0)
+
+        stdout = StringIO()
+        call_command('expire_reservations', branch=other_branch.name, stdout=stdout)
+        self.assertTrue(stdout.getvalue().startswith('Expired 1 reservations'))
+        call_command('expire_reservations', batch_size=1, stdout=stdout)
+        self.assertEqual(BookCopy.objects.filter(current_checkout=None).count(), 3)
+
+
+class ReaderCheckoutTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=12)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.client.login(username='reader', password='secret')
+
+    def post_checkout(self, bookcopy, action):
+        return self.client.post(reverse('reader_checkout'), {
+                'id' : bookcopy.id, 'title' : self.book.title,
+                'authors' : '-', 'action' : action})
+
+    def test_active_count(self):
+        now = datetime.now(pytz.utc)
+        self.bookcopies[0].do_borrow(self.user, now - timedelta(days=3))
+        self.bookcopies[1].do_borrow(self.user, now - timedelta(days=3))
+        self.bookcopies[1].do_return(self.user, now - timedelta(days=1))
+        self.bookcopies[2].do_reserve(self.user, now - timedelta(days=3))
+        self.bookcopies[3].do_reserve(self.user, now)
+        checkouts = BookCopyCheckout.objects.filter(user=self.user)
+        self.assertEqual(BookCopyCheckout.objects.active_count(self.user, now),
+                         len([c for c in checkouts if c.is_current(now)]))
+        self.assertEqual(BookCopyCheckout.objects.active_count(self.user, now), 2)
+
+    def test_checkout_limit(self):
+        for bookcopy in self.bookcopies[0:10]:
+            response = self.post_checkout(bookcopy, 'borrow')
+            self.assertEqual(response.status_code, 302)
+        response = self.post_checkout(self.bookcopies[10], 'reserve')
+        self.assertEqual(response.content,
+                         "User may not borrow or reserve more than 10 books!")
+        # Returning a book makes room for another.
+        self.post_checkout(self.bookcopies[0], 'return')
+        response = self.post_checkout(self.bookcopies[10], 'reserve')
+        self.assertEqual(response.status_code, 302)
+        # A reserved book may be borrowed while at the limit.
+        response = self.post_checkout(self.bookcopies[10], 'borrow')
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(BookCopy.objects.get(id=self.bookcopies[10].id)
+                         .status(self.user, datetime.now(pytz.utc)), 'borrowed (mine)')
+
+    def test_versions_bumped_after_commit(self):
+        # A page built while the transaction is open is dropped once it commits.
+        seen = []
+        def returned(sender, checkout, **kwargs):
+            seen.append(versions.bookcopy_versions([checkout.bookcopy_id])[0])
+        signals.checkout_returned.connect(returned)
+        try:
+            self.post_checkout(self.bookcopies[0], 'borrow')
+            self.post_checkout(self.bookcopies[0], 'return')
+        finally:
+            signals.checkout_returned.disconnect(returned)
+        self.assertNotEqual(versions.bookcopy_versions([self.bookcopies[0].id]), seen)
+
+    def test_unavailable(self):
+        other = User.objects.create_user('other', 'other@example.com', 'secret')
+        self.bookcopies[0].do_borrow(other, datetime.now(pytz.utc))
+        response = self.post_checkout(self.bookcopies[0], 'borrow')
+        self.assertEqual(response.context['error'], "Book is not available!")
+        # Another copy is available at the only branch.
+        self.assertEqual(response.context['library_branch_list'],
+                         [(self.branches[0].id, self.branches[0].name)])
+        response = self.post_checkout(self.bookcopies[1], 'return')
+        self.assertEqual(response.content, "Book was not borrowed!")
+
+
+class CheckoutRetryTest(TestCase):
+    def setUp(self):
+        self.original = checkout._checkout_bookcopy
+        self.original_delay = checkout.RETRY_DELAY
+        checkout.RETRY_DELAY = 0
+        self.bookcopy = BookCopy(id=1, book_id=1)
+
+    def tearDown(self):
+        checkout._checkout_bookcopy = self.original
+        checkout.RETRY_DELAY = self.original_delay
+
+    def fail_times(self, count, error):
+        calls = []
+        def fake_checkout(*args):
+            calls.append(args)
+            if len(calls) <= count:
+                raise error
+            return self.bookcopy
+        checkout._checkout_bookcopy = fake_checkout
+        return calls
+
+    def test_deadlock_is_retried(self):
+        calls = self.fail_times(2, DatabaseError(1213, 'Deadlock found'))
+        self.assertEqual(checkout_bookcopy(None, 1, 'borrow', None), self.bookcopy)
+        self.assertEqual(len(calls), 3)
+
+    def test_retries_are_limited(self):
+        calls = self.fail_times(10, DatabaseError(1205, 'Lock wait timeout'))
+        self.assertRaises(DatabaseError, checkout_bookcopy, None, 1, 'borrow', None)
+        self.assertEqual(len(calls), checkout.CHECKOUT_RETRIES + 1)
+
+    def test_other_errors_are_raised(self):
+        calls = self.fail_times(1, DatabaseError(1146, 'Table does not exist'))
+        self.assertRaises(DatabaseError, checkout_bookcopy, None, 1, 'borrow', None)
+        self.assertEqual(len(calls), 1)
+
+
+class CheckoutConcurrencyTest(TransactionTestCase):
+    """
+    Many readers try to borrow the same copies at once.  This needs a
+    database with row locks, such as MySQL.
+    """
+    THREAD_COUNT = 16
+    COPY_COUNT = 4
+
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(
+            copy_count=self.COPY_COUNT)
+        self.users = [User.objects.create_user('reader%d' % index)
+                      for index in range(0, self.THREAD_COUNT)]
+
+    @skipUnless(connection.features.has_select_for_update,
+                "Database does not support row locks.")
+    def test_concurrent_borrow(self):
+        now = datetime.now(pytz.utc)
+        results = []
+        start = threading.Event()
+
+        def hammer(user):
+            start.wait()
+            try:
+                for bookcopy in self.bookcopies:
+                    try:
+                        checkout_bookcopy(user, bookcopy.id, 'borrow', now)
+                        results.append((bookcopy.id, user.id))
+                    except ValueError:
+                        pass
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=hammer, args=(user,)) for user in self.users]
+        for thread in threads:
+            thread.start()
+        start.set()
+        for thread in threads:
+            thread.join()
+
+        # Every copy was borrowed exactly once.
+        self.assertEqual(sorted(bookcopy_id for bookcopy_id, user_id in results),
+                         sorted(bookcopy.id for bookcopy in self.bookcopies))
+        for bookcopy in self.bookcopies:
+            self.assertEqual(BookCopyCheckout.objects.filter(bookcopy=bookcopy).count(), 1)
+            self.assertEqual(BookCopy.objects.get(id=bookcopy.id).current_checkout.user_id,
+                             dict(results)[bookcopy.id])
+
+
+class CheckoutSnapshotTest(TransactionTestCase):
+    """
+    A web request reads its session and user before checking out, which on
+    MySQL begins a REPEATABLE READ snapshot.  Checkouts committed by other
+    requests after that read must still be seen.
+    """
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(
+            copy_count=MAX_ACTIVE_CHECKOUTS + 1)
+        self.user = User.objects.create_user('reader')
+        self.other = User.objects.create_user('other')
+        self.now = datetime.now(pytz.utc)
+
+    def checkout_elsewhere(self, user, bookcopy):
+        """
+        Check out a copy in another thread, so on another connection.
+        """
+        def run():
+            try:
+                checkout_bookcopy(user, bookcopy.id, 'borrow', self.now)
+            finally:
+                connection.close()
+        thread = threading.Thread(target=run)
+        thread.start()
+        thread.join()
+
+    @skipUnless(connection.vendor == 'mysql', "Needs InnoDB REPEATABLE READ snapshots.")
+    def test_copy_borrowed_after_plain_read(self):
+        bookcopy = self.bookcopies[0]
+        User.objects.get(pk=self.user.pk)
+        self.checkout_elsewhere(self.other, bookcopy)
+        self.assertRaises(BookNotAvailable, checkout_bookcopy,
+                          self.user, bookcopy.id, 'borrow', self.now)
+
+    @skipUnless(connection.vendor == 'mysql', "Needs InnoDB REPEATABLE READ snapshots.")
+    def test_limit_after_plain_read(self):
+        for bookcopy in self.bookcopies[:MAX_ACTIVE_CHECKOUTS - 1]:
+            checkout_bookcopy(self.user, bookcopy.id, 'borrow', self.now)
+        User.objects.get(pk=self.user.pk)
+        self.checkout_elsewhere(self.user, self.bookcopies[-2])
+        self.assertRaises(ValueError, checkout_bookcopy,
+                          self.user, self.bookcopies[-1].id, 'borrow', self.now)
+        self.assertEqual(BookCopyCheckout.objects.active_count(self.user, self.now),
+                         MAX_ACTIVE_CHECKOUTS)
+
+
+class SearchTest(TestCase):
+    def setUp(self):
+        self.publisher = Publisher.objects.create(name="Oxford Press", address="101 Main Drive")
+        self.birds = Book.objects.create(title="Rearing Birds", isbn="9780000000001",
+                                         publisher=self.publisher,
+                                         publication_date=date(2001, 1, 1))
+        self.cats = Book.objects.create(title="Petting Cats", isbn="9780000000002",
+                                        publisher=self.publisher,
+                                        publication_date=date(2002, 1, 1))
+        self.author = Author.objects.create(name="Jessica Rearing")
+        self.cats.authors.add(self.author)
+
+    def test_prefix_and_rank(self):
+        # A title match outranks an author match.
+        self.assertEqual(search_books("rear"), [self.birds.id, self.cats.id])
+        self.assertEqual(search_books("rear", field='author'), [self.cats.id])
+        self.assertEqual(search_books("CAT"), [self.cats.id])
+        self.assertEqual(search_books("oxford", field='title'), [])
+        self.assertEqual(search_books("!!"), [])
+
+    def test_index_follows_saves(self):
+        self.publisher.name = "Wesley Printing"
+        self.publisher.save()
+        self.assertEqual(search_books("wesley", field='publisher'),
+                         [self.birds.id, self.cats.id])
+        self.author.name = "Graham Miller"
+        self.author.save()
+        self.assertEqual(search_books("miller"), [self.cats.id])
+        self.author.book_set.clear()
+        self.assertEqual(search_books("miller"), [])
+        self.birds.title = "Observing Snails"
+        self.birds.save()
+        self.assertEqual(search_books("birds"), [])
+        self.assertEqual(search_books("snail"), [self.birds.id])
+
+    def test_isbn(self):
+        self.assertEqual(search_books("978-0000000002", field='isbn'), [self.cats.id])
+        self.assertEqual(search_books("97800", field='isbn'), [self.birds.id, self.cats.id])
+        self.assertEqual(search_books("9780000000002"), [self.cats.id])
+
+    def test_all_fields(self):
+        # Matches on several fields add up.
+        self.assertEqual(search_books("jessica cats"), [self.cats.id])
+        self.assertEqual(search_books("oxford rearing"), [self.birds.id, self.cats.id])
+        self.assertEqual(search_books("oxford jessica"), [self.cats.id, self.birds.id])
+
+    def test_unchanged_document_is_not_rewritten(self):
+        self.publisher.address = "45 Houston Lane"
+        term_ids = list(BookSearchTerm.objects.values_list('id', flat=True).order_by('id'))
+        self.publisher.save()
+        self.assertEqual(list(BookSearchTerm.objects.values_list('id', flat=True).order_by('id')),
+                         term_ids)
+        self.assertEqual(BookSearchDocument.objects.get(book=self.cats).author_names,
+                         "Jessica Rearing")
+
+    def test_rebuild_command(self):
+        BookSearchTerm.objects.all().delete()
+        book_version = versions.get_version('book')
+        call_command('rebuild_search_index', stdout=StringIO())
+        # Searches cached under the old index are not served again.
+        self.assertNotEqual(versions.get_version('book'), book_version)
+        self.assertEqual(search_books("rearing"), [self.birds.id, self.cats.id])
+
+    def test_reader_bookcopy_search(self):
+        branch = LibraryBranch.objects.create(name="Texas Main Library", address="131 Paso Drive")
+        for index, book in enumerate([self.cats, self.birds, self.cats]):
+            BookCopy.objects.create(book=book, library_branch=branch,
+                                    copy_number=index, position="P%05d" % index)
+        User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.client.login(username='reader', password='secret')
+        response = self.client.get(reverse('reader_bookcopy'), {'q' : 'rearing', 'by' : 'title'})
+        self.assertEqual([row.title for row in response.context['bookcopy_list']],
+                         ["Rearing Birds"])
+        response = self.client.get(reverse('reader_bookcopy'), {'q' : 'oxford', 'by' : 'publisher'})
+        self.assertEqual([row.title for row in response.context['bookcopy_list']],
+                         ["Rearing Birds", "Petting Cats", "Petting Cats"])
+        response = self.client.get(reverse('reader_bookcopy'), {'q' : 'jessica', 'by' : 'author'})
+        self.assertEqual([row.title for row in response.context['bookcopy_list']],
+                         ["Petting Cats", "Petting Cats"])
+        response = self.client.get(reverse('reader_bookcopy'), {'q' : 'petting birds', 'by' : 'all'})
+        self.assertEqual(len(response.context['bookcopy_list']), 3)
+        self.assertFalse(response.context['search_truncated'])
+
+    def test_reader_bookcopy_search_truncated(self):
+        branch = LibraryBranch.objects.create(name="Texas Main Library", address="131 Paso Drive")
+        for index, book in enumerate([self.cats, self.birds]):
+            BookCopy.objects.create(book=book, library_branch=branch,
+                                    copy_number=index, position="P%05d" % index)
+        User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.client.login(username='reader', password='secret')
+        original = views.SEARCH_LIMIT
+        views.SEARCH_LIMIT = 1
+        try:
+            response = self.client.get(reverse('reader_bookcopy'), {'q' : 'rearing'})
+        finally:
+            views.SEARCH_LIMIT = original
+        self.assertEqual([row.title for row in response.context['bookcopy_list']],
+                         ["Rearing Birds"])
+        self.assertTrue(response.context['search_truncated'])
+        self.assertTrue('Only the copies of the 1 best matching titles' in response.content)
+
+
+class StatisticsTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=4, branch_count=2)
+        self.other_book = Book.objects.create(title="Petting Cats", isbn="9780000000002",
+                                              publisher=self.book.publisher,
+                                              publication_date=date(2002, 1, 1))
+        self.bookcopies[2].book = self.other_book
+        self.bookcopies[2].save()
+        self.alice = User.objects.create_user('alice')
+        self.bob = User.objects.create_user('bob')
+        self.now = datetime(2013, 6, 10, 12, 0, tzinfo=pytz.utc)
+        # Copies 0 and 2 are at the first branch.
+        self.bookcopies[0].do_borrow(self.alice, self.now - timedelta(days=60))
+        self.bookcopies[0].do_return(self.alice, self.now - timedelta(days=30))  # 10 days late
+        self.bookcopies[0].do_borrow(self.bob, self.now - timedelta(days=25))    # 5 days late
+        self.bookcopies[2].do_borrow(self.alice, self.now - timedelta(days=10))
+        self.bookcopies[2].do_return(self.alice, self.now - timedelta(days=5))
+        self.bookcopies[1].do_borrow(self.bob, self.now - timedelta(days=60))
+
+    def assertStatistics(self):
+        branch = self.branches[0]
+        self.assertEqual(list(stats.top_borrowers(branch)), [('alice', 2), ('bob', 1)])
+        self.assertEqual(list(stats.top_books(branch)),
+                         [("Rearing Birds", 2), ("Petting Cats", 1)])
+        self.assertAlmostEqual(stats.average_fine(branch, self.now), 1.50)
+        self.assertAlmostEqual(stats.average_fine(self.branches[1], self.now), 8.00)
+
+    def test_incremental(self):
+        self.assertStatistics()
+
+    def test_rebuild(self):
+        BranchBorrowerStatistic.objects.all().delete()
+        BranchFineStatistic.objects.all().update(late_count=0, late_days=0)
+        call_command('rebuild_statistics', stdout=StringIO())
+        self.assertStatistics()
+        call_command('rebuild_statistics', branch=str(self.branches[0].id), stdout=StringIO())
+        self.assertStatistics()
+
+    def test_view(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        response = self.client.post(reverse('admin_librarybranch_statistics'), {
+                'library_branch' : self.branches[0].id, 'statistic' : 'borrow'})
+        self.assertEqual(list(response.context['data']), [('alice', 2), ('bob', 1)])
+
+
+    def test_checkout_branch(self):
+        self.assertEqual(
+            set(BookCopyCheckout.objects.values_list('bookcopy__library_branch', 'library_branch')),
+            set([(self.branches[0].id, self.branches[0].id),
+                 (self.branches[1].id, self.branches[1].id)]))
+
+
+class UpgradeSchemaTest(TransactionTestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=4, branch_count=2)
+        self.user = User.objects.create_user('alice')
+        Reader.objects.create(user=self.user, address="1 Main Street", phone_number="555-0100")
+        now = datetime.now(pytz.utc)
+        for bookcopy in self.bookcopies:
+            bookcopy.do_borrow(self.user, now)
+
+    def index_names(self):
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = 'library_bookcopycheckout'")
+        return set(row[0] for row in cursor.fetchall())
+
+    @skipUnless(connection.vendor == 'sqlite', "Test lists the indexes of SQLite.")
+    def test_upgrade(self):
+        indexes = self.index_names()
+        cursor = connection.cursor()
+        cursor.execute("SELECT name FROM sqlite_master WHERE type = 'index' "
+                       "AND tbl_name = 'library_bookcopycheckout' "
+                       "AND sql LIKE '%library_branch_id%'")
+        for row in cursor.fetchall():
+            cursor.execute('DROP INDEX "%s"' % row[0])
+        BookCopyCheckout.objects.update(library_branch=None)
+        self.assertNotEqual(self.index_names(), indexes)
+
+        call_command('upgrade_schema', batch_size=3, stdout=StringIO())
+        self.assertEqual(self.index_names(), indexes)
+        self.assertEqual(
+            sorted(BookCopyCheckout.objects.values_list('library_branch', flat=True)),
+            sorted(bookcopy.library_branch_id for bookcopy in self.bookcopies))
+        output = StringIO()
+        call_command('upgrade_schema', dry_run=True, stdout=output)
+        self.assertEqual(output.getvalue(), '')
+
+    def test_explain_queries(self):
+        for joined in (False, True):
+            output = StringIO()
+            call_command('explain_queries', joined=joined, stdout=output)
+            plans = output.getvalue().split('\n== ')
+            self.assertEqual(len(plans), 7)
+            late = [plan for plan in plans if plan.startswith('late books')][0]
+            self.assertEqual('library_bookcopy"' in late, joined)
+
+
+class FinesTest(TestCase):
+    def test_get_fine(self):
+        borrow_date = datetime(2013, 6, 1, 12, 0, tzinfo=pytz.utc)
+        self.assertEqual(fines.get_fine(None, borrow_date), None)
+        self.assertEqual(fines.get_fine(borrow_date, borrow_date + timedelta(days=20)), None)
+        self.assertEqual(fines.get_fine(borrow_date, borrow_date + timedelta(days=20, hours=1)), 0.0)
+        self.assertEqual(fines.get_fine(borrow_date, borrow_date + timedelta(days=25, hours=23)), 1.0)
+        checkout = BookCopyCheckout(borrow_date=borrow_date)
+        self.assertEqual(checkout.get_fine(borrow_date + timedelta(days=30)), 2.0)
+
+    def test_batch_matches_single(self):
+        start = datetime(2013, 6, 1, 12, 0, tzinfo=pytz.utc)
+        borrow_dates = [start + timedelta(hours=7 * i) for i in range(0, 200)]
+        end_dates = [start + timedelta(days=60, minutes=13 * i) for i in range(0, 200)]
+        expected = [fines.late_days(b, e) for b, e in zip(borrow_dates, end_dates)]
+        self.assertEqual(list(fines.late_days_batch(borrow_dates, end_dates, use_numpy=False)),
+                         expected)
+        totals = (len([d for d in expected if d > 0]), sum(expected))
+        self.assertEqual(fines.late_totals(borrow_dates, end_dates, use_numpy=False), totals)
+        if fines.numpy is not None:
+            self.assertEqual(list(fines.late_days_batch(borrow_dates, end_dates)), expected)
+            self.assertEqual(fines.late_totals(borrow_dates, end_dates), totals)
+        self.assertEqual(fines.late_totals([], []), (0, 0))
+
+    def test_benchmark_command(self):
+        stdout = StringIO()
+        call_command('benchmark_fines', count=1000, stdout=stdout)
+        self.assertTrue('python 1000 checkouts' in stdout.getvalue())
+
+
+class InitDataTest(TestCase):
+    def generate(self, **options):
+        call_command('initdata', stdout=StringIO(), **options)
+
+    def test_generated_data(self):
+        self.generate(seed=3, books=40, branches=3, readers=7, checkouts=500, batch_size=50)
+        self.assertEqual(Book.objects.count(), 40)
+        self.assertEqual(LibraryBranch.objects.count(), 3)
+        self.assertEqual(Reader.objects.count(), 7)
+        self.assertEqual(BookCopyCheckout.objects.count(), 500)
+        # Every book has authors and is in the search index.
+        self.assertEqual(Book.objects.filter(authors=None).count(), 0)
+        self.assertEqual(BookSearchDocument.objects.count(), 40)
+        self.assertEqual(BranchBookStatistic.objects.aggregate(Sum('checkout_count')),
+                         {'checkout_count__sum' : 500})
+
+        now = datetime.now(pytz.utc)
+        for bookcopy in BookCopy.objects.all():
+            checkouts = list(BookCopyCheckout.objects.filter(bookcopy=bookcopy)
+                             .order_by('id'))
+            # The checkouts of a copy never overlap.
+            for checkout, next_checkout in zip(checkouts, checkouts[1:]):
+                self.assertTrue(checkout.return_date or checkout.borrow_date is None)
+                self.assertTrue((checkout.return_date or checkout.reserve_date) <
+                                (next_checkout.reserve_date or next_checkout.borrow_date))
+            out = [c for c in checkouts if c.borrow_date and not c.return_date]
+            self.assertTrue(len(out) <= 1)
+            self.assertEqual(bookcopy.current_checkout_id, out[0].id if out else None)
+
+    def test_seed_is_repeatable(self):
+        self.generate(seed=5, books=10, checkouts=50)
+        first = list(Book.objects.order_by('isbn').values_list('isbn', 'title'))
+        positions = list(BookCopy.objects.order_by('position').values_list('position', flat=True))
+        # Existing data is only deleted when asked to.
+        self.assertRaises(CommandError, self.generate, seed=5, books=10, checkouts=50)
+        self.assertEqual(Book.objects.count(), 10)
+        self.generate(seed=5, books=10, checkouts=50, clear=True, interactive=False)
+        self.assertEqual(list(Book.objects.order_by('isbn').values_list('isbn', 'title')), first)
+        self.assertEqual(Reader.objects.count(), 10)
+        self.assertEqual(User.objects.count(), 10)
+        self.assertEqual(len(positions), len(set(positions)))
+
+
+class BenchmarkTest(TestCase):
+    def test_record_queries(self):
+        create_catalog(copy_count=3)
+        with record_queries(connection) as stats:
+            list(BookCopy.objects.all())
+            BookCopy.objects.count()
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(stats.rows, 4)
+        # The connection is back to normal afterwards.
+        self.assertFalse('make_debug_cursor' in connections['default'].__dict__)
+
+    def test_benchmark(self):
+        call_command('initdata', stdout=StringIO(), seed=2, books=20, readers=5,
+                     checkouts=100)
+        output = os.path.join(tempfile.mkdtemp(), 'results.json')
+        # Measuring the configured database writes to it, so it must be confirmed.
+        self.assertRaises(CommandError, call_command, 'benchmark', stdout=StringIO(),
+                          existing=True, requests=1)
+        users = dict(User.objects.values_list('id', 'password'))
+        copies = BookCopy.objects.count()
+        call_command('benchmark', stdout=StringIO(), existing=True, allow_writes=True,
+                     requests=4, output=output)
+        # The users of the run are gone, and nobody else's password changed.
+        self.assertEqual(dict(User.objects.values_list('id', 'password')), users)
+        self.assertEqual(BookCopy.objects.count(), copies)
+        with open(output) as f:
+            results = json.load(f)
+        self.assertEqual(sorted(results.keys()), sorted(['reader_bookcopy',
+                'reader_mybooks', 'reader_checkout', 'admin_librarybranch_statistics']))
+        for result in results.values():
+            self.assertEqual(result['requests'], 4)
+            self.assertTrue(result['p99_ms'] >= result['p50_ms'])
+            self.assertTrue(result['queries_max'] >= 1)
+
+        thresholds = os.path.join(os.path.dirname(output), 'thresholds.json')
+        with open(thresholds, 'w') as f:
+            json.dump({'reader_mybooks' : {'queries_max' : 0}}, f)
+        self.assertRaises(CommandError, call_command, 'benchmark', stdout=StringIO(),
+                          existing=True, allow_writes=True, requests=1,
+                          thresholds=thresholds)
+
+
+class QueryStatsMiddlewareTest(TestCase):
+    def setUp(self):
+        create_catalog(copy_count=3)
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        request_stats.reset()
+
+    def client_for(self, sample_rate):
+        with self.settings(QUERY_STATS_SAMPLE_RATE=sample_rate):
+            client = Client()
+            client.login(username='admin', password='secret')
+            # The middleware is loaded with the settings of the first request.
+            client.get(reverse('index'))
+        return client
+
+    def test_headers_and_totals(self):
+        client = self.client_for(1)
+        response = client.get(reverse('reader_bookcopy'))
+        self.assertTrue(int(response['X-Query-Count']) >= 2)
+        self.assertTrue(int(response['X-Rows-Fetched']) >= 3)
+        self.assertTrue(float(response['X-View-Time-Ms']) >=
+                        float(response['X-Render-Time-Ms']) > 0)
+
+        response = client.get(reverse('admin_query_stats'))
+        views = json.loads(response.content)['views']
+        self.assertEqual(views['library.views.reader_bookcopy']['requests'], 1)
+        client.post(reverse('admin_query_stats'))
+        self.assertEqual(request_stats.summary().keys(),
+                         ['library.views.admin_query_stats'])
+
+    def test_off_when_not_sampled(self):
+        client = self.client_for(0)
+        response = client.get(reverse('reader_bookcopy'))
+        self.assertFalse(response.has_header('X-Query-Count'))
+        self.assertEqual(request_stats.summary(), {})
+
+
+class KeysetPageTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=45)
+        self.ids = [bookcopy.id for bookcopy in self.bookcopies]
+
+    def ids_of(self, page):
+        return [bookcopy.id for bookcopy in page.object_list]
+
+    def test_walk_forward_and_back(self):
+        pages = [KeysetPage(BookCopy.objects.all())]
+        while pages[-1].has_next:
+            with self.assertNumQueries(3):
+                pages.append(KeysetPage(BookCopy.objects.all(), pages[-1].next_cursor))
+        self.assertEqual([page.number for page in pages], [1, 2, 3, 4, 5])
+        self.assertEqual(sum([self.ids_of(page) for page in pages], []), self.ids)
+        self.assertFalse(pages[0].has_prev)
+
+        page = KeysetPage(BookCopy.objects.all(), pages[3].prev_cursor)
+        self.assertEqual(page.number, 3)
+        self.assertEqual(self.ids_of(page), self.ids[20:30])
+
+    def test_window_links(self):
+        page = KeysetPage(BookCopy.objects.all(), KeysetPage(
+                BookCopy.objects.all(), KeysetPage(BookCopy.objects.all()).next_cursor).next_cursor)
+        self.assertEqual([link['number'] for link in page.links], [1, 2, 3, 4, 5])
+        self.assertEqual([link['active'] for link in page.links],
+                         [False, False, True, False, False])
+        self.assertEqual(self.ids_of(KeysetPage(BookCopy.objects.all(), page.links[4]['cursor'])),
+                         self.ids[40:])
+        self.assertEqual(self.ids_of(KeysetPage(BookCopy.objects.all(), page.links[0]['cursor'])),
+                         self.ids[:10])
+
+    def test_last_page_and_bad_cursor(self):
+        last_cursor = KeysetPage(BookCopy.objects.all()).last_cursor
+        # The last page is found without counting the rows, and has no number.
+        with self.assertNumQueries(3):
+            last = KeysetPage(BookCopy.objects.all(), last_cursor)
+        self.assertEqual(last.number, None)
+        self.assertEqual([link['number'] for link in last.links], [None, None, None])
+        self.assertEqual(self.ids_of(last), self.ids[35:])
+        self.assertFalse(last.has_next)
+        self.assertEqual(self.ids_of(KeysetPage(BookCopy.objects.all(), 'forged')),
+                         self.ids[:10])
+
+    def test_admin_views(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        response = self.client.get(reverse('admin_bookcopy'))
+        self.assertEqual(self.ids_of(response.context['pager']), self.ids[:10])
+        response = self.client.get(reverse('admin_bookcopy'), {
+                'cursor' : response.context['pager'].next_cursor})
+        self.assertEqual(response.context['pager'].number, 2)
+        for name in ['admin_librarybranch', 'admin_reader']:
+            self.assertEqual(self.client.get(reverse(name)).status_code, 200)
+
+
+class ChoicesTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(branch_count=2)
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+
+    def test_librarybranch_choices_are_cached(self):
+        expected = [(branch.id, branch.name) for branch in self.branches]
+        self.assertEqual(choices.librarybranch_choices(), expected)
+        with self.assertNumQueries(0):
+            self.assertEqual(choices.librarybranch_choices(), expected)
+        # Saving a branch invalidates the choices.
+        self.branches[0].name = "Renamed Library"
+        self.branches[0].save()
+        self.assertEqual(choices.librarybranch_choices()[0][1], "Renamed Library")
+
+    def test_book_typeahead(self):
+        response = self.client.get(reverse('admin_book_typeahead'), {'q' : 'rear'})
+        self.assertEqual(json.loads(response.content), [
+                {'id' : self.book.id, 'title' : 'Rearing Birds', 'isbn' : '9780000000001'}])
+        self.book.title = "Raising Birds"
+        self.book.save()
+        self.assertEqual(choices.book_typeahead('rear'), [])
+
+    def test_add_bookcopy(self):
+        response = self.client.get(reverse('admin_bookcopy_add'))
+        self.assertEqual(response.status_code, 200)
+        response = self.client.post(reverse('admin_bookcopy_add'), {
+                'library_branch' : self.branches[1].id, 'book_title' : 'Rearing Birds',
+                'book' : self.book.id, 'copy_number' : 2, 'position' : 'Q00001'})
+        self.assertEqual(response.status_code, 302)
+        bookcopy = BookCopy.objects.get(position='Q00001')
+        self.assertEqual((bookcopy.book, bookcopy.library_branch), (self.book, self.branches[1]))
+
+        response = self.client.post(reverse('admin_bookcopy_add'), {
+                'library_branch' : self.branches[1].id, 'book_title' : 'Unknown',
+                'book' : 0, 'copy_number' : 3, 'position' : 'Q00002'})
+        self.assertTrue(response.context['form'].errors['book'])
+
+
+class ImportBookCopiesTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(branch_count=2)
+        self.branch_name = self.branches[1].name
+        self.lines = ['isbn,library_branch,copy_number,position'] + [
+            '978-0000000001,%s,%d,N%05d' % (self.branch_name, index, index)
+            for index in range(1, 8)]
+
+    def test_import_csv_in_chunks(self):
+        # Each chunk costs a book, branch and position lookup, an insert and
+        # two availability queries, but books and branches that were found
+        # are not looked up again.
+        with self.assertNumQueries(6 + 4 + 4):
+            result = importers.import_bookcopies(
+                importers.read_rows(self.lines, 'csv'), chunk_size=3)
+        self.assertEqual((result.row_count, result.created_count, result.error_count),
+                         (7, 7, 0))
+        self.assertEqual(BookCopy.objects.filter(library_branch=self.branches[1]).count(), 7)
+        availability = BookAvailability.objects.get(book=self.book, library_branch=self.branches[1])
+        self.assertEqual((availability.copy_count, availability.available_count), (7, 7))
+
+    def test_errors(self):
+        self.lines += [
+            '9780000000002,%s,1,N00100' % self.branch_name,
+            '9780000000001,Nowhere,1,N00101',
+            '9780000000001,%s,x,N00102' % self.branch_name,
+            '9780000000001,%s,1,N00001' % self.branch_name,
+            '9780000000001,%s,1,P00000' % self.branch_name,
+            'too,few']
+        result = importers.import_bookcopies(importers.read_rows(self.lines, 'csv'))
+        self.assertEqual(result.created_count, 7)
+        self.assertEqual([line for line, message in result.errors], [11, 14, 9, 10, 12, 13])
+        self.assertRaises(importers.ImportFileError, list,
+                          importers.read_rows(['isbn,position'], 'csv'))
+
+    def test_bom_and_bad_encoding(self):
+        # A byte order mark before the header, and a row in Latin-1.
+        lines = [codecs.BOM_UTF8 + self.lines[0], self.lines[1],
+                 '9780000000001,%s,2,\xe900001' % self.branch_name]
+        result = importers.import_bookcopies(importers.read_rows(lines, 'csv'))
+        self.assertEqual((result.created_count, result.errors),
+                         (1, [(3, 'The line is not a valid row.')]))
+        lines = [codecs.BOM_UTF8 + json.dumps({'isbn' : '9780000000001',
+                'library_branch' : self.branch_name, 'copy_number' : 3, 'position' : 'J00002'})]
+        result = importers.import_bookcopies(importers.read_rows(lines, 'jsonl'))
+        self.assertEqual((result.created_count, result.errors), (1, []))
+
+    def test_jsonl_dry_run(self):
+        lines = [json.dumps({'isbn' : '9780000000001', 'library_branch' : self.branch_name,
+                             'copy_number' : 2, 'position' : 'J00001'}), '', '[1]']
+        result = importers.import_bookcopies(importers.read_rows(lines, 'jsonl'),
+                                             dry_run=True)
+        self.assertEqual((result.created_count, result.errors), (1, [(3, 'The line is not a valid row.')]))
+        self.assertFalse(BookCopy.objects.filter(position='J00001').exists())
+
+    def test_command_and_view(self):
+        path = os.path.join(tempfile.mkdtemp(), 'copies.csv')
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.lines[0:4]) + '\n')
+        output = StringIO()
+        call_command('import_bookcopies', path, stdout=output, stderr=StringIO())
+        self.assertTrue('Imported 3 of 3 rows' in output.getvalue())
+
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        upload = SimpleUploadedFile('copies.csv', '\n'.join(self.lines[0:1] + self.lines[4:]))
+        response = self.client.post(reverse('admin_bookcopy_import'), {'file' : upload})
+        self.assertEqual(response.context['result'].created_count, 4)
+        self.assertEqual(BookCopy.objects.count(), 8)
+
+
+class ImportReadersTest(TestCase):
+    def setUp(self):
+        self.lines = ['username,email,first_name,last_name,address,phone_number,password',
+                      'ann,ann@example.com,Ann,Lee,1 Oak Street,555-0100,secret',
+                      'bob,,Bob,Ray,2 Oak Street,555-0101,',
+                      'ann,ann2@example.com,Ann,Other,3 Oak Street,555-0102,secret',
+                      'carl,not-an-email,Carl,Ray,4 Oak Street,555-0103,secret',
+                      'dana,dana@example.com,Dana,Ray,5 Oak Street,555-0104,secret']
+
+    def test_import_readers(self):
+        result = importers.import_readers(
+            importers.read_rows(self.lines, 'csv', importers.READER_COLUMNS),
+            chunk_size=2, processes=2)
+        self.assertEqual(result.created_count, 3)
+        self.assertEqual(sorted([line for line, message in result.errors]), [4, 5])
+        reader = Reader.objects.get(user__username='ann')
+        self.assertEqual((reader.address, reader.user.email), ('1 Oak Street', 'ann@example.com'))
+        self.assertTrue(reader.user.check_password('secret'))
+        # Readers without a password cannot log in until one is set.
+        self.assertFalse(User.objects.get(username='bob').has_usable_password())
+
+    def test_command_writes_progress(self):
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'readers.csv')
+        with open(path, 'w') as f:
+            f.write('\n'.join(self.lines) + '\n')
+        progress_file = os.path.join(directory, 'progress')
+        call_command('import_readers', path, processes=1, progress_file=progress_file,
+                     delete=True, stdout=StringIO(), stderr=StringIO())
+        progress = importers.read_progress(progress_file)
+        self.assertEqual((progress['done'], progress['created_count'], progress['error_count']),
+                         (True, 3, 2))
+        self.assertFalse(os.path.exists(path))
+
+    def test_view_queues_import(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        import_dir = importers.IMPORT_DIR
+        importers.IMPORT_DIR = tempfile.mkdtemp()
+        try:
+            upload = SimpleUploadedFile('readers.csv', '\n'.join(self.lines))
+            response = self.client.post(reverse('admin_reader_import'), {'file' : upload})
+            self.assertEqual(response.status_code, 302)
+            # The upload waits for the cron job, nothing is imported yet.
+            pending = importers.pending_reader_imports()
+            self.assertEqual(len(pending), 1)
+            job, path, format = pending[0]
+            self.assertEqual(format, 'csv')
+            with open(path) as f:
+                self.assertEqual(f.read(), '\n'.join(self.lines))
+            progress = self.client.get(response['Location']).context['progress']
+            self.assertEqual((progress['done'], progress['queued']), (False, True))
+
+            call_command('import_readers', pending=True, processes=1,
+                         stdout=StringIO(), stderr=StringIO())
+            self.assertEqual(importers.pending_reader_imports(), [])
+            self.assertEqual(os.listdir(importers.IMPORT_DIR),
+                             [os.path.basename(importers.progress_path(job))])
+            progress = self.client.get(response['Location']).context['progress']
+            self.assertEqual((progress['done'], progress['created_count']), (True, 3))
+        finally:
+            importers.IMPORT_DIR = import_dir
+        self.assertEqual(self.client.get(reverse('admin_reader_import'),
+                                         {'job' : '0' * 32}).status_code, 404)
+
+    def test_failed_pending_import_is_marked_done(self):
+        import_dir = importers.IMPORT_DIR
+        importers.IMPORT_DIR = tempfile.mkdtemp()
+        try:
+            job = importers.start_reader_import(
+                SimpleUploadedFile('readers.csv', 'name,email\nann,ann@example.com\n'), 'csv')
+            stderr = StringIO()
+            call_command('import_readers', pending=True, processes=1,
+                         stdout=StringIO(), stderr=stderr)
+            progress = importers.read_progress(importers.progress_path(job))
+        finally:
+            importers.IMPORT_DIR = import_dir
+        self.assertEqual((progress['done'], progress['error_count']), (True, 1))
+        self.assertTrue('lacks the columns' in progress['errors'][0][1])
+        self.assertTrue('lacks the columns' in stderr.getvalue())
+
+
+class FragmentCacheTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=15)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.other = User.objects.create_user('other', 'other@example.com', 'secret')
+        self.client.login(username='reader', password='secret')
+
+    def test_reader_bookcopy_is_cached_until_a_checkout(self):
+        first = self.client.get(reverse('reader_bookcopy'))
+        # Only the session and user are read when the page is cached.
+        with self.assertNumQueries(2):
+            second = self.client.get(reverse('reader_bookcopy'))
+        self.assertEqual(first.content, second.content)
+        self.assertFalse('borrowed' in second.content)
+
+        self.bookcopies[0].do_borrow(self.other, datetime.now(pytz.utc))
+        response = self.client.get(reverse('reader_bookcopy'))
+        self.assertEqual(response.content.count('borrowed'), 1)
+        # A copy on another page does not change this page.
+        self.bookcopies[12].do_borrow(self.other, datetime.now(pytz.utc))
+        with self.assertNumQueries(2):
+            self.client.get(reverse('reader_bookcopy'))
+
+    def test_reader_bookcopy_depends_on_the_reader(self):
+        self.bookcopies[0].do_reserve(self.user, datetime.now(pytz.utc))
+        self.assertTrue('reserved (mine)' in self.client.get(reverse('reader_bookcopy')).content)
+        self.client.login(username='other', password='secret')
+        response = self.client.get(reverse('reader_bookcopy'))
+        self.assertFalse('reserved (mine)' in response.content)
+        self.assertTrue('reserved' in response.content)
+
+    def test_admin_list_is_cached_until_a_save(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        self.client.get(reverse('admin_librarybranch'))
+        with self.assertNumQueries(2):
+            self.client.get(reverse('admin_librarybranch'))
+        self.branches[0].name = "Renamed Library"
+        self.branches[0].save()
+        self.assertTrue('Renamed Library' in self.client.get(reverse('admin_librarybranch')).content)
+
+
+class SessionBenchmarkTest(TestCase):
+    def test_cached_sessions_save_queries(self):
+        output = os.path.join(tempfile.mkdtemp(), 'sessions.json')
+        # Using the configured database writes to it, so it must be confirmed.
+        self.assertRaises(CommandError, call_command, 'benchmark_sessions',
+                          existing=True, requests=1, stdout=StringIO())
+        call_command('benchmark_sessions', existing=True, allow_writes=True, requests=3,
+                     output=output, sessions='db,cached_db,signed_cookies',
+                     stdout=StringIO())
+        # The user of the run is gone.
+        self.assertFalse(User.objects.exists())
+        with open(output) as f:
+            results = json.load(f)
+        # The database session is read on every request, besides the user.
+        self.assertEqual(results['db']['queries_mean'], 2)
+        self.assertEqual(results['cached_db']['queries_mean'], 1)
+        self.assertEqual(results['signed_cookies']['queries_mean'], 1)
+
+
+class ExportTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=5)
+        self.user = User.objects.create_user('reader')
+        now = datetime(2013, 6, 10, 12, 0, tzinfo=pytz.utc)
+        for bookcopy in self.bookcopies:
+            bookcopy.do_borrow(self.user, now)
+            bookcopy.do_return(self.user, now + timedelta(days=1))
+
+    def test_checkouts_are_read_in_chunks(self):
+        with self.assertNumQueries(3):
+            chunks = list(exports.export('checkouts', 'csv', chunk_size=3))
+        self.assertEqual(len(chunks), 3)
+        lines = ''.join(chunks).splitlines()
+        self.assertEqual(lines[0], 'id,bookcopy,username,library_branch,'
+                         'reserve_date,borrow_date,return_date')
+        self.assertEqual(len(lines), 6)
+        self.assertEqual(lines[1].split(',')[2:], [
+                'reader', 'Texas Main Library 0', '',
+                '2013-06-10T12:00:00+00:00', '2013-06-11T12:00:00+00:00'])
+
+    def test_jsonl_and_gzip(self):
+        content = ''.join(exports.export('bookcopies', 'jsonl', compress=True, chunk_size=2))
+        rows = [json.loads(line) for line in zlib.decompress(content, 16 + zlib.MAX_WBITS)
+                .splitlines()]
+        self.assertEqual([row['position'] for row in rows], ['P00000', 'P00001', 'P00002',
+                                                             'P00003', 'P00004'])
+        self.assertEqual(rows[0]['isbn'], self.book.isbn)
+
+    def test_view(self):
+        User.objects.create_superuser('admin', 'admin@example.com', 'secret')
+        self.client.login(username='admin', password='secret')
+        response = self.client.get(reverse('admin_export', args=['books']), {'gzip' : '1'})
+        self.assertEqual(response['Content-Type'], 'application/gzip')
+        self.assertTrue('books.csv.gz' in response['Content-Disposition'])
+        content = zlib.decompress(''.join(response.streaming_content), 16 + zlib.MAX_WBITS)
+        self.assertTrue('Rearing Birds' in content)
+        response = self.client.get(reverse('admin_export', args=['users']))
+        self.assertEqual(response.status_code, 404)
+
+    def test_command(self):
+        output = os.path.join(tempfile.mkdtemp(), 'bookcopies.csv')
+        call_command('export_data', 'bookcopies', output=output, stdout=StringIO())
+        with open(output) as f:
+            result = importers.import_bookcopies(importers.read_rows(f, 'csv'))
+        # The copies exist already, so every row is rejected.
+        self.assertEqual((result.row_count, result.created_count), (5, 0))
+        self.assertRaises(CommandError, call_command, 'export_data', 'users', stdout=StringIO())
+
+
+class ApiTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=5, branch_count=2)
+        self.user = User.objects.create_user('reader')
+
+    def get_json(self, name, args=(), **params):
+        response = self.client.get(reverse(name, args=args), params)
+        self.assertEqual(response.status_code, 200)
+        return response, json.loads(response.content)
+
+    def test_cursor_pages_and_fields(self):
+        ids = []
+        params = {'limit' : '2', 'fields' : 'id,status'}
+        while True:
+            response, content = self.get_json('api_bookcopies', **params)
+            ids.extend(row['id'] for row in content['results'])
+            self.assertEqual(set(content['results'][0]), set(['id', 'status']))
+            if not content['next']:
+                break
+            params['cursor'] = content['next']
+        self.assertEqual(ids, [bookcopy.id for bookcopy in self.bookcopies])
+        response, content = self.get_json('api_books', fields='title,authors')
+        self.assertEqual(content['results'], [{'title' : 'Rearing Birds', 'authors' : []}])
+
+    def test_conditional_get(self):
+        params = {'book' : str(self.book.id), 'library_branch' : str(self.branches[0].id)}
+        response, content = self.get_json('api_bookcopies', **params)
+        self.assertEqual([row['status'] for row in content['results']], ['available'] * 3)
+        with self.assertNumQueries(0):
+            not_modified = self.client.get(reverse('api_bookcopies'), params,
+                                           HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(not_modified.status_code, 304)
+        # Last-Modified is only precise to the second, so it is not sent and
+        # If-Modified-Since alone never gets a 304.
+        self.assertFalse(response.has_header('Last-Modified'))
+        self.assertEqual(self.client.get(reverse('api_bookcopies'), params,
+                                         HTTP_IF_MODIFIED_SINCE='Fri, 01 Jan 2100 00:00:00 GMT')
+                         .status_code, 200)
+
+        self.bookcopies[0].do_borrow(self.user, datetime.now(pytz.utc))
+        changed = self.client.get(reverse('api_bookcopies'), params,
+                                  HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(changed.status_code, 200)
+        self.assertNotEqual(changed['ETag'], response['ETag'])
+        self.assertEqual(json.loads(changed.content)['results'][0]['status'], 'borrowed')
+        # Copies at the other branch are not shown, so their version is not used.
+        other = self.client.get(reverse('api_bookcopies'), {'book' : str(self.book.id),
+                                                            'fields' : 'id'})
+        self.bookcopies[1].do_borrow(self.user, datetime.now(pytz.utc))
+        self.assertEqual(self.client.get(reverse('api_bookcopies'), {
+                    'book' : str(self.book.id), 'fields' : 'id'},
+                    HTTP_IF_NONE_MATCH=other['ETag']).status_code, 304)
+
+    def test_etag_changes_after_checkout_commits(self):
+        # A poll racing a return may see the versions bumped inside its transaction.
+        params = {'book' : str(self.book.id)}
+        etags = []
+        def returned(sender, checkout, **kwargs):
+            etags.append(self.client.get(reverse('api_bookcopies'), params)['ETag'])
+        now = datetime.now(pytz.utc)
+        checkout_bookcopy(self.user, self.bookcopies[0].id, 'borrow', now)
+        signals.checkout_returned.connect(returned)
+        try:
+            checkout_bookcopy(self.user, self.bookcopies[0].id, 'return', now)
+        finally:
+            signals.checkout_returned.disconnect(returned)
+        self.assertEqual(self.client.get(reverse('api_bookcopies'), params,
+                                         HTTP_IF_NONE_MATCH=etags[0]).status_code, 200)
+
+    def test_availability(self):
+        self.bookcopies[0].do_reserve(self.user, datetime.now(pytz.utc))
+        response, content = self.get_json('api_book_availability', args=[self.book.id])
+        self.assertEqual([(branch['id'], branch['available'], branch['copies'])
+                          for branch in content['library_branches']],
+                         [(self.branches[0].id, 2, 3), (self.branches[1].id, 2, 2)])
+        self.assertEqual(self.client.get(reverse('api_book_availability', args=[999])).status_code,
+                         404)
+
+    def test_bad_parameters(self):
+        for params in ({'limit' : '0'}, {'fields' : 'id,password'}, {'cursor' : 'forged'},
+                       {'book' : 'x'}):
+            response = self.client.get(reverse('api_bookcopies'), params)
+            self.assertEqual(response.status_code, 400)
+            self.assertTrue('error' in json.loads(response.content))
+
+
+class AvailabilityTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=4, branch_count=2)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.now = datetime(2013, 6, 10, 9, 0, tzinfo=pytz.utc)
+
+    def counts(self):
+        return sorted(BookAvailability.objects.values_list(
+                'book', 'library_branch', 'available_count', 'copy_count'))
+
+    def assertCounts(self, expected):
+        # The maintained counts are the ones a rebuild finds.
+        self.assertEqual(self.counts(), sorted(expected))
+        call_command('rebuild_availability', stdout=StringIO())
+        self.assertEqual(self.counts(), sorted(expected))
+
+    def test_checkouts(self):
+        book_id, first, second = self.book.id, self.branches[0].id, self.branches[1].id
+        self.assertCounts([(book_id, first, 2, 2), (book_id, second, 2, 2)])
+        self.bookcopies[0].do_reserve(self.user, self.now)
+        self.bookcopies[1].do_borrow(self.user, self.now)
+        self.assertCounts([(book_id, first, 1, 2), (book_id, second, 1, 2)])
+        # Borrowing a reserved copy does not take another one.
+        self.bookcopies[0].do_borrow(self.user, self.now + timedelta(hours=1))
+        self.bookcopies[1].do_return(self.user, self.now + timedelta(hours=1))
+        self.assertCounts([(book_id, first, 1, 2), (book_id, second, 2, 2)])
+
+        self.bookcopies[2].do_reserve(self.user, self.now)
+        self.assertCounts([(book_id, first, 0, 2), (book_id, second, 2, 2)])
+        self.assertEqual(BookCopy.objects.expire_reservations(self.now + timedelta(days=1)), 1)
+        self.assertCounts([(book_id, first, 1, 2), (book_id, second, 2, 2)])
+
+    def test_copies_added_moved_and_deleted(self):
+        book_id, first, second = self.book.id, self.branches[0].id, self.branches[1].id
+        self.bookcopies[0].do_borrow(self.user, self.now)
+        bookcopy = BookCopy.objects.get(id=self.bookcopies[0].id)
+        bookcopy.library_branch = self.branches[1]
+        bookcopy.save()
+        self.assertCounts([(book_id, first, 1, 1), (book_id, second, 2, 3)])
+        self.bookcopies[2].delete()
+        self.assertEqual(self.counts(), [(book_id, second, 2, 3)])
+        BookCopy.objects.create(book=self.book, library_branch=self.branches[0],
+                                copy_number=9, position="P00009")
+        self.assertCounts([(book_id, first, 1, 1), (book_id, second, 2, 3)])
+
+    def test_catalog_view(self):
+        for index in range(0, 5):
+            Book.objects.create(title="Book %d" % index, isbn="97800000001%02d" % index,
+                                publisher=self.book.publisher,
+                                publication_date=date(2001, 1, 1))
+        self.bookcopies[0].do_borrow(self.user, self.now)
+        self.client.login(username='reader', password='secret')
+        response = self.client.get(reverse('reader_catalog'))
+        self.assertTrue('1 of 2 copies available at Texas Main Library 0' in response.content)
+        self.assertTrue('2 of 2 copies available at Texas Main Library 1' in response.content)
+        self.assertEqual(len(response.context['book_list']), 6)
+        # The page of titles is found by keyset, then all counts with one query.
+        with record_queries(connection) as stats:
+            self.client.get(reverse('reader_catalog'))
+        Book.objects.create(title="Book 6", isbn="9780000000199",
+                            publisher=self.book.publisher, publication_date=date(2001, 1, 1))
+        with self.assertNumQueries(stats.count):
+            self.client.get(reverse('reader_catalog'))
+
+
+class FinderTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=3, branch_count=3)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.now = datetime(2013, 6, 10, 9, 0, tzinfo=pytz.utc)
+
+    def branch_ids(self, home_branch_id=None):
+        return [library_branch_id for library_branch_id, name
+                in finder.available_branches(self.book.id, home_branch_id)]
+
+    def test_available_branches(self):
+        first, second, third = [library_branch.id for library_branch in self.branches]
+        self.assertEqual(self.branch_ids(), [first, second, third])
+        self.assertEqual(self.branch_ids(third), [third, first, second])
+        # A lookup with nothing changed reads only the versions from the cache.
+        with self.assertNumQueries(0):
+            self.assertEqual(self.branch_ids(second), [second, first, third])
+        # Checkouts keep the index up to date.
+        self.bookcopies[1].do_borrow(self.user, self.now)
+        self.assertEqual(self.branch_ids(second), [first, third])
+        self.bookcopies[0].do_reserve(self.user, self.now)
+        self.assertEqual(self.branch_ids(), [third])
+        BookCopy.objects.expire_reservations(self.now + timedelta(days=1))
+        self.bookcopies[1].do_return(self.user, self.now + timedelta(days=1))
+        self.assertEqual(self.branch_ids(), [first, second, third])
+        # So do new branches, and copies added to them.
+        library_branch = LibraryBranch.objects.create(name="Austin Public Library",
+                                                      address="802 Atlantic Avenue")
+        BookCopy.objects.create(book=self.book, library_branch=library_branch,
+                                copy_number=9, position="P00009")
+        self.assertEqual(self.branch_ids(), [library_branch.id, first, second, third])
+
+    def test_index_size_is_bounded(self):
+        other_book = Book.objects.create(title="Rearing Fish", isbn="9780000000002",
+                                         publisher=self.book.publisher,
+                                         publication_date=date(2001, 1, 1))
+        original = finder.INDEX_SIZE
+        finder.INDEX_SIZE = 1
+        try:
+            finder.available_branches(self.book.id)
+            finder.available_branches(other_book.id)
+        finally:
+            finder.INDEX_SIZE = original
+        self.assertEqual(list(finder.availability_index.books), [other_book.id])
+
+    def test_checkout_suggests_branches(self):
+        other = User.objects.create_user('other', 'other@example.com', 'secret')
+        Reader.objects.create(user=self.user, address="1 Main Street",
+                              phone_number="555-0100", home_branch=self.branches[2])
+        self.bookcopies[0].do_borrow(other, self.now)
+        self.client.login(username='reader', password='secret')
+        response = self.client.get(reverse('reader_checkout'), {'id' : self.bookcopies[0].id})
+        self.assertEqual(response.context['error'], "Book is not available!")
+        self.assertEqual(response.context['library_branch_list'],
+                         [(self.branches[2].id, self.branches[2].name),
+                          (self.branches[1].id, self.branches[1].name)])
+        self.assertTrue('A copy is available at:' in response.content)
+
+
+class HoldTest(TestCase):
+    def setUp(self):
+        self.book, self.branches, self.bookcopies = create_catalog(copy_count=2)
+        self.user = User.objects.create_user('reader', 'reader@example.com', 'secret')
+        self.readers = [User.objects.create_user('reader%d' % index, 'reader@example.com',
+                                                 'secret') for index in range(0, 3)]
+        self.now = datetime.now(pytz.utc) - timedelta(days=3)
+
+    def available_count(self):
+        return BookAvailability.objects.get(book=self.book).available_count
+
+    def checkout(self, user, bookcopy, action, now=None):
+        return checkout_bookcopy(user, bookcopy.id, action, now or self.now)
+
+    def test_queue(self):
+        self.assertRaises(ValueError, self.checkout, self.readers[0], self.bookcopies[0], 'hold')
+        for bookcopy in self.bookcopies:
+            self.checkout(self.user, bookcopy, 'borrow')
+        for reader in self.readers:
+            self.checkout(reader, self.bookcopies[0], 'hold')
+        self.assertRaises(ValueError, self.checkout, self.readers[0], self.bookcopies[1], 'hold')
+        self.assertEqual([holds.queue_position(hold) for hold in BookHold.objects.order_by('id')],
+                         [1, 2, 3])
+
+        # A returned copy is reserved for the first reader in the queue.
+        later = self.now + timedelta(hours=1)
+        self.checkout(self.user, self.bookcopies[1], 'return', later)
+        bookcopy = BookCopy.objects.get(id=self.bookcopies[1].id)
+        self.assertEqual(bookcopy.status(self.readers[0], later), 'reserved (mine)')
+        self.assertEqual(bookcopy.status(self.readers[1], later), 'reserved')
+        self.assertEqual(self.available_count(), 0)
+        self.assertEqual(list(BookHold.objects.order_by('id').values_list('status', flat=True)),
+                         ['ready', 'waiting', 'waiting'])
+        # Borrowing it claims the hold.
+        self.checkout(self.readers[0], self.bookcopies[1], 'borrow', later)
+        self.checkout(self.user, self.bookcopies[0], 'return', later)
+        self.assertEqual(list(BookHold.objects.order_by('id').values_list('status', flat=True)),
+                         ['claimed', 'ready', 'waiting'])
+        self.assertEqual(BookCopy.objects.get(id=self.bookcopies[0].id)
+                         .status(self.readers[1], later), 'reserved (mine)')
+
+    def test_readers_at_the_limit_are_passed_over(self):
+        other_book = Book.objects.create(title="Rearing Fish", isbn="9780000000002",
+                                         publisher=self.book.publisher,
+                                         publication_date=date(2001, 1, 1))
+        other_bookcopy = BookCopy.objects.create(book=other_book, library_branch=self.branches[0],
+                                                 copy_number=0, position="Q00000")
+        for bookcopy in self.bookcopies:
+            self.checkout(self.user, bookcopy, 'borrow')
+        for reader in self.readers[0:2]:
+            self.checkout(reader, self.bookcopies[0], 'hold')
+        self.checkout(self.readers[0], other_bookcopy, 'borrow')
+        original = holds.MAX_ACTIVE_CHECKOUTS
+        holds.MAX_ACTIVE_CHECKOUTS = 1
+        try:
+            self.checkout(self.user, self.bookcopies[0], 'return')
+        finally:
+            holds.MAX_ACTIVE_CHECKOUTS = original
+        # The first reader keeps their place for the next copy.
+        self.assertEqual(list(BookHold.objects.order_by('id').values_list('status', flat=True)),
+                         ['waiting', 'ready'])
+        self.checkout(self.user, self.bookcopies[1], 'return')
+        self.assertEqual(list(BookHold.objects.order_by('id').values_list('status', flat=True)),
+                         ['ready', 'ready'])
+
+    def test_ready_holds_count_toward_the_limit(self):
+        original = holds.MAX_HOLDS
+        holds.MAX_HOLDS = 1
+        try:
+            for bookcopy in self.bookcopies:
+                self.checkout(self.user, bookcopy, 'borrow')
+            self.checkout(self.readers[0], self.bookcopies[0], 'hold')
+            self.checkout(self.user, self.bookcopies[0], 'return')
+            other_book = Book.objects.create(title="Rearing Fish", isbn="9780000000002",
+                                             publisher=self.book.publisher,
+                                             publication_date=date(2001, 1, 1))
+            other_bookcopy = BookCopy.objects.create(
+                book=other_book, library_branch=self.branches[0], copy_number=0,
+                position="Q00000")
+            self.checkout(self.user, other_bookcopy, 'borrow')
+            self.assertRaises(ValueError, self.checkout, self.readers[0], other_bookcopy, 'hold')
+        finally:
+            holds.MAX_HOLDS = original
+
+    def test_unclaimed_holds_expire(self):
+        self.checkout(self.user, self.bookcopies[0], 'borrow')
+        self.checkout(self.user, self.bookcopies[1], 'borrow')
+        for reader in self.readers[0:2]:
+            self.checkout(reader, self.bookcopies[0], 'hold')
+        self.checkout(self.user, self.bookcopies[0], 'return')
+
+        # The first reader did not come by 6PM, so the copy goes to the next one.
+        stdout = StringIO()
+        call_command('expire_reservations', stdout=stdout)
+        self.assertTrue(stdout.getvalue().startswith('Expired 1 reservations and 1 holds'))
+        self.assertEqual(list(BookHold.objects.order_by('id').values_list('status', flat=True)),
+                         ['expired', 'ready'])
+        now = datetime.now(pytz.utc)
+        self.assertEqual(BookCopy.objects.get(id=self.bookcopies[0].id)
+                         .status(self.readers[1], now), 'reserved (mine)')
+        self.assertEqual(self.available_count(), 0)
+        # With nobody left waiting, the copy is available again.
+        BookCopy.objects.expire_reservations(now + timedelta(days=2))
+        self.assertEqual(self.available_count(), 1)
+        call_command('rebuild_availability', stdout=StringIO())
+        self.assertEqual(self.available_count(), 1)
+
+    def test_hold_view(self):
+        other = User.objects.create_user('other', 'other@example.com', 'secret')
+        for bookcopy in self.bookcopies:
+            self.checkout(other, bookcopy, 'borrow')
+        self.client.login(username='reader0', password='secret')
+        response = self.client.post(reverse('reader_checkout'), {
+                'id' : self.bookcopies[0].id, 'title' : self.book.title,
+                'authors' : '-', 'action' : 'hold'})
+        self.assertRedirects(response, reverse('reader_mybooks'))
+        response = self.client.get(reverse('reader_mybooks'))
+        self.assertEqual([(hold['title'], hold['position'])
+                          for hold in response.context['hold_list']], [(self.book.title, 1)])
@@ -14,17 +14,32 @@ urlpatterns = patterns('',
     url(r'^admin/librarybranch$', 'library.views.admin_librarybranch', name='admin_librarybranch'),
     url(r'^admin/reader$', 'library.views.admin_reader', name='admin_reader'),
     url(r'^admin/reader/add$', 'library.views.admin_reader_add', name='admin_reader_add'),
+    url(r'^admin/reader/import$', 'library.views.admin_reader_import',
+        name='admin_reader_import'),
     url(r'^admin/bookcopy$', 'library.views.admin_bookcopy', name='admin_bookcopy'),
     url(r'^admin/bookcopy/add$', 'library.views.admin_bookcopy_add', name='admin_bookcopy_add'),
+    url(r'^admin/bookcopy/import$', 'library.views.admin_bookcopy_import',
+        name='admin_bookcopy_import'),
+    url(r'^admin/book/typeahead$', 'library.views.admin_book_typeahead',
+        name='admin_book_typeahead'),
     url(r'^admin/librarybranch_statistics$', 'library.views.admin_librarybranch_statistics',
         name='admin_librarybranch_statistics'),
+    url(r'^admin/query_stats$', 'library.views.admin_query_stats', name='admin_query_stats'),
+    url(r'^admin/export/(?P<name>\w+)$', 'library.views.admin_export', name='admin_export'),
 
     # Reader views.
     url(r'^dashboard$', 'library.views.dashboard_view', name='dashboard'),
     url(r'^reader_bookcopy$', 'library.views.reader_bookcopy', name='reader_bookcopy'),
+    url(r'^reader_catalog$', 'library.views.reader_catalog', name='reader_catalog'),
     url(r'^reader_checkout$', 'library.views.reader_checkout', name='reader_checkout'),
     url(r'^reader_mybooks$', 'library.views.reader_mybooks', name='reader_mybooks'),
 
+    # Read-only JSON API of the catalog.
+    url(r'^api/books$', 'library.api.books', name='api_books'),
+    url(r'^api/books/(?P<book_id>\d+)/availability$', 'library.api.book_availability',
+        name='api_book_availability'),
+    url(r'^api/bookcopies$', 'library.api.bookcopies', name='api_bookcopies'),
+
     # Examples:
     # url(r'^$', 'librarysite.views.home', name='home'),
     # url(r'^librarysite/', include('librarysite.foo.urls')),
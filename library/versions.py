@@ -0,0 +1,144 @@
+"""
+Version numbers of cached data, changed whenever the data changes.
+
+Cached values are stored under keys that hold the versions of everything
+they were built from, so a change never needs to find and delete them:
+the next read simply misses and the stale values expire.  The versions are
+kept in the cache too, so every process must share one cache (see CACHES
+in the settings) for a change in one process to be seen by the others.
+
+A version bumped inside a transaction is seen by other processes before
+the change is, and a value they build in between is stored under it with
+the old data.  Writers that hold a transaction open therefore bump again
+after it commits, like library.checkout and the 'expire_reservations'
+command.
+
+    'book'          books, their authors and publishers
+    'librarybranch' library branches
+    'reader'        readers and their users
+    'bookcopy'      which book copies exist, and where
+    'bookcopy.<id>' the checkout status of one book copy
+    'availability'  all the counts of available copies, when recounted
+    'availability.<id>' the counts of available copies of one book
+"""
+
+import hashlib
+from time import time
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db.models.signals import m2m_changed, post_delete, post_save
+
+from .models import Author, Book, BookCopy, LibraryBranch, Publisher, Reader
+
+# Seconds a version is kept.  A version that expired is replaced by a newer
+# one, which only makes the values built from it be built again.
+VERSION_TIMEOUT = 24 * 60 * 60
+
+# Seconds a cached template fragment is kept.
+FRAGMENT_TIMEOUT = 10 * 60
+
+
+def version_key(name):
+    return 'library.version.%s' % name
+
+
+def new_version():
+    """
+    Versions are times in microseconds, so a version that was evicted from
+    the cache is never reused.
+    @return int
+    """
+    return int(time() * 1000000)
+
+
+def get_versions(names):
+    """
+    Read the versions of many names with a single cache lookup.
+    @param names:Array<string>
+    @return Array<int>, in the order of the names
+    """
+    keys = [version_key(name) for name in names]
+    versions = cache.get_many(keys)
+    missing = dict((key, new_version()) for key in keys if key not in versions)
+    if missing:
+        cache.set_many(missing, VERSION_TIMEOUT)
+        versions.update(missing)
+    return [versions[key] for key in keys]
+
+
+def get_version(name):
+    """
+    @return int, the current version of a name
+    """
+    return get_versions([name])[0]
+
+
+def bump(*names):
+    """
+    Give names new versions, after the data they stand for has changed.
+    """
+    version = new_version()
+    cache.set_many(dict((version_key(name), version) for name in names), VERSION_TIMEOUT)
+
+
+def bump_bookcopies(bookcopy_ids):
+    """
+    Give the checkout status of book copies new versions.
+    """
+    if bookcopy_ids:
+        bump(*['bookcopy.%d' % bookcopy_id for bookcopy_id in bookcopy_ids])
+
+
+def bump_availability(book_ids):
+    """
+    Give the counts of available copies of books new versions.
+    """
+    if book_ids:
+        bump(*['availability.%d' % book_id for book_id in set(book_ids)])
+
+
+def bookcopy_versions(bookcopy_ids):
+    """
+    @return Array<int>, the versions of the checkout status of book copies
+    """
+    return get_versions(['bookcopy.%d' % bookcopy_id for bookcopy_id in bookcopy_ids])
+
+
+def fragment_key(*parts):
+    """
+    Make a short cache key from the parts a cached value depends on.
+    @return string
+    """
+    return hashlib.md5(repr(parts)).hexdigest()
+
+
+def book_changed(sender, **kwargs):
+    bump('book')
+
+def librarybranch_changed(sender, **kwargs):
+    bump('librarybranch')
+
+def reader_changed(sender, **kwargs):
+    bump('reader')
+
+def bookcopy_saved(sender, instance, created, update_fields=None, **kwargs):
+    # Checkouts only save current_checkout, and bump the copy themselves.
+    if update_fields is None or 'current_checkout' not in update_fields \
+            or len(update_fields) > 1:
+        bump('bookcopy', 'bookcopy.%d' % instance.id)
+
+def bookcopy_deleted(sender, instance, **kwargs):
+    bump('bookcopy', 'bookcopy.%d' % instance.id)
+
+for model in (Book, Author, Publisher):
+    post_save.connect(book_changed, sender=model)
+    post_delete.connect(book_changed, sender=model)
+m2m_changed.connect(book_changed, sender=Book.authors.through)
+post_save.connect(librarybranch_changed, sender=LibraryBranch)
+post_delete.connect(librarybranch_changed, sender=LibraryBranch)
+for model in (Reader, User):
+    post_save.connect(reader_changed, sender=model)
+    post_delete.connect(reader_changed, sender=model)
+post_save.connect(bookcopy_saved, sender=BookCopy)
+post_delete.connect(bookcopy_deleted, sender=BookCopy)
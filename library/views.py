@@ -1,20 +1,33 @@
-from datetime import datetime, timedelta
+from datetime import datetime
+import json
 import pytz
+import re
 
 from django import forms
+from django.conf import settings
 from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import login, logout, authenticate
 from django.contrib.auth.decorators import login_required
 from django.contrib.auth.forms import AuthenticationForm
 from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.core.cache import cache
 from django.core.urlresolvers import reverse
-from django.db.models import Avg, Max, Min, Count
-from django.db import connection
-from django.http import HttpResponse, HttpResponseRedirect, Http404
+from django.http import HttpResponse, HttpResponseRedirect, Http404, StreamingHttpResponse
 from django.shortcuts import render
 
-from .models import Reader, Book, BookCopy, BookCopyCheckout, LibraryBranch
+from . import choices, exports, holds, importers, stats, versions
+from .checkout import checkout_bookcopy
+from .finder import available_branches
+from .listing import (KeysetPage, Page, bookcopy_rows, bookcopy_rows_by_id,
+                      cached_keyset_context, get_page_number)
+from .middleware import request_stats
+from .models import (Reader, Book, BookAvailability, BookCopy, BookHold,
+                     BookNotAvailable, LibraryBranch, reserve_cutoff_date)
+from .search import SEARCH_LIMIT, rank_bookcopies, search_books
+
+# The number of titles shown on a page of the catalog.
+CATALOG_LIMIT = 50
 
 def index(request):
     context = {}
@@ -55,39 +68,15 @@ def admin_view(request):
 @login_required
 @staff_member_required
 def admin_librarybranch(request):
-    page = int(request.GET.get('page', '1'))
-    limit = 10
-    offset = limit * (page - 1)
-
-    librarybranch_list = LibraryBranch.objects.all()[offset : offset + limit]
-    page_count = LibraryBranch.objects.count() / limit + 1
-    context = {
-        "librarybranch_list" : librarybranch_list,
-        "page_count" : page_count,
-        "page" : page,
-        "pages" : range(1, page_count + 1),
-        "page_prev" : max(page - 1, 1),
-        "page_next" : min(page + 1, page_count)
-        }
+    context = cached_keyset_context(LibraryBranch.objects.all(), request.GET.get('cursor'),
+                                    "librarybranch_list", ['librarybranch'])
     return render(request, 'library/admin_librarybranch.html', context)
 
 @login_required
 @staff_member_required
 def admin_reader(request):
-    page = int(request.GET.get('page', '1'))
-    limit = 10
-    offset = limit * (page - 1)
-
-    reader_list = Reader.objects.all()[offset : offset + limit]
-    page_count = Reader.objects.count() / limit + 1
-    context = {
-        "reader_list" : reader_list,
-        "page_count" : page_count,
-        "page" : page,
-        "pages" : range(1, page_count + 1),
-        "page_prev" : max(page - 1, 1),
-        "page_next" : min(page + 1, page_count)
-        }
+    context = cached_keyset_context(Reader.objects.all().select_related('user'), request.GET.get('cursor'),
+                                    "reader_list", ['reader'])
     return render(request, 'library/admin_reader.html', context)
 
 
@@ -102,6 +91,12 @@ class ReaderForm(forms.Form):
     phone_number = forms.CharField(max_length=20)
     username = forms.CharField(max_length=20)
     password = forms.CharField(max_length=20)
+    home_branch = forms.TypedChoiceField(coerce=int, required=False, empty_value=None)
+
+    def __init__(self, *args, **kwargs):
+        super(ReaderForm, self).__init__(*args, **kwargs)
+        self.fields['home_branch'].choices = [('', '---------')] + \
+            choices.librarybranch_choices()
     
 
 @login_required
@@ -126,6 +121,7 @@ def admin_reader_add(request):
             reader.user = user
             reader.address = form.cleaned_data['address']
             reader.phone_number = form.cleaned_data['phone_number']
+            reader.home_branch_id = form.cleaned_data['home_branch']
             reader.save()
             
             return HttpResponseRedirect(reverse('admin_reader')) # Redirect after POST
@@ -136,23 +132,50 @@ def admin_reader_add(request):
         'form': form,
     })
 
+class ReaderImportForm(forms.Form):
+    """
+    Form for uploading a file of new Readers.
+    """
+    file = forms.FileField(label="File")
+    FORMAT_CHOICES = (
+        ('', 'From the file name',),
+        ('csv', 'CSV',),
+        ('jsonl', 'JSON lines',))
+    format = forms.ChoiceField(label="Format", choices=FORMAT_CHOICES, required=False)
+
 @login_required
 @staff_member_required
-def admin_bookcopy(request):
-    page = int(request.GET.get('page', '1'))
-    limit = 10
-    offset = limit * (page - 1)
+def admin_reader_import(request):
+    """
+    Upload a file of readers, which is imported by 'import_readers
+    --pending', and follow the progress of the import.
+    """
+    if request.method == 'POST':
+        form = ReaderImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            format = form.cleaned_data['format'] or importers.guess_format(upload.name)
+            job = importers.start_reader_import(upload, format)
+            return HttpResponseRedirect(reverse('admin_reader_import') + '?job=' + job)
+    else:
+        form = ReaderImportForm()
 
-    bookcopy_list = BookCopy.objects.all()[offset : offset + limit]
-    page_count = BookCopy.objects.count() / limit + 1
-    context = {
-        "bookcopy_list" : bookcopy_list,
-        "page_count" : page_count,
-        "page" : page,
-        "pages" : range(1, page_count + 1),
-        "page_prev" : max(page - 1, 1),
-        "page_next" : min(page + 1, page_count)
-        }
+    job = request.GET.get('job', '')
+    progress = None
+    if re.match(r'^[0-9a-f]{32}$', job):
+        progress = importers.read_progress(importers.progress_path(job))
+        if progress is None:
+            raise Http404
+    return render(request, 'library/admin_reader_import.html', {
+        'form': form,
+        'progress': progress,
+    })
+
+@login_required
+@staff_member_required
+def admin_bookcopy(request):
+    context = cached_keyset_context(BookCopy.objects.all().select_related('book'), request.GET.get('cursor'),
+                                    "bookcopy_list", ['bookcopy', 'book'])
     return render(request, 'library/admin_bookcopy.html', context)
 
 class BookCopyForm(forms.Form):
@@ -162,18 +185,22 @@ class BookCopyForm(forms.Form):
     library_branch = forms.ChoiceField(label="Library Branch",
                                        choices=(),
                                        widget=forms.Select())
-    book = forms.ChoiceField(label="Book",
-                             choices=(),
-                             widget=forms.Select())
+    # The title is only typed to find the book, whose id is sent.
+    book_title = forms.CharField(label="Book", required=False)
+    book = forms.IntegerField(widget=forms.HiddenInput(), error_messages={
+            'required' : 'Choose a book from the suggestions.'})
     copy_number = forms.IntegerField(label="Copy Number", min_value=1)
     position = forms.CharField(max_length=30)
 
     def __init__(self, *args, **kwargs):
         super(BookCopyForm, self).__init__(*args, **kwargs)
-        library_branch_choices = [(lb.id, lb.name) for lb in LibraryBranch.objects.all()]
-        self.fields['library_branch'].choices = library_branch_choices
-        book_choices = [(b.id, b.title[0:40]) for b in Book.objects.all()]
-        self.fields['book'].choices = book_choices
+        self.fields['library_branch'].choices = choices.librarybranch_choices()
+
+    def clean_book(self):
+        try:
+            return Book.objects.get(id=self.cleaned_data['book'])
+        except Book.DoesNotExist:
+            raise forms.ValidationError('Choose a book from the suggestions.')
 
 
 @login_required
@@ -184,10 +211,8 @@ def admin_bookcopy_add(request):
         form = BookCopyForm(request.POST) # Initialize form with data.
         if form.is_valid():
             bookcopy = BookCopy()
-            bookcopy.book = Book.objects.get(
-                id=form.cleaned_data['book'])
-            bookcopy.library_branch = LibraryBranch.objects.get(
-                id=form.cleaned_data['library_branch'])
+            bookcopy.book = form.cleaned_data['book']
+            bookcopy.library_branch_id = int(form.cleaned_data['library_branch'])
             bookcopy.copy_number = form.cleaned_data['copy_number']
             bookcopy.position = form.cleaned_data['position']
             bookcopy.save()
@@ -199,6 +224,50 @@ def admin_bookcopy_add(request):
         'form': form,
     })
 
+class BookCopyImportForm(forms.Form):
+    """
+    Form for uploading a file of new BookCopy rows.
+    """
+    file = forms.FileField(label="File")
+    FORMAT_CHOICES = (
+        ('', 'From the file name',),
+        ('csv', 'CSV',),
+        ('jsonl', 'JSON lines',))
+    format = forms.ChoiceField(label="Format", choices=FORMAT_CHOICES, required=False)
+    dry_run = forms.BooleanField(label="Only check the rows", required=False)
+
+@login_required
+@staff_member_required
+def admin_bookcopy_import(request):
+    result = None
+    if request.method == 'POST':
+        form = BookCopyImportForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            format = form.cleaned_data['format'] or importers.guess_format(upload.name)
+            # The upload is read a line at a time, not loaded whole.
+            try:
+                result = importers.import_bookcopies(importers.read_rows(upload, format),
+                                                     dry_run=form.cleaned_data['dry_run'])
+            except importers.ImportFileError as e:
+                form.errors['file'] = form.error_class([str(e)])
+    else:
+        form = BookCopyImportForm()
+
+    return render(request, 'library/admin_bookcopy_import.html', {
+        'form': form,
+        'result': result,
+    })
+
+@login_required
+@staff_member_required
+def admin_book_typeahead(request):
+    """
+    Books matching a partly typed title, ISBN, author or publisher, as JSON.
+    """
+    books = choices.book_typeahead(request.GET.get('q', ''))
+    return HttpResponse(json.dumps(books), content_type='application/json')
+
 class LibraryBranchStatisticsForm(forms.Form):
     """
     Form for requesting statistics about a LibraryBranch.
@@ -217,8 +286,7 @@ class LibraryBranchStatisticsForm(forms.Form):
 
     def __init__(self, *args, **kwargs):
         super(LibraryBranchStatisticsForm, self).__init__(*args, **kwargs)
-        library_branch_choices = [(lb.id, lb.name) for lb in LibraryBranch.objects.all()]
-        self.fields['library_branch'].choices = library_branch_choices
+        self.fields['library_branch'].choices = choices.librarybranch_choices()
 
 @login_required
 @staff_member_required
@@ -235,47 +303,20 @@ def admin_librarybranch_statistics(request):
             headers = []
             data = [[3, 4], [5, 6]]
             
-            # Based upon the requested statistic, do the computations.
+            # Based upon the requested statistic, read the maintained totals.
             if statistic == 'borrow':
                 title = "Top Borrowers"
                 headers = ['Username', 'Total Books Borrowed']
-                data = BookCopyCheckout.objects \
-                    .filter(bookcopy__library_branch=library_branch) \
-                    .values_list('user__username') \
-                    .annotate(num_books=Count('id')) \
-                    .order_by('-num_books') \
-                    [:10]  # LIMIT 10
+                data = stats.top_borrowers(library_branch)
             elif statistic == 'books':
                 title = "Top Borrowed Books"
                 headers = ['Book Title', 'Times Borrowed']
-                data = BookCopyCheckout.objects \
-                    .filter(bookcopy__library_branch=library_branch) \
-                    .values_list('bookcopy__book__title') \
-                    .annotate(borrow_count=Count('id')) \
-                    .order_by('-borrow_count') \
-                    [:10]  # LIMIT 10
+                data = stats.top_books(library_branch)
             elif statistic == 'avg_fine':
                 title = "Average Fine"
                 headers = ['Average Fine']
-                # Get a raw SQL connection to compute the average.
-                # There's no easy Django equivalent for this.
-                cursor = connection.cursor()
-                cursor.execute(
-                    '\n'.join([
-                            'SELECT avg(late_days)',
-                            'FROM (',
-                            '  SELECT DateDiff(COALESCE(return_date, now()), borrow_date)',
-                            '    - %s AS late_days',
-                            '  FROM library_bookcopycheckout as bcc, library_bookcopy as bc',
-                            '  WHERE bcc.bookcopy_id = bc.id',
-                            '    AND bc.library_branch_id = %s',
-                            '    AND not isnull(borrow_date)',
-                            '  ) AS t1',
-                            'WHERE late_days > 0']),
-                    [20, library_branch.id]) # Fines are computed when late more than 20 days.
-                avg_late_days = float(cursor.fetchone()[0] or 0.0)
-                data = [['$%.2f' % (avg_late_days * 0.20)]] # 20 cents per day.
-                print "data = ", data
+                average_fine = stats.average_fine(library_branch, datetime.now(pytz.utc))
+                data = [['$%.2f' % average_fine]]
 
             return render(request, 'library/admin_librarybranch_statistics.html', {
                     'form': form,
@@ -292,6 +333,38 @@ def admin_librarybranch_statistics(request):
                 'form': form,
                 })
 
+@login_required
+@staff_member_required
+def admin_query_stats(request):
+    """
+    The query counts and timings of the requests measured by
+    QueryStatsMiddleware, by view, as JSON.  A POST clears them.
+    """
+    if request.method == 'POST':
+        request_stats.reset()
+    content = json.dumps({
+            'sample_rate' : getattr(settings, 'QUERY_STATS_SAMPLE_RATE', 0),
+            'views' : request_stats.summary(),
+            }, indent=2, sort_keys=True)
+    return HttpResponse(content, content_type='application/json')
+
+@login_required
+@staff_member_required
+def admin_export(request, name):
+    """
+    Download the rows of a table as CSV or JSON lines, optionally gzipped.
+    The file is streamed as the rows are read, a chunk at a time.
+    """
+    format = request.GET.get('format', 'csv')
+    compress = request.GET.get('gzip') == '1'
+    if name not in exports.EXPORTS or format not in exports.FORMATS:
+        raise Http404
+    response = StreamingHttpResponse(exports.export(name, format, compress),
+                                     content_type=exports.export_content_type(format, compress))
+    response['Content-Disposition'] = 'attachment; filename="%s"' % \
+        exports.export_filename(name, format, compress)
+    return response
+
 @login_required
 def dashboard_view(request):
     context = {}
@@ -299,98 +372,137 @@ def dashboard_view(request):
 
 @login_required
 def reader_bookcopy(request):
-    page = int(request.GET.get('page', '1'))
-    limit = 10
-    offset = limit * (page - 1)
-
-    bookcopy_set = BookCopy.objects
-    bookcopy_list = []
-
     query = request.GET.get('q', None)
     search_by = request.GET.get('by', None)
-    if search_by == 'mine':
-        bookcopy_set = bookcopy_set.filter(current_checkout__user=request.user)
-    elif query:
-        if search_by == 'title':
-            print "Filtering on title"
-            bookcopy_set = bookcopy_set.filter(book__title__icontains=query)
-        elif search_by == 'isbn':
-            print "Filtering on isbn"
-            bookcopy_set = bookcopy_set.filter(book__isbn__icontains=query)
-        elif search_by == 'publisher':
-            print "Filtering on publisher"
-            bookcopy_set = bookcopy_set.filter(book__publisher__name__icontains=query)
+    number = get_page_number(request)
 
     # Used for finding the status.
     now = datetime.now(pytz.utc)
 
-    bookcopy_list = []
-    for bookcopy in bookcopy_set.all():
-        bookcopy_list.append({
-                "id" : bookcopy.id,
-                "library_branch_name" : bookcopy.library_branch.name,
-                "copy_number" : bookcopy.copy_number,
-                "position": bookcopy.position,
-                "title" : bookcopy.book.title,
-                "isbn" : bookcopy.book.isbn,
-                "publisher_name" : bookcopy.book.publisher.name,
-                "status" : bookcopy.status(request.user, now)
-                })
-
-    page_count = len(bookcopy_list) / limit + 1
-    bookcopy_list = bookcopy_list[offset : offset + limit]
+    def find_page():
+        bookcopy_set = BookCopy.objects.order_by('id')
+        truncated = False
+        if search_by == 'mine':
+            bookcopy_set = bookcopy_set.filter(current_checkout__user=request.user)
+        elif query:
+            # Look up the books in the search index, best matches first.
+            # One book more than shown tells whether the results were cut.
+            if search_by in ('title', 'isbn', 'author', 'publisher'):
+                book_ids = search_books(query, field=search_by, limit=SEARCH_LIMIT + 1)
+            else:
+                # Search all fields at once.
+                book_ids = search_books(query, limit=SEARCH_LIMIT + 1)
+            truncated = len(book_ids) > SEARCH_LIMIT
+            bookcopy_set = rank_bookcopies(bookcopy_set, book_ids[:SEARCH_LIMIT])
+        # Count and slice in the database, only the page is loaded.
+        return Page(bookcopy_set, number), truncated
+
+    # The copies on a page only change when copies or books do, except for
+    # the reader's own copies, so the page is remembered by those versions.
+    catalog_versions = versions.get_versions(['book', 'librarybranch', 'bookcopy'])
+    listing_key = 'library.reader_bookcopy.' + versions.fragment_key(
+        query, search_by, number, catalog_versions)
+    listing = None
+    if search_by != 'mine':
+        listing = cache.get(listing_key)
+    bookcopy_list = None
+    if listing is None:
+        page, truncated = find_page()
+        bookcopy_list = bookcopy_rows(page.object_list, request.user, now)
+        page_context = page.context()
+        page_context['search_truncated'] = truncated
+        listing = ([row.id for row in bookcopy_list], page_context)
+        if search_by != 'mine':
+            cache.set(listing_key, listing, versions.FRAGMENT_TIMEOUT)
+    bookcopy_ids, page_context = listing
+    if bookcopy_list is None:
+        # Only fetched if the table is not cached.
+        bookcopy_list = lambda: bookcopy_rows_by_id(bookcopy_ids, request.user, now)
+
+    # The table shows the status of each copy for this reader, which
+    # changes with the checkouts of the copies and when reservations expire.
+    # The pager links hold the query, so pages of different searches with
+    # the same copies are cached apart.
     context = {
         "query" : query,
         "search_by" : search_by,
         "bookcopy_list" : bookcopy_list,
-        "page_count" : page_count,
-        "page" : page,
-        "pages" : range(1, page_count + 1),
-        "page_prev" : max(page - 1, 1),
-        "page_next" : min(page + 1, page_count)
+        "fragment_key" : versions.fragment_key(
+            query, search_by, page_context['page'], page_context['page_count'],
+            bookcopy_ids, versions.bookcopy_versions(bookcopy_ids), catalog_versions,
+            request.user.id, reserve_cutoff_date(now)),
+        "fragment_timeout" : versions.FRAGMENT_TIMEOUT,
+        "search_limit" : SEARCH_LIMIT,
         }
+    context.update(page_context)
     return render(request, 'library/reader_bookcopy.html', context)
 
 @login_required
-def reader_mybooks(request):
-    page = int(request.GET.get('page', '1'))
-    limit = 10
-    offset = limit * (page - 1)
+def reader_catalog(request):
+    """
+    List the titles, with the number of their copies available at each
+    branch.  The counts of a whole page of titles are read with a single
+    query on the (book, library_branch) index of BookAvailability.
+    """
+    pager = KeysetPage(Book.objects.all(), request.GET.get('cursor'), CATALOG_LIMIT)
+    book_ids = [book.id for book in pager.object_list]
+    availability = dict((book_id, []) for book_id in book_ids)
+    for book_id, library_branch_name, available_count, copy_count in BookAvailability.objects \
+            .filter(book__in=book_ids).order_by('library_branch__name') \
+            .values_list('book', 'library_branch__name', 'available_count', 'copy_count'):
+        availability[book_id].append({
+                'library_branch_name' : library_branch_name,
+                'available_count' : available_count,
+                'copy_count' : copy_count,
+                })
+    context = {
+        "book_list" : [(book, availability[book.id]) for book in pager.object_list],
+        }
+    context.update(pager.context())
+    return render(request, 'library/reader_catalog.html', context)
 
-    bookcopy_list = []
+@login_required
+def reader_mybooks(request):
     bookcopy_set = BookCopy.objects.filter(current_checkout__user=request.user)
+    page = Page(bookcopy_set.order_by('id'), get_page_number(request))
 
     # Used for finding the status.
     now = datetime.now(pytz.utc)
 
     bookcopy_list = []
-    for bookcopy in bookcopy_set.all():
+    for row in bookcopy_rows(page.object_list, request.user, now):
         return_by_date = None
-        fine = bookcopy.current_checkout.get_fine(now)
+        fine = row.checkout.get_fine(now)
         if fine:
             fine = '$%.2f' % fine
         bookcopy_list.append({
-                "id" : bookcopy.id,
-                "library_branch_name" : bookcopy.library_branch.name,
-                "copy_number" : bookcopy.copy_number,
-                "title" : bookcopy.book.title,
-                "reserve_date" : bookcopy.current_checkout.reserve_date or "--",
-                "borrow_date" : bookcopy.current_checkout.borrow_date or "--",
+                "id" : row.id,
+                "library_branch_name" : row.library_branch_name,
+                "copy_number" : row.copy_number,
+                "title" : row.title,
+                "reserve_date" : row.checkout.reserve_date or "--",
+                "borrow_date" : row.checkout.borrow_date or "--",
                 "return_by_date" : return_by_date or "--",
-                "status" : bookcopy.status(request.user, now),
+                "status" : row.status,
                 "fine" : fine or "--"
                 })
 
-    page_count = len(bookcopy_list) / limit + 1
-    bookcopy_list = bookcopy_list[offset : offset + limit]
+    # The books the reader is waiting for, and their places in the queues.
+    hold_list = []
+    for hold in BookHold.objects.filter(user=request.user, status__in=holds.ACTIVE_STATUSES) \
+            .select_related('book').order_by('id'):
+        hold_list.append({
+                "title" : hold.book.title,
+                "hold_date" : hold.hold_date,
+                "status" : hold.get_status_display(),
+                "position" : holds.queue_position(hold) if hold.status == 'waiting' else "--",
+                })
+
     context = {
         "bookcopy_list" : bookcopy_list,
-        "page_count" : page_count,
-        "page" : page,
-        "pages" : range(1, page_count + 1),
-        "page_prev" : max(page - 1, 1),
-        "page_next" : min(page + 1, page_count)
+        "hold_list" : hold_list,
         }
+    context.update(page.context())
     return render(request, 'library/reader_mybooks.html', context)
 
 class BookCopyCheckoutForm(forms.Form):
@@ -407,7 +519,8 @@ class BookCopyCheckoutForm(forms.Form):
     ACTION_CHOICES = (
         ('borrow', 'Borrow',),
         ('reserve', 'Reserve',),
-        ('return', 'Return',))
+        ('return', 'Return',),
+        ('hold', 'Hold (wait for any copy)',))
     action = forms.ChoiceField(widget=forms.RadioSelect, choices=ACTION_CHOICES)
 
     def __init__(self, bookcopy, status, *args, **kwargs):
@@ -423,12 +536,26 @@ class BookCopyCheckoutForm(forms.Form):
             if status:
                 self.fields['status'].initial = status
 
+def suggest_branches(user, bookcopy):
+    """
+    Find the branches where a reader may get a book that is not available
+    here, the reader's home branch first, or else the branch of the copy.
+    @return Array<(int, string)>, the id and name of each branch
+    """
+    home_branch_ids = list(Reader.objects.filter(user=user)
+                           .values_list('home_branch', flat=True)[:1])
+    home_branch_id = home_branch_ids[0] if home_branch_ids else None
+    return available_branches(bookcopy.book_id, home_branch_id or bookcopy.library_branch_id)
+
 @login_required
 def reader_checkout(request):
     """
-    A form used by the reader to borrow, reserve, or return a book.
+    A form used by the reader to borrow, reserve, return or hold a book.
+    When the copy is taken, the branches with a copy available are
+    suggested, or else the reader may hold the book.
     """
     bookcopy = None
+    error = None
     if request.method == 'POST':
 
         # A 'POST' request is for form submission.
@@ -437,29 +564,19 @@ def reader_checkout(request):
             id = form.cleaned_data['id']
             action = form.cleaned_data['action']
             now = datetime.now(pytz.utc)
-            bookcopy = BookCopy.objects.get(id=id)
-
-            if action == 'borrow' or action == 'reserve':
-                # Make sure the user does not check out more than 10 books at a time.
-                checkout_count = len(filter(
-                        lambda checkout: checkout.is_current(now),
-                        BookCopyCheckout.objects.filter(user=request.user)))
-                if checkout_count > 10:
-                    return HttpResponse("User may not borrow or reserve more than 10 books!")
-
-                # Now perform the requested action.
-                if bookcopy.is_available(request.user, now):
-                    if action == 'borrow':
-                        bookcopy.do_borrow(request.user, now)
-                    elif action == 'reserve':
-                        bookcopy.do_reserve(request.user, now)
-                else:
-                    return HttpResponse("Book is not available!")
-            elif action == 'return':
-                # The book does not need to be 'available' to return it.
-                bookcopy.do_return(request.user, now)
-
-            return HttpResponseRedirect(reverse('reader_bookcopy')) # Redirect after POST
+            try:
+                bookcopy = checkout_bookcopy(request.user, id, action, now)
+            except BookCopy.DoesNotExist:
+                raise Http404
+            except BookNotAvailable as e:
+                bookcopy = BookCopy.objects.select_related('book').get(id=id)
+                error = str(e)
+            except ValueError as e:
+                return HttpResponse(str(e))
+            else:
+                if action == 'hold':
+                    return HttpResponseRedirect(reverse('reader_mybooks'))
+                return HttpResponseRedirect(reverse('reader_bookcopy')) # Redirect after POST
     else:
         # A 'GET' request is to view the form.
         id = int(request.GET.get('id', None))
@@ -468,10 +585,13 @@ def reader_checkout(request):
         bookcopy = BookCopy.objects.get(id=id)
         status = bookcopy.status(request.user, datetime.now(pytz.utc))
         form = BookCopyCheckoutForm(bookcopy, status)
+        if status in ('borrowed', 'reserved'):
+            error = "Book is not available!"
 
     context = {
         "bookcopy" : bookcopy,
-        "form" : form
+        "form" : form,
+        "error" : error,
+        "library_branch_list" : suggest_branches(request.user, bookcopy) if error else [],
         }
     return render(request, 'library/reader_checkout.html', context)
-
@@ -1,4 +1,7 @@
 import os
+import tempfile
+
+from django.core.exceptions import ImproperlyConfigured
 
 PROJECT_PATH = os.path.realpath(os.path.dirname(os.path.dirname(__file__)))
 
@@ -102,6 +105,8 @@ TEMPLATE_LOADERS = (
 )
 
 MIDDLEWARE_CLASSES = (
+    # First, so it measures the queries of the other middleware too.
+    'library.middleware.QueryStatsMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -111,6 +116,84 @@ MIDDLEWARE_CLASSES = (
     # 'django.middleware.clickjacking.XFrameOptionsMiddleware',
 )
 
+# The cache, chosen with the LIBRARY_CACHE environment variable:
+#   locmem     a separate cache in the memory of each process (the default)
+#   file       files in LIBRARY_CACHE_LOCATION, shared by the processes of
+#              one machine
+#   memcached  the memcached servers in LIBRARY_CACHE_LOCATION, shared by
+#              every machine, e.g. "10.0.0.1:11211;10.0.0.2:11211".  It needs
+#              python-memcached, without which a locmem cache stands in.
+# Cached pages are invalidated through the cache itself (see
+# library/versions.py), so a site served by several processes needs a
+# shared cache.
+LIBRARY_CACHE = os.environ.get('LIBRARY_CACHE', 'locmem')
+LIBRARY_CACHE_LOCATION = os.environ.get('LIBRARY_CACHE_LOCATION', '')
+if LIBRARY_CACHE == 'memcached':
+    try:
+        import memcache
+    except ImportError:
+        import warnings
+        warnings.warn('python-memcached is not installed, using a locmem cache.')
+        LIBRARY_CACHE = 'locmem'
+if LIBRARY_CACHE == 'locmem':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+            'LOCATION': 'librarysite',
+            'OPTIONS': {'MAX_ENTRIES': 10000},
+        }
+    }
+elif LIBRARY_CACHE == 'file':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache',
+            'LOCATION': (LIBRARY_CACHE_LOCATION or
+                         os.path.join(tempfile.gettempdir(), 'librarysite-cache')),
+            'OPTIONS': {'MAX_ENTRIES': 100000},
+        }
+    }
+elif LIBRARY_CACHE == 'memcached':
+    CACHES = {
+        'default': {
+            'BACKEND': 'django.core.cache.backends.memcached.MemcachedCache',
+            'LOCATION': (LIBRARY_CACHE_LOCATION or '127.0.0.1:11211').split(';'),
+        }
+    }
+else:
+    raise ImproperlyConfigured('LIBRARY_CACHE must be locmem, file or memcached.')
+CACHES['default']['KEY_PREFIX'] = 'librarysite'
+
+# Where sessions are kept, chosen with the LIBRARY_SESSIONS environment
+# variable:
+#   db              the database, read on every request
+#   cached_db       the cache, written through to the database.  The
+#                   default with a shared cache.
+#   signed_cookies  a signed cookie in the browser, nothing is stored
+#   cache           the cache only, sessions are lost when it is cleared
+# cached_db and cache need a shared cache when the site is served by
+# several processes, otherwise each process sees its own sessions.
+SESSION_ENGINES = {
+    'db' : 'django.contrib.sessions.backends.db',
+    'cached_db' : 'django.contrib.sessions.backends.cached_db',
+    'signed_cookies' : 'django.contrib.sessions.backends.signed_cookies',
+    'cache' : 'django.contrib.sessions.backends.cache',
+}
+LIBRARY_SESSIONS = os.environ.get('LIBRARY_SESSIONS',
+                                  'db' if LIBRARY_CACHE == 'locmem' else 'cached_db')
+if LIBRARY_SESSIONS not in SESSION_ENGINES:
+    raise ImproperlyConfigured('LIBRARY_SESSIONS must be one of %s.' %
+                               ', '.join(sorted(SESSION_ENGINES)))
+SESSION_ENGINE = SESSION_ENGINES[LIBRARY_SESSIONS]
+
+# The fraction of requests, from 0 to 1, whose queries and timings are
+# measured by QueryStatsMiddleware.  0 turns the middleware off.
+QUERY_STATS_SAMPLE_RATE = float(os.environ.get('QUERY_STATS_SAMPLE_RATE', '0'))
+
+# Where files of readers uploaded from the admin pages wait until
+# "manage.py import_readers --pending" imports them.  The web server and
+# the cron job running it must both see this directory.
+LIBRARY_IMPORT_DIR = os.environ.get('LIBRARY_IMPORT_DIR', tempfile.gettempdir())
+
 ROOT_URLCONF = 'librarysite.urls'
 
 # Python dotted path to the WSGI application used by Django's runserver.